@@ -19,13 +19,34 @@ class Config(object):
   ANNOTATOR_RUN = "/home/ubuntu/gas/ann/run.py"
   PENDING = "PENDING"
   RUNNING = "RUNNING"
+  FAILED = "FAILED"
+
+  # Worker pool; 0 sizes the pool to the instance's cores and memory
+  ANNOTATOR_MAX_WORKERS = 0
+  ANNOTATOR_JOB_MEMORY_MB = 0
+  ANNOTATOR_POOL_POLL_INTERVAL = 5
+  # "subprocess" starts run.py per job; "inprocess" reuses pre-warmed workers
+  ANNOTATOR_WORKER_MODE = "subprocess"
 
   AWS_REGION_NAME = "us-east-1"
 
+  # Shared boto3 client settings (see aws_clients.py)
+  AWS_MAX_POOL_CONNECTIONS = 50
+  AWS_MAX_ATTEMPTS = 5
+  AWS_RETRY_MODE = "standard"
+  AWS_TCP_KEEPALIVE = True
+
   # AWS S3 upload parameters
   AWS_S3_INPUTS_BUCKET = "gas-inputs"
   AWS_S3_RESULTS_BUCKET = "gas-results"
 
+  # S3 transfer tuning (see transfer.py)
+  AWS_S3_MULTIPART_THRESHOLD_MB = 64
+  AWS_S3_MULTIPART_CHUNKSIZE_MB = 64
+  AWS_S3_MAX_CONCURRENCY = 10
+  # Stream inputs into the annotator instead of downloading them first
+  AWS_S3_STREAM_INPUTS = False
+
   # AWS SNS topics
   AWS_SNS_ARN = ""
 
@@ -34,6 +55,13 @@ class Config(object):
   AWS_SQS_QUEUE_ARN = ""
   AWS_SQS_WAIT_TIME = 20
   AWS_SQS_MAX_MESSAGES = 10
+  # Leases on running jobs' messages
+  AWS_SQS_VISIBILITY_TIMEOUT = 120
+  AWS_SQS_HEARTBEAT_INTERVAL = 40
+  # Failed jobs are retried after AWS_SQS_RETRY_DELAY seconds, doubling on
+  # every attempt, and marked FAILED after AWS_SQS_MAX_ATTEMPTS deliveries
+  AWS_SQS_MAX_ATTEMPTS = 5
+  AWS_SQS_RETRY_DELAY = 30
 
   # AWS DynamoDB
   AWS_DYNAMODB_ANNOTATIONS_TABLE = ""
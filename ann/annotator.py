@@ -1,9 +1,16 @@
-import boto3
-from subprocess import Popen
-from botocore.client import Config
 from botocore.exceptions import ClientError
 import os
+import sys
 import json
+import time
+
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'common'))
+import aws_clients
+import transfer
+from worker_pool import WorkerPool, DuplicateJobError, remove_job_dir
+from lease import LeaseManager, RECEIVE_COUNT
+from sqs_batch import SQS_BATCH_SIZE, receive_messages, delete_messages
 
 # get config
 from configparser import ConfigParser, ExtendedInterpolation
@@ -12,44 +19,81 @@ config.read('ann_config.ini')
 
 REGION = config.get('aws', 'AwsRegionName')
 DYNAMO = config.get('dynamodb', 'AWS_DYNAMODB_ANNOTATIONS_TABLE')
+MAX_WORKERS = config.getint('ann', 'MAX_WORKERS')
+JOB_MEMORY_MB = config.getint('ann', 'JOB_MEMORY_MB')
+POOL_POLL_INTERVAL = config.getint('ann', 'POOL_POLL_INTERVAL')
+WORKER_MODE = config.get('ann', 'WORKER_MODE')
+VISIBILITY_TIMEOUT = config.getint('sqs', 'VISIBILITY_TIMEOUT')
+HEARTBEAT_INTERVAL = config.getint('sqs', 'HEARTBEAT_INTERVAL')
+MAX_ATTEMPTS = config.getint('sqs', 'MAX_ATTEMPTS')
+RETRY_DELAY = config.getint('sqs', 'RETRY_DELAY')
+STREAM_INPUTS = config.getboolean('s3', 'STREAM_INPUTS')
+
+aws_clients.configure(
+    region_name=REGION,
+    max_pool_connections=config.getint('aws', 'MAX_POOL_CONNECTIONS'),
+    max_attempts=config.getint('aws', 'MAX_ATTEMPTS'),
+    retry_mode=config.get('aws', 'RETRY_MODE'),
+    tcp_keepalive=config.getboolean('aws', 'TCP_KEEPALIVE'))
+
+transfer.configure(
+    multipart_threshold_mb=config.getint('s3', 'MULTIPART_THRESHOLD_MB'),
+    multipart_chunksize_mb=config.getint('s3', 'MULTIPART_CHUNKSIZE_MB'),
+    max_concurrency=config.getint('s3', 'MAX_CONCURRENCY'))
+
+# The worker pool, queue and leases are built by main(). In inprocess mode
+# the pool's worker processes import this script again (as __mp_main__),
+# and importing it must not start another polling loop.
+pool = None
+queue = None
+leases = None
+# local directory of each held job, removed when the job fails for good
+job_dirs = {}
 
 # define helper functions to initiate subprocess and update table
-def run_subprocess(args, job_id):
+def run_subprocess(job_id, file_path, user_role, source=None):
     """
-    Helper function to try to initiate subprocess.
+    Helper function to try to initiate subprocess in the worker pool.
     Doing this to avoid nested try/excepts.
     Returns True if subprocess ran correctly, False otherwise. 
     """
     try:
-        process = Popen(args)
+        if not pool.submit(job_id, file_path, user_role, source):
+            print(f"no free worker for job_id {job_id}")
+            return False
         print(f"running job_id {job_id}")
         return True
+    except DuplicateJobError:
+        raise
     except Exception as e:
         print("subprocess didn't run")
         print(e)
         return False
 
 
-def update_table(job_id):
+def update_table(job_id, attempt):
     """
-    Helper function to try to conditionally update table.
-    Doing this to avoid nested try/excepts.
-    Returns True if table updates correctly, False otherwise. 
+    Helper function to claim a job for an attempt: sets it RUNNING and
+    records the attempt, the delivery count of its message. A PENDING job
+    can always be claimed; a RUNNING one only by a later delivery, i.e. the
+    retry of an attempt that failed or died, never by a duplicate message.
+    Returns True if the job was claimed, False if it may not run.
+    Other ClientErrors are left to the caller.
     """
-    dynamodb = boto3.resource('dynamodb', region_name=REGION)
-    ann_table = dynamodb.Table(DYNAMO)
+    ann_table = aws_clients.get_resource('dynamodb').Table(DYNAMO)
 
-    # if job status cannot be updated, a ClientError exception will be thrown
     try:
         update_response = ann_table.update_item(
         Key={
             'job_id': job_id,
         },
-        UpdateExpression="SET job_status = :r",
-        ConditionExpression="job_status = :p",
+        UpdateExpression="SET job_status = :r, attempts = :n",
+        ConditionExpression="job_status = :p OR "\
+            "(job_status = :r AND (attribute_not_exists(attempts) OR attempts < :n))",
         ExpressionAttributeValues={
             ':r': "RUNNING",
-            ':p': "PENDING"
+            ':p': "PENDING",
+            ':n': attempt
         }
         )
         print('job status updated')
@@ -57,98 +101,202 @@ def update_table(job_id):
     except ClientError as ce:
         # error handling for table update
         if ce.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            print('ConditionalCheckFailedException:', "job could not be updated")
-        else:
-            print('could not update job status')
-        return False
+            print('ConditionalCheckFailedException:', f"job could not be claimed for attempt {attempt}")
+            return False
+        raise
 
 
-def delete_message(message):
+def mark_failed(job_id):
     """
-    Helper function to delete message.
+    Helper function to mark a job that used up its attempts as FAILED.
     """
+    ann_table = aws_clients.get_resource('dynamodb').Table(DYNAMO)
     try:
-        message.delete()
-        print('message deleted')
-    except ClientError as e:
-        print(e.response['Error']['Code'])
-        print('could not delete message from queue')
-
-
-# Connect to SQS and get the message queue
-sqs = boto3.resource('sqs', region_name=REGION)
-
-# get queue
-# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs.html#using-an-existing-queue
-
-# getting messages and accessing their attributes
-# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs.html#using-an-existing-queue
-
-
-queue_name = config.get('sqs', 'AWS_SQS_REQUESTS_QUEUE_NAME')
-queue = sqs.get_queue_by_name(QueueName=queue_name)
-
-# Poll the message queue in a loop 
-while True:
-    # Attempt to read a message from the queue
-    # Use long polling - DO NOT use sleep() to wait between polls
-
-    # long polling
-    # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/sqs-example-long-polling.html
-    # https://stackoverflow.com/questions/50558084/how-to-long-poll-amazon-sqs-service-using-boto
-
-    messages = queue.receive_messages(WaitTimeSeconds=20)
-    for message in messages:
-        job_info = json.loads(json.loads(message.body)['Message'])
-        receipt_handle = message.receipt_handle
-        
-        job_id = job_info['job_id']
-        user = job_info['user_id']
-        input_file = job_info['input_file_name']
-        bucket = config.get('s3', 'AWS_S3_INPUTS_BUCKET')
-        key = job_info['s3_key_input_file']
-        file_id = f"{job_id}~{input_file}"
-    
-        ##########################################
-        # check if a user has a directory. if not, create one to store their job files
-        # https://stackoverflow.com/questions/1274405/how-to-create-new-folder
-
-        # download file from s3
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
-        # https://stackoverflow.com/questions/29378763/how-to-save-s3-object-to-a-file-using-boto3
-        if not os.path.exists(f"{os.getcwd()}/anntools/data/{user}"):
-            os.makedirs(f"{os.getcwd()}/anntools/data/{user}")
-        try:
-            os.makedirs(f"{os.getcwd()}/anntools/data/{user}/{file_id}")
-        except:
-            print('directory already created')
-
-        s3 = boto3.client('s3', region_name=REGION, config=Config(signature_version='s3v4'))
-
-        try:
-            s3.download_file(bucket, key, f"{os.getcwd()}/anntools/data/{user}/{file_id}/{file_id}")
-        except ClientError as error:
-            e_message = error.response['Error']['Message']
-            if e_message == 'Not Found':
-                print('Bucket does not exist')
-            elif e_message == 'Forbidden':
-                print('Access to this bucket is forbidden')
-
-        ##########################################
-
-        # Launch annotation job as a background process
-        args = ['python', f"{os.getcwd()}/run.py", f"{os.getcwd()}/anntools/data/{user}/{file_id}/{file_id}"]
-
-        subprocess_ran = run_subprocess(args, job_id)
-
-        if subprocess_ran:
-            # if subprocess runs successfully, update status to 'RUNNING'
-            table_updated = update_table(job_id)
-            if not table_updated:
-                # table couldn't be updated
-                print("Message will be deleted because subprocess ran correctly, "\
-                    "but table could not be updated to reflect 'RUNNING' status.")
-            # Delete the message from the queue, if job was successfully submitted
-            delete_message(message)
-        else:
-            print("subprocess failed to spawn. please try again.")                
+        ann_table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression="SET job_status = :f",
+        ConditionExpression="job_status IN (:p, :r)",
+        ExpressionAttributeValues={':f': "FAILED", ':p': "PENDING", ':r': "RUNNING"}
+        )
+        print(f"job_id {job_id} marked FAILED")
+    except ClientError as ce:
+        print(f"could not mark job_id {job_id} FAILED: {ce.response['Error']['Code']}")
+
+
+def fail_job(job_id):
+    """
+    Handles a failed attempt: the job is retried after a backoff, or marked
+    FAILED once it has used up its attempts. Its local directory is
+    removed, unless it holds checkpointed chunks a retry here can reuse.
+    """
+    if leases.fail(job_id):
+        job_dir = job_dirs.pop(job_id, None)
+        if job_dir:
+            remove_job_dir(job_dir, keep_checkpoint=True)
+    else:
+        give_up(job_id, release=False)
+
+
+def give_up(job_id, release=True):
+    """
+    Marks a job FAILED, deletes its message (unless fail() already did)
+    and removes its local directory.
+    """
+    if release:
+        leases.complete([job_id])
+    mark_failed(job_id)
+    job_dir = job_dirs.pop(job_id, None)
+    if job_dir:
+        remove_job_dir(job_dir)
+
+
+def main():
+    """
+    Polls the job request queue and runs jobs in the worker pool.
+    """
+    global pool, queue, leases
+
+    # jobs run in a bounded pool instead of one unmanaged process per message
+    pool = WorkerPool(MAX_WORKERS, JOB_MEMORY_MB, WORKER_MODE, f"{os.getcwd()}/run.py")
+
+    # Connect to SQS and get the message queue
+    sqs = aws_clients.get_resource('sqs')
+
+    # get queue
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs.html#using-an-existing-queue
+
+    # getting messages and accessing their attributes
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs.html#using-an-existing-queue
+
+
+    queue_name = config.get('sqs', 'AWS_SQS_REQUESTS_QUEUE_NAME')
+    queue = sqs.get_queue_by_name(QueueName=queue_name)
+
+    # messages of running jobs are held until the job finishes
+    leases = LeaseManager(queue, VISIBILITY_TIMEOUT, HEARTBEAT_INTERVAL, MAX_ATTEMPTS, RETRY_DELAY)
+
+    # Poll the message queue in a loop 
+    while True:
+        # Attempt to read a message from the queue
+        # Use long polling - DO NOT use sleep() to wait between polls
+
+        # long polling
+        # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/sqs-example-long-polling.html
+        # https://stackoverflow.com/questions/50558084/how-to-long-poll-amazon-sqs-service-using-boto
+
+        # collect finished jobs so their slots can be reused;
+        # successful jobs give up their message, failed ones are retried
+        completed_jobs = []
+        for finished_job, returncode in pool.reap():
+            print(f"job_id {finished_job} finished with exit code {returncode}")
+            if returncode == 0:
+                # the job cleaned up its own directory
+                job_dirs.pop(finished_job, None)
+                completed_jobs.append(finished_job)
+            else:
+                fail_job(finished_job)
+        leases.complete(completed_jobs)
+
+        # only pull as many messages as there are free workers;
+        # the rest stay in the queue for this or another ann instance
+        free_slots = pool.free_slots()
+        if not free_slots:
+            try:
+                print('all workers busy:', pool.stats(queue))
+            except ClientError as e:
+                print(e.response['Error']['Code'])
+            time.sleep(POOL_POLL_INTERVAL)
+            continue
+
+        messages = receive_messages(queue, 20, min(free_slots, SQS_BATCH_SIZE), [RECEIVE_COUNT])
+        for message in messages:
+            job_info = json.loads(json.loads(message.body)['Message'])
+            receipt_handle = message.receipt_handle
+
+            job_id = job_info['job_id']
+            user = job_info['user_id']
+            input_file = job_info['input_file_name']
+            bucket = config.get('s3', 'AWS_S3_INPUTS_BUCKET')
+            key = job_info['s3_key_input_file']
+            file_id = f"{job_id}~{input_file}"
+
+            # hold the message from here on, so it stays invisible while the
+            # input downloads; a second delivery of a job held here must not
+            # overwrite its input
+            if not leases.acquire(job_id, message):
+                print(f"job_id {job_id} is already held here; dropping duplicate request")
+                delete_messages(queue, [message])
+                continue
+            job_dirs[job_id] = f"{os.getcwd()}/anntools/data/{user}/{file_id}"
+
+            # the job was delivered more often than it may be attempted
+            # (e.g. instances died while running it)
+            if leases.attempt(job_id) > leases.max_attempts:
+                give_up(job_id)
+                continue
+
+            # claim the job for this attempt before doing any work; this fails
+            # if the job is finished or an attempt with a later delivery holds it
+            try:
+                claimed = update_table(job_id, leases.attempt(job_id))
+            except ClientError as ce:
+                print('could not update job status:', ce.response['Error']['Code'])
+                fail_job(job_id)
+                continue
+            if not claimed:
+                print(f"job_id {job_id} is finished or running elsewhere; dropping request")
+                job_dirs.pop(job_id, None)
+                leases.complete([job_id])
+                continue
+
+            ##########################################
+            # check if a user has a directory. if not, create one to store their job files
+            # https://stackoverflow.com/questions/1274405/how-to-create-new-folder
+
+            # download file from s3
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
+            # https://stackoverflow.com/questions/29378763/how-to-save-s3-object-to-a-file-using-boto3
+            if not os.path.exists(f"{os.getcwd()}/anntools/data/{user}"):
+                os.makedirs(f"{os.getcwd()}/anntools/data/{user}")
+            try:
+                os.makedirs(f"{os.getcwd()}/anntools/data/{user}/{file_id}")
+            except:
+                print('directory already created')
+
+            # when streaming, the job reads the input straight from S3
+            source = f"s3://{bucket}/{key}" if STREAM_INPUTS else None
+            if not STREAM_INPUTS:
+                s3 = aws_clients.get_client('s3', signature_version='s3v4')
+
+                try:
+                    progress = transfer.download_file(s3, bucket, key,
+                        f"{os.getcwd()}/anntools/data/{user}/{file_id}/{file_id}")
+                    print(progress)
+                except ClientError as error:
+                    e_message = error.response['Error']['Message']
+                    if e_message == 'Not Found':
+                        print('Bucket does not exist')
+                    elif e_message == 'Forbidden':
+                        print('Access to this bucket is forbidden')
+                    fail_job(job_id)
+                    continue
+
+            ##########################################
+
+            # Launch annotation job in the worker pool; the message stays held
+            # until the job finishes, then it is deleted on success and retried
+            # or dropped on failure
+            file_path = f"{os.getcwd()}/anntools/data/{user}/{file_id}/{file_id}"
+            try:
+                subprocess_ran = run_subprocess(job_id, file_path, job_info.get('user_role'), source)
+            except DuplicateJobError:
+                # cannot happen while the lease is held, but never run a job twice
+                continue
+
+            if not subprocess_ran:
+                print("subprocess failed to spawn. please try again.")
+                fail_job(job_id)
+
+
+if __name__ == '__main__':
+    main()
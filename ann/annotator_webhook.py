@@ -11,12 +11,20 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import requests
 from flask import Flask, jsonify, request
-import boto3
-from subprocess import Popen
-from botocore.client import Config
 from botocore.exceptions import ClientError
 import os
+import sys
 import json
+import time
+import threading
+
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'common'))
+import aws_clients
+import transfer
+from worker_pool import WorkerPool, DuplicateJobError, remove_job_dir
+from lease import LeaseManager, RECEIVE_COUNT
+from sqs_batch import receive_messages, delete_messages
 
 app = Flask(__name__)
 environment = 'ann_config.Config'
@@ -33,36 +41,35 @@ AWS_SQS_WAIT_TIME = app.config['AWS_SQS_WAIT_TIME']
 AWS_SQS_MAX_MESSAGES = app.config['AWS_SQS_MAX_MESSAGES']
 RUNNING = app.config['RUNNING']
 PENDING = app.config['PENDING']
+FAILED = app.config['FAILED']
 
 FILE_SEP = app.config['FILE_SEP']
 KEY_SEP = app.config['KEY_SEP']
 
-# Connect to SQS and get the message queue
+aws_clients.configure(
+    region_name=REGION,
+    max_pool_connections=app.config['AWS_MAX_POOL_CONNECTIONS'],
+    max_attempts=app.config['AWS_MAX_ATTEMPTS'],
+    retry_mode=app.config['AWS_RETRY_MODE'],
+    tcp_keepalive=app.config['AWS_TCP_KEEPALIVE'])
+
+transfer.configure(
+    multipart_threshold_mb=app.config['AWS_S3_MULTIPART_THRESHOLD_MB'],
+    multipart_chunksize_mb=app.config['AWS_S3_MULTIPART_CHUNKSIZE_MB'],
+    max_concurrency=app.config['AWS_S3_MAX_CONCURRENCY'])
+
+POOL_POLL_INTERVAL = app.config['ANNOTATOR_POOL_POLL_INTERVAL']
+STREAM_INPUTS = app.config['AWS_S3_STREAM_INPUTS']
 QUEUE_NAME = app.config['AWS_SQS_QUEUE_NAME']
 
-try:
-    sqs = boto3.resource('sqs', region_name=REGION)
-except ClientError as e:
-    print(e, file=sys.stderr)
-
-# Check if requests queue exists, otherwise create it
-try:
-    queue = sqs.get_queue_by_name(QueueName=QUEUE_NAME)
-except ClientError as e:
-    if e.response['Error']['Code'] == 'AWS.SimpleQueueService.NonExistentQueue':
-        queue = sqs.create_queue(QueueName=QUEUE_NAME)
-        sns = boto3.resource('sns', region_name=REGION)
-        topic = sns.Topic(SNS)
-        try:
-            subscription = topic.subscribe(
-                Protocol='sqs',
-                Endpoint=app.config['AWS_SQS_QUEUE_ARN']
-            )
-        except ClientError as e:
-            print(e)
-            print("Could not subscribe queue to sns")
-    else:
-        print("Could not connect to queue")
+# The worker pool, queue and leases are built by main(). In inprocess mode
+# the pool's worker processes import this script again (as __mp_main__),
+# and importing it must not connect to SQS, start a reaper or run Flask.
+pool = None
+queue = None
+leases = None
+# local directory of each held job, removed when the job fails for good
+job_dirs = {}
 
 
 '''
@@ -100,7 +107,7 @@ def annotate():
         try:
             # connect to sns
             # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/reference/services/sns.html
-            sns = boto3.client('sns', region_name=REGION)
+            sns = aws_clients.get_client('sns')
             response = sns.confirm_subscription(
                 TopicArn=request_data['TopicArn'],
                 Token=request_data['Token']
@@ -121,61 +128,195 @@ def annotate():
     else:
         if request_type == 'Notification':
             app.logger.info('Job request received.')
-            try:
-                messages = queue.receive_messages(WaitTimeSeconds=AWS_SQS_WAIT_TIME, MaxNumberOfMessages=AWS_SQS_MAX_MESSAGES)
-            except ClientError as e:
-                return jsonify({"code": 500, "message": "Could not retrieve messages."})
-            for message in messages:
-                # parse variables
-                job_info = json.loads(json.loads(message.body)['Message'])
-                receipt_handle = message.receipt_handle
-        
-                try:
-                    job_id = job_info['job_id']
-                    user = job_info['user_id']
-                    input_file = job_info['input_file_name']
-                    bucket = app.config['AWS_S3_INPUTS_BUCKET']
-                    key = job_info['s3_key_input_file']
-                    file_id = f"{job_id}{FILE_SEP}{input_file}"
-                    user_role = job_info['user_role']
-                except KeyError as k:
-                    print('Could not retrieve necessary job information.')
-                    return jsonify({"code": 500, "message": "Could not retrieve messages."})
-
-                # create dirs to run annotation
-                create_dirs(user, file_id)
-
-                # connect to s3 to download file
-                try:
-                    s3 = boto3.client('s3', region_name=REGION, config=Config(signature_version='s3v4'))
-                except ClientError as e:
-                    return jsonify({"code": 500, "message": "Could not connect to s3"})
-                
-                download_file(s3, bucket, key, user, file_id)
-
-                # launch annotation
-                args = ['python', RUN_PY, f"{JOBS_DIR}{KEY_SEP}{user}{KEY_SEP}{file_id}{KEY_SEP}{file_id}", user_role]
-
-                subprocess_ran = run_subprocess(args, job_id)
-                if subprocess_ran:
-                    # if subprocess runs successfully, update status to 'RUNNING'
-                    table_updated = update_table(job_id)
-                    if not table_updated:
-                        # table couldn't be updated
-                        app.logger.error("Message will be deleted because subprocess ran correctly, "\
-                            "but table could not be updated to reflect 'RUNNING' status.")
-                    # Delete the message from the queue, if job was successfully submitted
-                    delete_message(message)
-                else:
-                    app.logger.error('Failed to run subprocess') 
+            error = process_job_requests()
+            if error:
+                return error
 
     return jsonify({
         "code": 200, 
         "message": "Annotation job request processed."
         }), 200
 
+@app.route('/stats', methods=['GET'])
+def pool_stats():
+    """
+    Reports in-flight jobs, the approximate depth of the request queue
+    and the number of AWS clients alive in this process.
+    """
+    try:
+        stats = pool.stats(queue)
+        stats['aws_clients'] = aws_clients.stats()
+        return jsonify({"code": 200, "stats": stats}), 200
+    except ClientError as e:
+        return jsonify({"code": 500, "message": e.response['Error']['Code']}), 500
+
 #### HELPER FUNCTIONS ####
 
+def process_job_requests():
+    """
+    Pulls as many job requests as there are free workers and starts them.
+    Messages that do not fit in the pool stay in the queue until a worker
+    frees up. SNS request threads and the reaper thread call this at the
+    same time, so slots are reserved before receiving, and the slot of a
+    message that does not get started is handed back. Each message is
+    leased as soon as it is received: a duplicate delivery or a malformed
+    request is deleted, a job that is finished or claimed elsewhere gives
+    up its message, and a job that fails to start goes through fail_job(),
+    which releases it for a retry after a backoff or marks it FAILED.
+    Returns an error response, or None on success.
+    """
+    free_slots = pool.reserve(AWS_SQS_MAX_MESSAGES)
+    if not free_slots:
+        app.logger.info('All workers busy; leaving job requests in queue.')
+        return None
+
+    try:
+        messages = receive_messages(queue, AWS_SQS_WAIT_TIME, free_slots, [RECEIVE_COUNT])
+    except ClientError as e:
+        pool.cancel(free_slots)
+        return jsonify({"code": 500, "message": "Could not retrieve messages."})
+    # hand back the slots no message arrived for
+    pool.cancel(free_slots - len(messages))
+
+    error = None
+    for message in messages:
+        # parse variables
+        job_info = json.loads(json.loads(message.body)['Message'])
+        receipt_handle = message.receipt_handle
+
+        try:
+            job_id = job_info['job_id']
+            user = job_info['user_id']
+            input_file = job_info['input_file_name']
+            bucket = app.config['AWS_S3_INPUTS_BUCKET']
+            key = job_info['s3_key_input_file']
+            file_id = f"{job_id}{FILE_SEP}{input_file}"
+            user_role = job_info['user_role']
+        except KeyError as k:
+            # a malformed request can never run; drop it
+            print('Could not retrieve necessary job information.')
+            pool.cancel()
+            delete_messages(queue, [message])
+            error = jsonify({"code": 500, "message": "Could not retrieve messages."})
+            continue
+
+        # hold the message from here on, so it stays invisible while the
+        # input downloads; a second delivery of a job held here is dropped
+        if not leases.acquire(job_id, message):
+            pool.cancel()
+            drop_duplicate(job_id, message)
+            continue
+        job_dir = f"{JOBS_DIR}{KEY_SEP}{user}{KEY_SEP}{file_id}"
+        job_dirs[job_id] = job_dir
+
+        # the job was delivered more often than it may be attempted
+        # (e.g. instances died while running it)
+        if leases.attempt(job_id) > leases.max_attempts:
+            pool.cancel()
+            give_up(job_id)
+            continue
+
+        # claim the job for this attempt before doing any work; this fails
+        # if the job is finished or an attempt with a later delivery holds it
+        try:
+            claimed = update_table(job_id, leases.attempt(job_id))
+        except ClientError as e:
+            app.logger.error(f"Could not update job status: {e.response['Error']['Code']}")
+            pool.cancel()
+            fail_job(job_id)
+            continue
+        if not claimed:
+            app.logger.info(f"job_id {job_id} is finished or running elsewhere; dropping request")
+            pool.cancel()
+            job_dirs.pop(job_id, None)
+            leases.complete([job_id])
+            continue
+
+        # create dirs to run annotation
+        create_dirs(user, file_id)
+
+        # when streaming, the job reads the input straight from S3;
+        # otherwise download it first
+        source = f"s3://{bucket}/{key}" if STREAM_INPUTS else None
+        if not STREAM_INPUTS:
+            # connect to s3 to download file
+            try:
+                s3 = aws_clients.get_client('s3', signature_version='s3v4')
+            except ClientError as e:
+                pool.cancel()
+                fail_job(job_id)
+                error = jsonify({"code": 500, "message": "Could not connect to s3"})
+                continue
+
+            if not download_file(s3, bucket, key, user, file_id):
+                pool.cancel()
+                fail_job(job_id)
+                continue
+
+        # launch annotation; the message stays held until the job finishes,
+        # then it is deleted on success and retried or dropped on failure
+        file_path = f"{job_dir}{KEY_SEP}{file_id}"
+        try:
+            subprocess_ran = run_subprocess(job_id, file_path, user_role, source)
+        except DuplicateJobError:
+            # cannot happen while the lease is held, but never run a job twice
+            continue
+        if not subprocess_ran:
+            app.logger.error('Failed to run subprocess')
+            fail_job(job_id)
+    return error
+
+
+def fail_job(job_id):
+    """
+    Handles a failed attempt: the job is retried after a backoff, or marked
+    FAILED once it has used up its attempts. Its local directory is
+    removed, unless it holds checkpointed chunks a retry here can reuse.
+    """
+    if leases.fail(job_id):
+        job_dir = job_dirs.pop(job_id, None)
+        if job_dir:
+            remove_job_dir(job_dir, keep_checkpoint=True)
+    else:
+        give_up(job_id, release=False)
+
+
+def give_up(job_id, release=True):
+    """
+    Marks a job FAILED, deletes its message (unless fail() already did)
+    and removes its local directory.
+    """
+    if release:
+        leases.complete([job_id])
+    mark_failed(job_id)
+    job_dir = job_dirs.pop(job_id, None)
+    if job_dir:
+        remove_job_dir(job_dir)
+
+
+def reap_workers():
+    """
+    Background loop that collects finished jobs and, whenever a worker
+    frees up, pulls the requests that were left waiting in the queue.
+    """
+    while True:
+        time.sleep(POOL_POLL_INTERVAL)
+        finished = pool.reap()
+        completed_jobs = []
+        for job_id, returncode in finished:
+            app.logger.info(f"job_id {job_id} finished with exit code {returncode}")
+            if returncode == 0:
+                # the job cleaned up its own directory
+                job_dirs.pop(job_id, None)
+                completed_jobs.append(job_id)
+            else:
+                fail_job(job_id)
+        leases.complete(completed_jobs)
+        if finished and pool.free_slots():
+            with app.app_context():
+                process_job_requests()
+
+
 def create_dirs(user, file_id):
     """
     Creates directory locally to store file.
@@ -192,55 +333,77 @@ def create_dirs(user, file_id):
 def download_file(s3, bucket, key, user, file_id):
     """
     Helper function. Downloads file locally to run anntools.
+    Returns True if the file was downloaded, False otherwise.
     """
     try:
-        s3.download_file(bucket, key, f"{JOBS_DIR}{KEY_SEP}{user}{KEY_SEP}{file_id}{KEY_SEP}{file_id}")
-        app.logger.info('Downloaded file locally')
+        progress = transfer.download_file(s3, bucket, key,
+            f"{JOBS_DIR}{KEY_SEP}{user}{KEY_SEP}{file_id}{KEY_SEP}{file_id}")
+        app.logger.info(f"Downloaded file locally: {progress}")
     except ClientError as error:
         e_message = error.response['Error']['Message']
         if e_message == 'Not Found':
             app.logger.error('Bucket does not exist')
         elif e_message == 'Forbidden':
             app.logger.error('Access to this bucket is forbidden')
-        return jsonify({"code": 500, "error": "Could not download file to run annotation."})
+        app.logger.error("Could not download file to run annotation.")
+        return False
+    return True
 
 
-def run_subprocess(args, job_id):
+def run_subprocess(job_id, file_path, user_role, source=None):
     """
-    Helper function to try to initiate subprocess.
+    Helper function to try to initiate subprocess in one of the worker
+    pool slots reserved by process_job_requests.
     Doing this to avoid nested try/excepts.
     Returns True if subprocess ran correctly, False otherwise. 
     """
     try:
-        process = Popen(args)
+        if not pool.submit(job_id, file_path, user_role, source, reserved=True):
+            app.logger.info(f"No free worker for job_id {job_id}")
+            return False
         app.logger.info(f"running job_id {job_id}")
         return True
+    except DuplicateJobError:
+        raise
     except Exception as e:
         app.logger.error("subprocess didn't run")
         app.logger.error(e)
         return False
 
 
-def update_table(job_id):
+def drop_duplicate(job_id, message):
     """
-    Helper function to try to conditionally update table.
-    Doing this to avoid nested try/excepts.
-    Returns True if table updates correctly, False otherwise. 
+    Deletes a second delivery of a job that is already held here; the
+    held job keeps the original message.
+    """
+    app.logger.info(f"job_id {job_id} is already held here; dropping duplicate request")
+    delete_messages(queue, [message])
+
+
+def update_table(job_id, attempt):
     """
-    dynamodb = boto3.resource('dynamodb', region_name=REGION)
-    ann_table = dynamodb.Table(DYNAMO)
+    Claims the job for an attempt by setting it RUNNING and recording the
+    attempt, which is the delivery count of its message. A PENDING job can
+    always be claimed; a RUNNING one only by a later delivery of its
+    message, i.e. the retry of an attempt that failed or died. A duplicate
+    message, or a job that is already finished, cannot claim it.
+    Returns True if the job was claimed, False if it may not run.
+    Other ClientErrors are left to the caller.
+    """
+    ann_table = aws_clients.get_resource('dynamodb').Table(DYNAMO)
 
-    # if job status cannot be updated, a ClientError exception will be thrown
     try:
-        update_response = ann_table.update_item(
+        ann_table.update_item(
             Key={
                 'job_id': job_id,
             },
-            UpdateExpression="SET job_status = :r",
-            ConditionExpression="job_status = :p",
+            UpdateExpression="SET job_status = :r, attempts = :n",
+            ConditionExpression="job_status = :p OR "\
+                "(job_status = :r AND (attribute_not_exists(attempts) OR attempts < :n))",
             ExpressionAttributeValues={
                 ':r': RUNNING,
-                ':p': PENDING
+                ':p': PENDING,
+                ':n': attempt
             }
             )
         app.logger.info('job status updated')
@@ -248,24 +411,76 @@ def update_table(job_id):
     except ClientError as ce:
         # error handling for table update
         if ce.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            app.logger.error('ConditionalCheckFailedException:', "Job could not be updated")
-        else:
-            app.logger.error('Could not update job status')
-        return False
+            app.logger.info(f"job_id {job_id} could not be claimed for attempt {attempt}")
+            return False
+        raise
+
+
+def mark_failed(job_id):
+    """
+    Marks a job that used up its attempts as FAILED.
+    """
+    ann_table = aws_clients.get_resource('dynamodb').Table(DYNAMO)
+    try:
+        ann_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression="SET job_status = :f",
+            ConditionExpression="job_status IN (:p, :r)",
+            ExpressionAttributeValues={':f': FAILED, ':p': PENDING, ':r': RUNNING})
+        app.logger.info(f"job_id {job_id} marked {FAILED}")
+    except ClientError as ce:
+        app.logger.error(f"Could not mark job_id {job_id} {FAILED}: {ce.response['Error']['Code']}")
 
 
-def delete_message(message):
+def main():
     """
-    Helper function to delete message.
+    Builds the worker pool, connects to the request queue and serves the
+    SNS endpoint, with the reaper running in the background.
     """
+    global pool, queue, leases
+
+    # jobs run in a bounded pool instead of one unmanaged process per message
+    pool = WorkerPool(app.config['ANNOTATOR_MAX_WORKERS'], app.config['ANNOTATOR_JOB_MEMORY_MB'],
+        app.config['ANNOTATOR_WORKER_MODE'], RUN_PY)
+
+    # Connect to SQS and get the message queue
     try:
-        message.delete()
-        app.logger.info('message deleted')
+        sqs = aws_clients.get_resource('sqs')
     except ClientError as e:
-        app.logger.error(e.response['Error']['Code'])
-        app.logger.error('could not delete message from queue')
+        print(e, file=sys.stderr)
+
+    # Check if requests queue exists, otherwise create it
+    try:
+        queue = sqs.get_queue_by_name(QueueName=QUEUE_NAME)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'AWS.SimpleQueueService.NonExistentQueue':
+            queue = sqs.create_queue(QueueName=QUEUE_NAME)
+            sns = aws_clients.get_resource('sns')
+            topic = sns.Topic(SNS)
+            try:
+                subscription = topic.subscribe(
+                    Protocol='sqs',
+                    Endpoint=app.config['AWS_SQS_QUEUE_ARN']
+                )
+            except ClientError as e:
+                print(e)
+                print("Could not subscribe queue to sns")
+        else:
+            print("Could not connect to queue")
+
+    # messages of running jobs are held until the job finishes
+    leases = LeaseManager(queue, app.config['AWS_SQS_VISIBILITY_TIMEOUT'],
+        app.config['AWS_SQS_HEARTBEAT_INTERVAL'], app.config['AWS_SQS_MAX_ATTEMPTS'],
+        app.config['AWS_SQS_RETRY_DELAY'])
+
+    threading.Thread(target=reap_workers, daemon=True).start()
+
+    # the reloader would run main() again in a child process, with a
+    # second pool and lease heartbeat
+    app.run('0.0.0.0', debug=True, use_reloader=False)
 
 
-app.run('0.0.0.0', debug=True)
+if __name__ == '__main__':
+    main()
 
 ### EOF
\ No newline at end of file
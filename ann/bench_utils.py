@@ -0,0 +1,90 @@
+# bench_utils.py
+#
+# Benchmarks for the helpers in utils.py
+#
+# Usage: python bench_utils.py [pairs]
+#
+# Compares the scalar overlap helpers, called once per variant/region
+# pair, with their vectorized NumPy counterparts on random segments, and
+# the linear-time dedup with the list-scan version it replaced.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import time
+import random
+
+import numpy as np
+
+import utils
+
+
+def timed(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    secs = time.perf_counter() - start
+    print(f"{name:<40} {secs:8.3f} s")
+    return result, secs
+
+
+def random_segments(n, span=10000000, max_len=100000):
+    starts = np.random.randint(0, span, size=n)
+    ends = starts + np.random.randint(0, max_len, size=n)
+    return starts, ends
+
+
+def bench_overlap(n):
+    print(f"\n{n} variant/region pairs")
+    test_starts, test_ends = random_segments(n)
+    ref_starts, ref_ends = random_segments(n)
+    # the scalar path works on plain Python ints, as it does in the annotator
+    pairs = list(zip(test_starts.tolist(), test_ends.tolist(),
+        ref_starts.tolist(), ref_ends.tolist()))
+
+    scalar, scalar_secs = timed('proportionOverlap (scalar loop)',
+        lambda: [utils.proportionOverlap(*pair) for pair in pairs])
+    vector, vector_secs = timed('proportionOverlapArray',
+        utils.proportionOverlapArray, test_starts, test_ends, ref_starts, ref_ends)
+    assert np.allclose(scalar, vector)
+    print(f"speedup: {scalar_secs / vector_secs:.1f}x")
+
+    scalar, scalar_secs = timed('isBetween (scalar loop)',
+        lambda: [utils.isBetween(t, r1, r2) for t, _, r1, r2 in pairs])
+    vector, vector_secs = timed('isBetweenArray',
+        utils.isBetweenArray, test_starts, ref_starts, ref_ends)
+    assert scalar == vector.tolist()
+    print(f"speedup: {scalar_secs / vector_secs:.1f}x")
+
+
+def dedup_list_scan(mylist):
+    # the original dedup, quadratic in the number of unique elements
+    outlist = []
+    for element in mylist:
+        if element not in outlist:
+            outlist.append(element)
+    return outlist
+
+
+def bench_dedup(n):
+    print(f"\ndedup of up to {n} gene names (about half duplicates)")
+    genes = [f"GENE{random.randrange(n // 2)}" for _ in range(n)]
+    # the list scan is quadratic, so only time it on prefixes of the input
+    for size in (n // 100, n // 20, n // 10):
+        expected, _ = timed(f"list scan, {size} elements", dedup_list_scan, genes[:size])
+        result, _ = timed(f"dedup, {size} elements", utils.dedup, genes[:size])
+        assert result == expected
+    timed(f"dedup, {n} elements", utils.dedup, genes)
+    # dicts are unhashable; a key function keeps them on the linear path
+    records = [{'gene': gene} for gene in genes]
+    timed(f"dedup by key, {n} dict records", utils.dedup, records, lambda r: r['gene'])
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    random.seed(0)
+    np.random.seed(0)
+    bench_overlap(n)
+    bench_dedup(100000)
+
+### EOF
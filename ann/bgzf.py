@@ -0,0 +1,244 @@
+# bgzf.py
+#
+# gzip/BGZF input and output for the annotation pipeline
+#
+# Inputs may be uploaded as .vcf.gz (plain gzip or BGZF); they are
+# decompressed as a stream, never loaded whole. Annotated output can be
+# written as BGZF, the blocked gzip variant used by bgzip/tabix: a series
+# of independent gzip members of at most 64 KB each, readable by any gzip
+# tool, with an optional tabix (.tbi) index for region queries.
+#
+# BGZF and tabix formats: https://samtools.github.io/hts-specs/SAMv1.pdf
+# and https://samtools.github.io/hts-specs/tabix.pdf
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import struct
+import zlib
+
+MB = 1024 * 1024
+
+GZ = '.gz'
+TBI = '.tbi'
+
+# bgzip keeps the uncompressed data of a block under 64 KB so the
+# compressed block always fits in the 16-bit BSIZE field
+BLOCK_DATA = 0xff00
+
+# gzip member header with the BGZF 'BC' extra subfield; BSIZE is appended
+BLOCK_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+TABIX_VCF = 2
+
+
+def is_gzipped(path):
+    return path.endswith(GZ)
+
+
+def strip_gz(path):
+    return path[:-len(GZ)] if is_gzipped(path) else path
+
+
+def iter_gunzip(chunks):
+    """
+    Decompresses a stream of gzip bytes (plain gzip, multi-member gzip or
+    BGZF) chunk by chunk. Raises EOFError if the input is truncated.
+    """
+    d = zlib.decompressobj(31)
+    pending = False
+    for chunk in chunks:
+        while chunk:
+            pending = True
+            data = d.decompress(chunk)
+            if data:
+                yield data
+            if d.eof:
+                # BGZF and concatenated gzip files hold several members
+                chunk = d.unused_data
+                d = zlib.decompressobj(31)
+                pending = False
+            else:
+                chunk = b''
+    if pending:
+        raise EOFError('compressed input ended before the end of the gzip stream')
+
+
+def read_chunks(f, size=MB):
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def gunzip_file(src, dst):
+    """
+    Decompresses src into dst without holding either in memory.
+    Returns the number of bytes written.
+    """
+    written = 0
+    with open(src, 'rb') as f, open(dst, 'wb') as out:
+        for data in iter_gunzip(read_chunks(f)):
+            out.write(data)
+            written += len(data)
+    return written
+
+
+class BgzfWriter:
+    """
+    Writes BGZF. tell() returns the virtual offset of the next byte
+    (compressed block offset << 16 | offset within the block), which is
+    what tabix indexes point at.
+    """
+    def __init__(self, path, level=6):
+        self.file = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.block_offset = 0
+
+    def tell(self):
+        return (self.block_offset << 16) | len(self.buffer)
+
+    def write(self, data):
+        while data:
+            space = BLOCK_DATA - len(self.buffer)
+            self.buffer += data[:space]
+            data = data[space:]
+            if len(self.buffer) >= BLOCK_DATA:
+                self.flush_block()
+
+    def flush_block(self):
+        if not self.buffer:
+            return
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(bytes(self.buffer)) + compressor.flush()
+        size = len(BLOCK_HEADER) + 2 + len(deflated) + 8
+        self.file.write(BLOCK_HEADER)
+        self.file.write(struct.pack('<H', size - 1))
+        self.file.write(deflated)
+        self.file.write(struct.pack('<II', zlib.crc32(self.buffer) & 0xffffffff, len(self.buffer)))
+        self.block_offset += size
+        self.buffer.clear()
+
+    def close(self):
+        self.flush_block()
+        self.file.write(EOF_BLOCK)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def reg2bin(beg, end):
+    """
+    Smallest UCSC/tabix bin containing [beg, end), 0-based.
+    """
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+class TabixIndex:
+    """
+    Builds a tabix index for a coordinate-sorted BGZF VCF as its records
+    are written. Records must arrive sorted; otherwise sorted is set to
+    False and the index must not be written.
+    """
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        self.current = None
+        self.last_beg = 0
+        self.sorted = True
+
+    def add(self, chrom, beg, end, voff_beg, voff_end):
+        if chrom != self.current:
+            if chrom in self.refs:
+                self.sorted = False
+            self.current = chrom
+            self.last_beg = 0
+            self.names.append(chrom)
+            self.refs[chrom] = {'bins': {}, 'linear': []}
+        if beg < self.last_beg:
+            self.sorted = False
+        self.last_beg = beg
+        end = max(end, beg + 1)
+
+        ref = self.refs[chrom]
+        chunks = ref['bins'].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == voff_beg:
+            chunks[-1][1] = voff_end
+        else:
+            chunks.append([voff_beg, voff_end])
+
+        linear = ref['linear']
+        first, last = beg >> 14, (end - 1) >> 14
+        if len(linear) <= last:
+            linear.extend([None] * (last + 1 - len(linear)))
+        for window in range(first, last + 1):
+            if linear[window] is None:
+                linear[window] = voff_beg
+
+    def write(self, path):
+        names = b''.join(name.encode() + b'\x00' for name in self.names)
+        with BgzfWriter(path) as out:
+            out.write(b'TBI\x01')
+            out.write(struct.pack('<8i', len(self.names), TABIX_VCF, 1, 2, 0, ord('#'), 0, len(names)))
+            out.write(names)
+            for name in self.names:
+                ref = self.refs[name]
+                out.write(struct.pack('<i', len(ref['bins'])))
+                for bin_id, chunks in sorted(ref['bins'].items()):
+                    out.write(struct.pack('<Ii', bin_id, len(chunks)))
+                    for voff_beg, voff_end in chunks:
+                        out.write(struct.pack('<QQ', voff_beg, voff_end))
+                # windows with no record start at the previous window's offset
+                linear = []
+                previous = 0
+                for offset in ref['linear']:
+                    previous = previous if offset is None else offset
+                    linear.append(previous)
+                out.write(struct.pack('<i', len(linear)))
+                out.write(struct.pack(f"<{len(linear)}Q", *linear))
+
+
+def compress_vcf(src, dst, index=False, level=6):
+    """
+    Compresses the VCF src into BGZF at dst. With index, also writes a
+    tabix index at dst + '.tbi' if the records are coordinate-sorted.
+    Returns the index path, or None if no index was written.
+    """
+    tabix = TabixIndex() if index else None
+    with open(src, 'rb') as f, BgzfWriter(dst, level) as out:
+        for line in f:
+            if tabix is None or line.startswith(b'#') or not line.strip():
+                out.write(line)
+                continue
+            voff_beg = out.tell()
+            out.write(line)
+            chrom, pos, _, ref = line.split(b'\t', 4)[:4]
+            beg = int(pos) - 1
+            tabix.add(chrom.decode(), beg, beg + len(ref), voff_beg, out.tell())
+    if tabix is None:
+        return None
+    if not tabix.sorted:
+        print(f"{src} is not coordinate-sorted; no tabix index written")
+        return None
+    tabix.write(dst + TBI)
+    return dst + TBI
+
+### EOF
@@ -0,0 +1,166 @@
+# checkpoint.py
+#
+# Chunk-level checkpoints for resumable annotation
+#
+# Chunked annotation (see parallel.py) records every finished chunk in a
+# manifest kept next to the chunks. A restarted job re-splits its input,
+# skips the chunks the manifest lists as done and annotates only the rest.
+# With a store, chunk outputs and the manifest are also copied to S3, so
+# a job retried on another instance (e.g. after a spot interruption)
+# resumes instead of starting over.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+
+from botocore.exceptions import ClientError
+
+import transfer
+
+MANIFEST = 'manifest.json'
+
+
+class S3Store:
+    """
+    Keeps checkpoint files under an S3 prefix.
+    """
+    def __init__(self, s3, bucket, prefix):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get_manifest(self):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + MANIFEST)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+    def put_manifest(self, manifest):
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + MANIFEST,
+            Body=json.dumps(manifest).encode())
+
+    def upload(self, path):
+        transfer.upload_file(self.s3, path, self.bucket, self.prefix + os.path.basename(path))
+
+    def download(self, path):
+        transfer.download_file(self.s3, self.bucket, self.prefix + os.path.basename(path), path)
+
+    def clear(self):
+        """
+        Deletes every object under the prefix.
+        """
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if keys:
+                self.s3.delete_objects(Bucket=self.bucket, Delete={'Objects': keys})
+
+
+class Checkpoint:
+    """
+    Manifest of finished chunks in chunk_dir. A manifest written with a
+    different chunk size is ignored, since the chunks would not line up.
+    Each entry records the size of the chunk's input, so a chunk is only
+    reused if re-splitting produced the same chunk.
+    """
+    def __init__(self, chunk_dir, chunk_records, store=None):
+        self.chunk_dir = chunk_dir
+        self.chunk_records = chunk_records
+        self.store = store
+        self.path = os.path.join(chunk_dir, MANIFEST)
+        self.manifest = self.load()
+
+    def load(self):
+        manifest = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+        elif self.store is not None:
+            try:
+                manifest = self.store.get_manifest()
+            except ClientError as e:
+                print(f"could not read checkpoint manifest: {e.response['Error']['Code']}")
+        if not manifest or manifest.get('chunk_records') != self.chunk_records:
+            manifest = {'chunk_records': self.chunk_records, 'chunks': {}}
+        return manifest
+
+    def save(self):
+        # write and rename, so a crash never leaves a half-written manifest
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.path)
+        if self.store is not None:
+            try:
+                self.store.put_manifest(self.manifest)
+            except ClientError as e:
+                self.drop_store(e)
+
+    @property
+    def completed(self):
+        return len(self.manifest['chunks'])
+
+    def restore(self, chunk_path):
+        """
+        The (annot, log) paths of an already annotated chunk, fetched from
+        the store if they are not on local disk, or None if the chunk
+        still has to be annotated.
+        """
+        name = os.path.basename(chunk_path)
+        entry = self.manifest['chunks'].get(name)
+        if entry is None:
+            return None
+        if entry['input_bytes'] != os.path.getsize(chunk_path):
+            del self.manifest['chunks'][name]
+            return None
+        paths = (os.path.join(self.chunk_dir, entry['annot']),
+            os.path.join(self.chunk_dir, entry['log']))
+        for path in paths:
+            if os.path.exists(path):
+                continue
+            if self.store is None:
+                return None
+            try:
+                self.store.download(path)
+            except ClientError:
+                return None
+        return paths
+
+    def record(self, chunk_path, annot_path, log_path):
+        """
+        Marks a chunk as annotated, after copying its outputs to the store.
+        """
+        if self.store is not None:
+            try:
+                self.store.upload(annot_path)
+                self.store.upload(log_path)
+            except ClientError as e:
+                self.drop_store(e)
+        self.manifest['chunks'][os.path.basename(chunk_path)] = {
+            'annot': os.path.basename(annot_path),
+            'log': os.path.basename(log_path),
+            'input_bytes': os.path.getsize(chunk_path),
+        }
+        self.save()
+
+    def drop_store(self, error):
+        # an unreachable store must not fail the job; keep checkpointing locally
+        print(f"checkpoint store unavailable, continuing locally: {error.response['Error']['Code']}")
+        self.store = None
+
+    def clear(self):
+        """
+        Drops the remote copy once the job has finished.
+        """
+        if self.store is not None:
+            try:
+                self.store.clear()
+            except ClientError as e:
+                print(f"could not delete checkpoint from store: {e.response['Error']['Code']}")
+
+### EOF
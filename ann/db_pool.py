@@ -0,0 +1,339 @@
+# db_pool.py
+#
+# Pooled connections to the reference annotator database
+#
+# db_connect() used to fetch the RDS secret and open a new connection
+# for every caller. Credentials are now cached and refreshed after a TTL,
+# connections are kept in a bounded pool and health-checked before reuse,
+# and repeated reference lookups can be answered from an LRU cache.
+# db_connect() now hands out pooled connections whose close() checks
+# them back in.
+#
+# The connect factory is injectable, so the pool can be exercised against
+# a local MySQL or an sqlite3 stand-in, e.g.
+#   ConnectionPool(connect=lambda: sqlite3.connect('ref.db', check_same_thread=False))
+#
+# Settings can be tuned with configure() or the ANNOTATOR_DB_* environment
+# variables.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pymysql
+
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'common'))
+import aws_clients
+
+settings = {
+    'secret_id': os.environ.get('ANNOTATOR_DB_SECRET_ID', 'rds/anntools_database'),
+    'database': os.environ.get('ANNOTATOR_DB_NAME', 'annotator'),
+    'credentials_ttl': int(os.environ.get('ANNOTATOR_DB_CREDENTIALS_TTL', 900)),
+    'max_connections': int(os.environ.get('ANNOTATOR_DB_MAX_CONNECTIONS', 4)),
+    'acquire_timeout': int(os.environ.get('ANNOTATOR_DB_ACQUIRE_TIMEOUT', 30)),
+    'connect_timeout': int(os.environ.get('ANNOTATOR_DB_CONNECT_TIMEOUT', 10)),
+    'query_cache_size': int(os.environ.get('ANNOTATOR_DB_QUERY_CACHE_SIZE', 10000)),
+}
+
+# MySQL error code for a rejected login, e.g. after the secret was rotated
+ACCESS_DENIED = 1045
+
+lock = threading.Lock()
+credentials = {'secret': None, 'fetched': 0}
+state = {'pid': None, 'pool': None}
+
+
+def configure(**kwargs):
+    """
+    Overrides pool settings (secret_id, database, credentials_ttl,
+    max_connections, acquire_timeout, connect_timeout, query_cache_size).
+    Pools that were already built keep their size, so call this at startup.
+    """
+    unknown = set(kwargs) - set(settings)
+    if unknown:
+        raise ValueError(f"unknown database settings: {', '.join(sorted(unknown))}")
+    with lock:
+        settings.update(kwargs)
+
+
+def get_credentials(refresh=False):
+    """
+    The RDS secret from Secrets Manager, cached for credentials_ttl seconds.
+    ClientErrors are left to the caller.
+    """
+    with lock:
+        age = time.time() - credentials['fetched']
+        if refresh or credentials['secret'] is None or age > settings['credentials_ttl']:
+            asm = aws_clients.get_client('secretsmanager')
+            response = asm.get_secret_value(SecretId=settings['secret_id'])
+            credentials['secret'] = json.loads(response['SecretString'])
+            credentials['fetched'] = time.time()
+        return credentials['secret']
+
+
+def mysql_connect():
+    """
+    Opens a pymysql connection with the cached credentials. A rejected
+    login refreshes the secret once, in case it was rotated.
+    """
+    for refresh in (False, True):
+        secret = get_credentials(refresh=refresh)
+        try:
+            return pymysql.connect(
+                host=secret['host'],
+                port=secret['port'],
+                user=secret['username'],
+                passwd=secret['password'],
+                db=settings['database'],
+                connect_timeout=settings['connect_timeout'])
+        except pymysql.err.OperationalError as e:
+            if refresh or e.args[0] != ACCESS_DENIED:
+                raise
+
+
+def is_healthy(conn):
+    """
+    Checks a pooled connection before it is handed out again.
+    """
+    try:
+        if hasattr(conn, 'ping'):
+            conn.ping(reconnect=False)
+        else:
+            # DB-API connections without ping(), such as sqlite3
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+def cache_key(sql, params):
+    """
+    Hashable key for a query. pymysql takes params as a sequence, a dict
+    of named params or a single value; dicts are keyed by their sorted
+    items so the values (not just the names) count and order does not.
+    """
+    if params is None:
+        return (sql, ())
+    if isinstance(params, dict):
+        return (sql, tuple(sorted(params.items())))
+    if isinstance(params, (list, tuple)):
+        return (sql, tuple(params))
+    return (sql, (params,))
+
+
+class PooledConnection:
+    """
+    A connection checked out of a pool for code that expects a plain
+    DB-API connection. It behaves like the connection, except that
+    close() returns it to the pool instead of closing it.
+    """
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise pymysql.err.InterfaceError("connection was returned to the pool")
+        return getattr(self._conn, name)
+
+    def close(self, broken=False):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn, broken=broken)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(broken=exc_type is not None)
+
+    def __del__(self):
+        # a caller that never closes must not hold a pool slot forever
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class QueryCache:
+    """
+    LRU cache of query results keyed by (sql, params). Results are stored
+    as tuples of rows so callers cannot modify a cached result.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.rows:
+                self.rows.move_to_end(key)
+                self.hits += 1
+                return self.rows[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, rows):
+        with self.lock:
+            self.rows[key] = rows
+            self.rows.move_to_end(key)
+            while len(self.rows) > self.size:
+                self.rows.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.rows),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class ConnectionPool:
+    """
+    Bounded pool of database connections. At most max_connections are
+    open at once; acquire() waits up to acquire_timeout seconds for one to
+    be released. Idle connections are health-checked before reuse and
+    replaced if the check fails.
+    """
+    def __init__(self, connect=None, max_connections=None, query_cache_size=None):
+        self.connect = connect or mysql_connect
+        self.max_connections = max_connections or settings['max_connections']
+        cache_size = settings['query_cache_size'] if query_cache_size is None else query_cache_size
+        self.cache = QueryCache(cache_size) if cache_size > 0 else None
+        self.slots = threading.BoundedSemaphore(self.max_connections)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.replaced = 0
+
+    def acquire(self, timeout=None):
+        timeout = settings['acquire_timeout'] if timeout is None else timeout
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError(f"no database connection free after {timeout} s")
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    conn = self.connect()
+                    with self.lock:
+                        self.opened += 1
+                    return conn
+                if is_healthy(conn):
+                    return conn
+                self.discard(conn)
+                with self.lock:
+                    self.replaced += 1
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken:
+            self.discard(conn)
+        else:
+            with self.lock:
+                self.idle.append(conn)
+        self.slots.release()
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def checkout(self, timeout=None):
+        """
+        A connection whose close() checks it back into the pool.
+        """
+        return PooledConnection(self, self.acquire(timeout))
+
+    @contextmanager
+    def connection(self):
+        """
+        with pool.connection() as conn: ... returns conn to the pool, or
+        closes it if the block raised a database error.
+        """
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    def query(self, sql, params=(), cache=True):
+        """
+        Runs a read-only query and returns its rows as a tuple. With cache,
+        repeated (sql, params) lookups are answered from the LRU cache.
+        """
+        key = cache_key(sql, params)
+        if cache and self.cache is not None:
+            rows = self.cache.get(key)
+            if rows is not None:
+                return rows
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                rows = tuple(tuple(row) for row in cursor.fetchall())
+            finally:
+                cursor.close()
+        if cache and self.cache is not None:
+            self.cache.put(key, rows)
+        return rows
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self.discard(conn)
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'max_connections': self.max_connections,
+                'idle': len(self.idle),
+                'opened': self.opened,
+                'replaced': self.replaced,
+            }
+        if self.cache is not None:
+            stats['query_cache'] = self.cache.stats()
+        return stats
+
+
+def get_pool():
+    """
+    The process-wide pool, built on first use. Connections must not be
+    shared with a forked child, so a new pid starts a new pool.
+    """
+    with lock:
+        pid = os.getpid()
+        if state['pid'] != pid:
+            state['pid'] = pid
+            state['pool'] = ConnectionPool()
+        return state['pool']
+
+### EOF
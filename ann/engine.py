@@ -0,0 +1,441 @@
+# engine.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Annotation engine: runs AnnTools on a job and publishes its results.
+# Imported once by long-lived workers so that boto3, the configuration
+# and the AnnTools driver are loaded before any job arrives; run.py is a
+# thin command line wrapper around run_job().
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import time
+import driver
+import shutil
+import os
+import traceback
+import hashlib
+from botocore.exceptions import ClientError
+import json
+
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'common'))
+import aws_clients
+import bgzf
+import checkpoint
+import parallel
+import ref_lookup
+import result_cache
+import transfer
+
+# get config
+from configparser import ConfigParser, ExtendedInterpolation
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read('ann_config.ini')
+
+CNET = config.get('ann', 'CNET')
+REGION = config.get('aws', 'AwsRegionName')
+BUCKET = config.get('s3', 'AWS_S3_RESULTS_BUCKET')
+DYNAMO = config.get('dynamodb', 'AWS_DYNAMODB_ANNOTATIONS_TABLE')
+SNS_ARN = config.get('sns', 'AWS_SNS_JOB_RESULTS_TOPIC')
+JOBS_DIR = config.get('ann', 'ANNOTATOR_JOBS_DIR')
+ANNOT = config.get('ann', 'ANNOT')
+LOG = config.get('ann', 'LOG')
+COMPLETED = config.get('ann', 'COMPLETED')
+SM_ARN = config.get('sm', 'AWS_STATE_MACHINE_ARN')
+RETURN_OPT = config.get('dynamodb', 'RETURN_OPT')
+KEY_SEP = config.get('ann', 'KEY_SEP')
+FILE_SEP = config.get('ann', 'FILE_SEP')
+VCF = config.get('ann', 'VCF')
+GZIP_UPLOADS = config.getboolean('s3', 'GZIP_UPLOADS')
+PARALLEL_WORKERS = config.getint('ann', 'PARALLEL_WORKERS')
+CHUNK_RECORDS = config.getint('ann', 'CHUNK_RECORDS')
+BGZF_OUTPUT = config.getboolean('ann', 'BGZF_OUTPUT')
+TABIX_INDEX = config.getboolean('ann', 'TABIX_INDEX')
+CHECKPOINT_CHUNKS = config.getboolean('ann', 'CHECKPOINT_CHUNKS')
+CHECKPOINT_TO_S3 = config.getboolean('ann', 'CHECKPOINT_TO_S3')
+CHECKPOINT_PREFIX = config.get('ann', 'CHECKPOINT_PREFIX')
+RESULT_CACHE = config.getboolean('cache', 'RESULT_CACHE')
+
+aws_clients.configure(
+    region_name=REGION,
+    max_pool_connections=config.getint('aws', 'MAX_POOL_CONNECTIONS'),
+    max_attempts=config.getint('aws', 'MAX_ATTEMPTS'),
+    retry_mode=config.get('aws', 'RETRY_MODE'),
+    tcp_keepalive=config.getboolean('aws', 'TCP_KEEPALIVE'))
+
+transfer.configure(
+    multipart_threshold_mb=config.getint('s3', 'MULTIPART_THRESHOLD_MB'),
+    multipart_chunksize_mb=config.getint('s3', 'MULTIPART_CHUNKSIZE_MB'),
+    max_concurrency=config.getint('s3', 'MAX_CONCURRENCY'),
+    stream_range_mb=config.getint('s3', 'STREAM_RANGE_MB'))
+
+ref_lookup.configure(
+    backend=config.get('ref', 'BACKEND'),
+    snapshot_dir=config.get('ref', 'SNAPSHOT_DIR'))
+
+
+def get_clients():
+    """
+    Returns the AWS clients used to publish results from the process-wide
+    registry, which builds them on first use in each (forked) process.
+    """
+    return {
+        's3': aws_clients.get_client('s3', signature_version='s3v4'),
+        'dynamodb': aws_clients.get_resource('dynamodb'),
+        'sns': aws_clients.get_client('sns'),
+        'stepfunctions': aws_clients.get_client('stepfunctions'),
+    }
+
+
+def get_result_cache():
+    """
+    The result cache for this annotator configuration. The output format
+    is part of the cache key, since BGZF and plain results differ.
+    """
+    return result_cache.ResultCache(get_clients()['s3'], BUCKET,
+        config.get('cache', 'PREFIX'),
+        {
+            'annotator': config.get('cache', 'ANNOTATOR_VERSION'),
+            'reference': config.get('cache', 'REFERENCE_VERSION'),
+            'format': 'bgzf' if BGZF_OUTPUT else 'vcf',
+        },
+        config.get('cache', 'METRICS_NAMESPACE'))
+
+
+def annot_path_for(file_path):
+    """
+    Where AnnTools writes the annotated output for an input file.
+    """
+    direc, name = os.path.split(file_path)
+    return os.path.join(direc, name.replace(VCF, '') + ANNOT)
+
+
+def log_path_for(file_path):
+    """
+    Where AnnTools writes the log for an input file.
+    """
+    return file_path + LOG
+
+
+def annotate_chunk(chunk_path):
+    """
+    Annotates one chunk of a split input; runs in a worker process.
+    """
+    driver.run(chunk_path, 'vcf')
+    return annot_path_for(chunk_path), log_path_for(chunk_path)
+
+
+def checkpoint_store(file_path):
+    """
+    S3 location for a job's chunk checkpoints, next to its results:
+    <CNET>/<user>/<job_id~file>/<CHECKPOINT_PREFIX>/
+    """
+    split_file = file_path.split(KEY_SEP)
+    user, job_id_file = split_file[-3], split_file[-1]
+    return checkpoint.S3Store(get_clients()['s3'], BUCKET,
+        f"{CNET}{KEY_SEP}{user}{KEY_SEP}{job_id_file}{KEY_SEP}{CHECKPOINT_PREFIX}{KEY_SEP}")
+
+
+def annotate(file_path, store=None):
+    """
+    Runs AnnTools on the input, in parallel chunks when configured.
+    Checkpointed jobs always run in chunks so that they can be resumed.
+    """
+    if PARALLEL_WORKERS > 1 or CHECKPOINT_CHUNKS:
+        workers = max(1, PARALLEL_WORKERS)
+        chunks = parallel.annotate_parallel(file_path, annotate_chunk,
+            annot_path_for(file_path), log_path_for(file_path),
+            workers, CHUNK_RECORDS, VCF, CHECKPOINT_CHUNKS, store)
+        print(f"annotated {chunks} chunk(s) with {workers} workers")
+    else:
+        driver.run(file_path, 'vcf')
+
+
+def warm_up():
+    """
+    Worker process initializer; builds the AWS clients before the first job.
+    """
+    get_clients()
+
+
+class Results:
+    def __init__(self, file_path, user_role):
+
+        split_file = file_path.split(KEY_SEP)
+        self.user = split_file[-3]
+        self.job_id_file = split_file[-1]
+        self.job_id, self.input_file = self.job_id_file.split(FILE_SEP)
+        # gzipped inputs are annotated from their decompressed copy
+        self.vcf_file = bgzf.strip_gz(self.input_file)
+
+        self.jobs_direc = f"{JOBS_DIR}{KEY_SEP}{self.user}{KEY_SEP}{self.job_id_file}"
+
+        # result file names and their keys in the results bucket
+        self.annot_file = self.job_id + FILE_SEP + self.vcf_file.replace(VCF, '') + ANNOT
+        if BGZF_OUTPUT:
+            self.annot_file += bgzf.GZ
+        self.log_file = self.job_id + FILE_SEP + self.vcf_file + LOG
+        key_prefix = f"{CNET}{KEY_SEP}{self.user}{KEY_SEP}{self.job_id_file}{KEY_SEP}"
+        self.annot_key = key_prefix + self.annot_file
+        self.log_key = key_prefix + self.log_file
+        self.index_key = self.annot_key + bgzf.TBI if BGZF_OUTPUT and TABIX_INDEX else None
+        self.index_uploaded = False
+
+        self.s3 = get_clients()['s3']
+
+        self.user_role = user_role
+
+    def upload_annot_file(self):
+        # uploading a file
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+        # https://stackoverflow.com/questions/15085864/how-to-upload-a-file-to-directory-in-s3-bucket-using-boto
+        # https://www.learnaws.org/2022/07/13/boto3-upload-files-s3/
+
+        annot_path = f"{self.jobs_direc}{KEY_SEP}{self.annot_file}"
+
+        try:
+            index_path = None
+            if BGZF_OUTPUT:
+                # BGZF is already compressed, so no Content-Encoding on top
+                annot_path = annot_path[:-len(bgzf.GZ)]
+                index_path = bgzf.compress_vcf(annot_path, annot_path + bgzf.GZ, index=TABIX_INDEX)
+                annot_path += bgzf.GZ
+            print('uploading .annot file')
+            progress = transfer.upload_file(self.s3, annot_path, BUCKET, self.annot_key,
+                compress=GZIP_UPLOADS and not BGZF_OUTPUT)
+            print(progress)
+            if index_path:
+                try:
+                    transfer.upload_file(self.s3, index_path, BUCKET, self.index_key)
+                    self.index_uploaded = True
+                except ClientError as error:
+                    # the results are usable without their index
+                    print(f"could not upload tabix index: {error.response['Error']['Code']}")
+            return True
+        except FileNotFoundError:
+            print("Subprocess did not generate annotator file. Please try again.")
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'AccessDenied':
+                print("Access Denied.")
+            elif error.response['Error']['Code'] == 'NoSuchBucket':
+                print('Bucket does not exist')
+        return False
+
+    def upload_log_file(self):
+        # attempt to upload log file
+        try:
+            # attempt to upload log file
+            print('uploading .log file')
+            progress = transfer.upload_file(self.s3, f"{self.jobs_direc}{KEY_SEP}{self.log_file}", BUCKET,
+                self.log_key, compress=GZIP_UPLOADS)
+            print(progress)
+            return True
+        except FileNotFoundError:
+            # ignore annotation failures
+            print("Subprocess did not generate log file. Please try again.")
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'AccessDenied':
+                print("Access Denied.")
+            elif error.response['Error']['Code'] == 'NoSuchBucket':
+                print('Bucket does not exist')
+        return False
+
+    def upload_results(self):
+        """
+        Uploads the .annot and .log files concurrently.
+        Returns (annot_uploaded, log_uploaded).
+        """
+        annot_uploaded, log_uploaded = transfer.run_parallel(
+            self.upload_annot_file, self.upload_log_file)
+        return annot_uploaded, log_uploaded
+
+
+"""A rudimentary timer for coarse-grained profiling
+"""
+class Timer(object):
+  def __init__(self, verbose=True):
+    self.verbose = verbose
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.end = time.time()
+    self.secs = self.end - self.start
+    if self.verbose:
+      print(f"Approximate runtime: {self.secs:.2f} seconds")
+
+
+def run_job(file_path, user_role, source=None):
+    """
+    Annotates the input file, uploads the results, marks the job COMPLETED,
+    notifies the user and cleans up the local job directory.
+    If source is an s3:// URI, the input is streamed from S3 through a
+    named pipe at file_path while it is being annotated, rather than read
+    from a previously downloaded file.
+    A .vcf.gz input (gzip or BGZF) is decompressed as a stream next to
+    file_path, or on its way into the pipe, since AnnTools reads plain VCF.
+    With the result cache, an input that was annotated before (same bytes,
+    same annotator and reference versions) is answered from the cache
+    without running AnnTools.
+    Returns True if the annotated results were published, False otherwise.
+    """
+    vcf_path = bgzf.strip_gz(file_path)
+    cache = get_result_cache() if RESULT_CACHE else None
+    input_digest = None
+
+    # a downloaded input can be looked up before annotating it; a streamed
+    # one is hashed on its way in and can only populate the cache
+    if cache and not source:
+        input_digest = result_cache.file_digest(file_path)
+        results = Results(file_path, user_role)
+        if cache.restore(input_digest, results.annot_key, results.log_key, results.index_key):
+            print(f"results for {results.job_id} copied from the result cache")
+            finalize_job(results)
+            cleanup_job(results)
+            return True
+
+    feeder = None
+    streamed_digest = None
+    if source:
+        bucket, key = transfer.parse_s3_uri(source)
+        chunks = transfer.iter_object_ranges(get_clients()['s3'], bucket, key)
+        if cache:
+            streamed_digest = hashlib.sha256()
+            chunks = result_cache.hashing(chunks, streamed_digest)
+        if bgzf.is_gzipped(file_path):
+            chunks = bgzf.iter_gunzip(chunks)
+        feeder = transfer.FifoFeeder(vcf_path, chunks)
+    elif vcf_path != file_path:
+        try:
+            bgzf.gunzip_file(file_path, vcf_path)
+            os.remove(file_path)
+        except Exception:
+            print(f"could not decompress {file_path}")
+            traceback.print_exc()
+            return False
+
+    # chunks of a job that died part way are reused when it is retried,
+    # on this instance or (with an S3 store) on any other
+    store = checkpoint_store(file_path) if CHECKPOINT_CHUNKS and CHECKPOINT_TO_S3 else None
+
+    # Call the AnnTools pipeline
+    try:
+        with Timer():
+            annotate(vcf_path, store)
+    except Exception:
+        print(f"annotation failed for {file_path}")
+        traceback.print_exc()
+        return False
+    finally:
+        if feeder:
+            feeder.close()
+
+    if feeder and feeder.error:
+        print(f"input stream from {source} failed: {feeder.error}")
+        return False
+
+    # initialize results files
+    results = Results(file_path, user_role)
+
+    # upload the results files in a directory for their job
+    annot_uploaded, log_uploaded = results.upload_results()
+    if not annot_uploaded:
+        return False
+
+    if cache and log_uploaded:
+        if streamed_digest is not None:
+            input_digest = streamed_digest.hexdigest()
+        cache.store(input_digest, results.annot_key, results.log_key,
+            results.index_key if results.index_uploaded else None)
+
+    finalize_job(results)
+    cleanup_job(results)
+    return True
+
+
+def finalize_job(results):
+    """
+    Marks the job COMPLETED, publishes the job results notification and,
+    for free users, starts the archival state machine.
+    """
+    # update table and get return values
+    # https://stackoverflow.com/questions/34447304/example-of-update-item-in-dynamodb-boto3
+    complete_time = int(time.time())
+    try:
+        ann_table = get_clients()['dynamodb'].Table(DYNAMO)
+        table_response = ann_table.update_item(
+                Key={
+                    'job_id': results.job_id,
+                },
+                UpdateExpression="set s3_results_bucket = :r, s3_key_result_file = :a, s3_key_log_file =:l,\
+                complete_time=:t, job_status=:v",
+                ExpressionAttributeValues={
+                    ':r': BUCKET,
+                    ':a': f"{CNET}{KEY_SEP}{results.user}{KEY_SEP}{results.annot_file}",
+                    ':l': f"{CNET}{KEY_SEP}{results.user}{KEY_SEP}{results.log_file}",
+                    ':t': complete_time,
+                    ':v': COMPLETED
+                },
+                ReturnValues=RETURN_OPT,
+            )
+        print('Updated table status')
+        user_role = table_response['Attributes'].get('user_role', None)
+    except ClientError as e:
+        print("could not update table with 'COMPLETED' status")
+        print(e.response['Error']['Code'])
+
+    #### publish a notification that the job is complete ####
+
+    sns_message = {
+                'user_id': results.user,
+                'job_id': results.job_id,
+                'complete_time': str(complete_time),
+                'input_file': results.input_file
+                }
+    try:
+        response = get_clients()['sns'].publish(
+            TopicArn=SNS_ARN,
+            Message=json.dumps(sns_message)
+        )
+    except ClientError as e:
+        print('could not publish message to topic')
+        print(e.response['Error']['Code'])
+
+
+    #### execute step function ####
+    if results.user_role == 'free_user':
+        try:
+            sf_response = get_clients()['stepfunctions'].start_execution(
+                stateMachineArn=SM_ARN,
+                input=json.dumps(sns_message)
+                )
+            print('Free user: step function executed.')
+        except:
+            print('ERROR: Could not activate step function.')
+
+
+def cleanup_job(results):
+    """
+    Deletes the local files for a finished job.
+    """
+    #### local delete files ####
+    # https://stackoverflow.com/questions/6996603/how-do-i-delete-a-file-or-folder-in-python
+
+    # check if user's directory has no other jobs before deleting the directory
+    # this is to prevent deleting a user's ongoing jobs
+    existing_dirs = os.listdir(f"{JOBS_DIR}{KEY_SEP}{results.user}")
+    if len(existing_dirs) == 1 and existing_dirs[0] == results.job_id_file:
+        shutil.rmtree(f"{JOBS_DIR}{KEY_SEP}{results.user}")
+        print(f"user's directory and files for {results.job_id} were deleted.")
+    else:
+        shutil.rmtree(f"{JOBS_DIR}{KEY_SEP}{results.user}{KEY_SEP}{results.job_id_file}")
+        print(f"files associated with job_id {results.job_id} were deleted.")
+
+
+### EOF
@@ -0,0 +1,169 @@
+# lease.py
+#
+# SQS message leases for running annotation jobs
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import threading
+from botocore.exceptions import ClientError
+
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'common'))
+from sqs_batch import SQS_BATCH_SIZE, delete_messages
+
+
+# SQS caps a message's visibility timeout at 12 hours
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+# ask receive_messages() for this attribute so attempts can be counted
+RECEIVE_COUNT = 'ApproximateReceiveCount'
+
+
+def receive_count(message):
+    """
+    How many times SQS has delivered the message, this delivery included.
+    """
+    return int(message.attributes.get(RECEIVE_COUNT, 1)) if message.attributes else 1
+
+
+class LeaseManager:
+    """
+    Holds the SQS message of every job from the moment it is received
+    until the job has run. A background thread periodically extends the
+    visibility timeout of all held messages, so no other annotator picks
+    the job up while its input downloads or it is in progress. When the
+    job finishes, complete() deletes its message; if it fails, fail()
+    makes the message visible again after an exponentially growing delay
+    so the job is retried here or on another ann instance, until it has
+    been delivered max_attempts times. If this instance dies, the
+    heartbeats stop and the message reappears after visibility_timeout.
+    """
+    def __init__(self, queue, visibility_timeout=120, heartbeat_interval=40,
+            max_attempts=5, retry_delay=30):
+        if heartbeat_interval >= visibility_timeout:
+            raise ValueError("heartbeat_interval must be shorter than visibility_timeout")
+        self.queue = queue
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
+        self.thread.start()
+
+    def acquire(self, job_id, message):
+        """
+        Starts holding the message of a job that has just been received.
+        Returns False, without holding it, if a message for the same job
+        is already held here (a duplicate delivery).
+        """
+        with self.lock:
+            if job_id in self.leases:
+                return False
+            self.leases[job_id] = message
+        self.extend([(job_id, message)])
+        return True
+
+    def attempt(self, job_id):
+        """
+        The attempt number of a held job, counted from its deliveries.
+        """
+        with self.lock:
+            message = self.leases.get(job_id)
+        return receive_count(message) if message is not None else 0
+
+    def exhausted(self, job_id):
+        return self.attempt(job_id) >= self.max_attempts
+
+    def backoff(self, attempt):
+        """
+        Seconds before attempt + 1: retry_delay, doubled for every
+        further attempt.
+        """
+        return min(self.retry_delay * 2 ** max(attempt - 1, 0), MAX_VISIBILITY_TIMEOUT)
+
+    def fail(self, job_id):
+        """
+        Handles a failed attempt. The message is released for a retry
+        after backoff(), or deleted once the job has had max_attempts.
+        Returns True if the job will be retried, False if it gave up.
+        """
+        if self.exhausted(job_id):
+            print(f"job_id {job_id} failed {self.attempt(job_id)} times; giving up")
+            self.complete([job_id])
+            return False
+        self.release(job_id, self.backoff(self.attempt(job_id)))
+        return True
+
+    def complete(self, job_ids):
+        """
+        Deletes the messages of jobs that finished successfully, batching
+        the deletes. Returns the job_ids whose message could not be deleted.
+        """
+        with self.lock:
+            held = [(job_id, self.leases.pop(job_id)) for job_id in job_ids
+                if job_id in self.leases]
+        if not held:
+            return []
+        failed = delete_messages(self.queue, [message for _, message in held])
+        print(f"deleted {len(held) - len(failed)} completed job message(s)")
+        return [job_id for job_id, message in held if message in failed]
+
+    def release(self, job_id, delay=0):
+        """
+        Stops holding a job's message; it becomes visible again after
+        delay seconds. Returns True if the message was released.
+        """
+        with self.lock:
+            message = self.leases.pop(job_id, None)
+        if message is None:
+            return False
+        try:
+            message.change_visibility(VisibilityTimeout=delay)
+            print(f"message for job_id {job_id} released for retry in {delay}s")
+            return True
+        except ClientError as e:
+            # the message will still reappear once its visibility expires
+            print(e.response['Error']['Code'])
+            print(f"could not release message for job_id {job_id}")
+            return False
+
+    def held(self):
+        with self.lock:
+            return len(self.leases)
+
+    def extend(self, leases):
+        """
+        Resets the visibility timeout of the given (job_id, message) pairs.
+        """
+        for i in range(0, len(leases), SQS_BATCH_SIZE):
+            entries = [{
+                'Id': job_id,
+                'ReceiptHandle': message.receipt_handle,
+                'VisibilityTimeout': self.visibility_timeout
+                } for job_id, message in leases[i:i + SQS_BATCH_SIZE]]
+            try:
+                response = self.queue.change_message_visibility_batch(Entries=entries)
+            except ClientError as e:
+                print(e.response['Error']['Code'])
+                print('could not extend message visibility')
+                continue
+            for failed in response.get('Failed', []):
+                print(f"could not extend lease for job_id {failed['Id']}: {failed.get('Code')}")
+
+    def heartbeat_loop(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            with self.lock:
+                leases = list(self.leases.items())
+            if leases:
+                self.extend(leases)
+
+    def stop(self):
+        self.stopped.set()
+
+### EOF
@@ -0,0 +1,131 @@
+# parallel.py
+#
+# Chunked parallel annotation of large VCF files
+#
+# The input is split into chunks of records, each carrying a copy of the
+# VCF header, the chunks are annotated in a process pool and their outputs
+# are merged back in the original record order. With checkpointing,
+# finished chunks are recorded as they complete and a restarted job only
+# annotates the chunks that are missing (see checkpoint.py).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from checkpoint import Checkpoint
+
+
+def split_vcf(input_path, chunk_dir, chunk_records, vcf_suffix='.vcf'):
+    """
+    Splits a VCF into files of at most chunk_records records, each starting
+    with the full header. Yields chunk paths as soon as each chunk is
+    written, so annotation can start before the whole input is split.
+    The input is read once, front to back, so it may be a named pipe.
+    """
+    os.makedirs(chunk_dir, exist_ok=True)
+    header = []
+    chunk = None
+    count = 0
+    n = 0
+    with open(input_path, 'rb') as vcf:
+        for line in vcf:
+            if line.startswith(b'#') and chunk is None and n == 0:
+                header.append(line)
+                continue
+            if chunk is None:
+                n += 1
+                chunk_path = os.path.join(chunk_dir, f"chunk{n:05d}{vcf_suffix}")
+                chunk = open(chunk_path, 'wb')
+                chunk.writelines(header)
+            chunk.write(line)
+            count += 1
+            if count == chunk_records:
+                chunk.close()
+                yield chunk_path
+                chunk = None
+                count = 0
+    if chunk is not None:
+        chunk.close()
+        yield chunk_path
+    elif n == 0:
+        # header-only input: annotate it as a single (empty) chunk
+        chunk_path = os.path.join(chunk_dir, f"chunk00001{vcf_suffix}")
+        with open(chunk_path, 'wb') as chunk:
+            chunk.writelines(header)
+        yield chunk_path
+
+
+def merge_chunks(chunk_paths, out_path, skip_headers=True):
+    """
+    Concatenates chunk outputs in order. With skip_headers, '#' lines are
+    only kept from the first chunk.
+    """
+    with open(out_path, 'wb') as out:
+        for i, chunk_path in enumerate(chunk_paths):
+            with open(chunk_path, 'rb') as chunk:
+                if i == 0 or not skip_headers:
+                    shutil.copyfileobj(chunk, out)
+                    continue
+                for line in chunk:
+                    if not line.startswith(b'#'):
+                        out.write(line)
+
+
+def annotate_parallel(input_path, annotate_chunk, annot_path, log_path,
+        workers, chunk_records, vcf_suffix='.vcf', checkpoint=False, store=None):
+    """
+    Annotates input_path in chunks using up to workers processes.
+    annotate_chunk(chunk_path) must be a picklable top-level function that
+    annotates one chunk and returns (chunk_annot_path, chunk_log_path).
+    The chunk annotations are merged into annot_path and the chunk logs
+    concatenated into log_path. Exceptions from any chunk are re-raised.
+    With checkpoint, finished chunks are kept (and copied to store, if
+    given) when the job fails, and reused when it is run again.
+    Returns the number of chunks.
+    """
+    chunk_dir = f"{input_path}.chunks"
+    os.makedirs(chunk_dir, exist_ok=True)
+    progress = Checkpoint(chunk_dir, chunk_records, store) if checkpoint else None
+    chunk_paths = []
+    outputs = {}
+    futures = {}
+    resumed = 0
+
+    def finish(future):
+        chunk_path = futures.pop(future)
+        outputs[chunk_path] = future.result()
+        if progress is not None:
+            progress.record(chunk_path, *outputs[chunk_path])
+
+    completed = False
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk_path in split_vcf(input_path, chunk_dir, chunk_records, vcf_suffix):
+                chunk_paths.append(chunk_path)
+                restored = progress.restore(chunk_path) if progress is not None else None
+                if restored:
+                    outputs[chunk_path] = restored
+                    resumed += 1
+                else:
+                    futures[executor.submit(annotate_chunk, chunk_path)] = chunk_path
+                # record chunks as they finish, while the input is still being split
+                for future in [f for f in futures if f.done()]:
+                    finish(future)
+            for future in as_completed(list(futures)):
+                finish(future)
+        if resumed:
+            print(f"resumed from checkpoint: reused {resumed} of {len(chunk_paths)} chunk(s)")
+        merge_chunks([outputs[path][0] for path in chunk_paths], annot_path)
+        merge_chunks([outputs[path][1] for path in chunk_paths], log_path, skip_headers=False)
+        completed = True
+    finally:
+        if completed or progress is None:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+    if progress is not None:
+        progress.clear()
+    return len(chunk_paths)
+
+### EOF
@@ -0,0 +1,168 @@
+# ref_lookup.py
+#
+# Batched lookups against the reference annotator database
+#
+# Rather than one query per variant, positions are collected per
+# chromosome and fetched in blocks, either with IN (...) lists or with a
+# single BETWEEN range when the block is dense, and the rows are joined
+# back to the records in memory.
+#
+# With the snapshot backend, lookups are answered from a local columnar
+# snapshot exported by ref_snapshot.py instead of the remote database.
+#
+#   lookup = BatchLookup('dbsnp', columns=('rsid',))
+#   for record_id, chrom, pos in variants:
+#       lookup.add(record_id, chrom, pos)
+#   rows_by_record = lookup.fetch()
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+
+import db_pool
+
+settings = {
+    'batch_size': int(os.environ.get('ANNOTATOR_DB_BATCH_SIZE', 1000)),
+    # a block is fetched as one range if it spans at most this many
+    # positions per requested position
+    'range_density': int(os.environ.get('ANNOTATOR_DB_RANGE_DENSITY', 4)),
+    # mysql or snapshot
+    'backend': os.environ.get('ANNOTATOR_REF_BACKEND', 'mysql'),
+    'snapshot_dir': os.environ.get('ANNOTATOR_REF_SNAPSHOT_DIR', ''),
+}
+
+IN = 'in'
+RANGE = 'range'
+AUTO = 'auto'
+
+MYSQL = 'mysql'
+SNAPSHOT = 'snapshot'
+
+snapshots = {}
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def configure(**kwargs):
+    """
+    Overrides lookup settings (batch_size, range_density, backend,
+    snapshot_dir).
+    """
+    unknown = set(kwargs) - set(settings)
+    if unknown:
+        raise ValueError(f"unknown lookup settings: {', '.join(sorted(unknown))}")
+    settings.update(kwargs)
+
+
+def check_identifier(name):
+    # table and column names are interpolated into the SQL, so only
+    # plain identifiers are accepted
+    if not IDENTIFIER.match(name):
+        raise ValueError(f"invalid SQL identifier: {name!r}")
+    return name
+
+
+def blocks(positions, size):
+    for i in range(0, len(positions), size):
+        yield positions[i:i + size]
+
+
+class BatchLookup:
+    """
+    Collects (chromosome, position) keys for many records and fetches the
+    matching reference rows with one query per block of batch_size
+    positions. mode is IN, RANGE or AUTO (a range for dense blocks, an IN
+    list otherwise). placeholder is the driver's paramstyle marker: '%s'
+    for pymysql, '?' for sqlite3.
+    """
+    def __init__(self, table, columns=('*',), chrom_col='chrom', pos_col='pos',
+            batch_size=None, mode=AUTO, pool=None, placeholder='%s'):
+        self.table = check_identifier(table)
+        self.columns = [c if c == '*' else check_identifier(c) for c in columns]
+        self.chrom_col = check_identifier(chrom_col)
+        self.pos_col = check_identifier(pos_col)
+        self.batch_size = batch_size or settings['batch_size']
+        if mode not in (IN, RANGE, AUTO):
+            raise ValueError(f"unknown lookup mode: {mode}")
+        self.mode = mode
+        self.pool = pool
+        self.placeholder = placeholder
+        self.records = {}
+        self.positions = {}
+        self.queries = 0
+
+    def add(self, record_id, chrom, pos):
+        self.records.setdefault(record_id, []).append((chrom, pos))
+        self.positions.setdefault(chrom, set()).add(pos)
+
+    def select(self):
+        # the key columns come first so rows can be joined back
+        columns = ', '.join([self.chrom_col, self.pos_col] + self.columns)
+        return f"SELECT {columns} FROM {self.table} WHERE {self.chrom_col} = {self.placeholder}"
+
+    def block_query(self, chrom, block):
+        use_range = self.mode == RANGE or (self.mode == AUTO and
+            block[-1] - block[0] + 1 <= len(block) * settings['range_density'])
+        if use_range:
+            sql = f"{self.select()} AND {self.pos_col} BETWEEN {self.placeholder} AND {self.placeholder}"
+            return sql, (chrom, block[0], block[-1])
+        markers = ', '.join([self.placeholder] * len(block))
+        sql = f"{self.select()} AND {self.pos_col} IN ({markers})"
+        return sql, (chrom,) + tuple(block)
+
+    def fetch_rows(self):
+        """
+        Runs the block queries and returns {(chrom, pos): [row, ...]} for the
+        requested positions. Rows exclude the two key columns.
+        """
+        pool = self.pool or db_pool.get_pool()
+        found = {}
+        for chrom, positions in self.positions.items():
+            wanted = sorted(positions)
+            for block in blocks(wanted, self.batch_size):
+                sql, params = self.block_query(chrom, block)
+                self.queries += 1
+                for row in pool.query(sql, params, cache=False):
+                    # a range also returns rows between the requested positions
+                    if row[1] in positions:
+                        found.setdefault((chrom, row[1]), []).append(row[2:])
+        return found
+
+    def fetch(self):
+        """
+        Fetches all collected positions and returns {record_id: [row, ...]},
+        in the order positions were added for each record. Records with no
+        reference rows map to an empty list.
+        """
+        found = self.fetch_rows()
+        return {record_id: [row for key in keys for row in found.get(key, ())]
+            for record_id, keys in self.records.items()}
+
+
+def get_snapshot(table):
+    """
+    The local snapshot of a table, opened once per process.
+    """
+    if table not in snapshots:
+        # NumPy is only needed on nodes that use snapshots
+        import ref_snapshot
+        snapshots[table] = ref_snapshot.Snapshot(settings['snapshot_dir'], table)
+    return snapshots[table]
+
+
+def lookup_positions(table, variants, **kwargs):
+    """
+    One-call form: variants is an iterable of (record_id, chrom, pos).
+    Uses the configured backend; the snapshot backend only honours the
+    columns argument.
+    """
+    if settings['backend'] == SNAPSHOT:
+        return get_snapshot(table).lookup_positions(variants, kwargs.get('columns'))
+    lookup = BatchLookup(table, **kwargs)
+    for record_id, chrom, pos in variants:
+        lookup.add(record_id, chrom, pos)
+    return lookup.fetch()
+
+### EOF
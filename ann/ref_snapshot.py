@@ -0,0 +1,289 @@
+# ref_snapshot.py
+#
+# Local columnar snapshots of reference tables
+#
+# Exports a table from the annotator database into per-chromosome NumPy
+# arrays: a sorted position array plus one array per payload column.
+# Snapshots are opened with mmap, so every worker on a node shares the
+# same page-cache copy and startup does not load anything up front.
+#
+# Layout:
+#   <snapshot_dir>/<table>/manifest.json
+#   <snapshot_dir>/<table>/<chrom>/pos.npy
+#   <snapshot_dir>/<table>/<chrom>/<column>.npy
+#   <snapshot_dir>/<table>/<chrom>/<column>.nulls.npy  (only if it has NULLs)
+#
+# Usage: python ref_snapshot.py <snapshot_dir> <table> <column> [<column> ...]
+#        [--chrom-col chrom] [--pos-col pos]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+from decimal import Decimal
+
+import numpy as np
+import pymysql
+
+import db_pool
+from ref_lookup import check_identifier
+
+MANIFEST = 'manifest.json'
+POSITIONS = 'pos.npy'
+# NULL mask of a column, next to its values
+NULLS = '.nulls.npy'
+# chunks of a chromosome being exported, removed once it is written
+SPILL_DIR = '.spill'
+FETCH_ROWS = 100000
+# bytes for a number in a column that also holds text
+NUMBER_WIDTH = 32
+
+
+def column_array(values):
+    """
+    Converts a column to an mmap-friendly array: integers keep int64,
+    floats and DECIMALs are stored as float64, anything else as fixed-width
+    UTF-8 bytes (object arrays cannot be memory-mapped). Returns the array
+    and a boolean mask of the NULLs (None if there are none); NULL slots
+    hold 0, NaN or b'' and are told apart from real values by the mask.
+    """
+    present = [v for v in values if v is not None]
+    nulls = np.array([v is None for v in values]) if len(present) < len(values) else None
+    if all(isinstance(v, int) for v in present):
+        array = np.array([0 if v is None else v for v in values], dtype=np.int64)
+    elif all(isinstance(v, (int, float, Decimal)) for v in present):
+        array = np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+    else:
+        encoded = [b'' if v is None else str(v).encode() for v in values]
+        width = max((len(v) for v in encoded), default=0) or 1
+        array = np.array(encoded, dtype=f"S{width}")
+    return array, nulls
+
+
+def merge_dtype(current, dtype):
+    """
+    The dtype that holds the chunks of a column seen so far: int64 widens
+    to float64, and either to bytes wide enough for any chunk.
+    """
+    if current is None or current == dtype:
+        return dtype
+    if current.kind == 'S' or dtype.kind == 'S':
+        # numbers written as text fit in NUMBER_WIDTH bytes
+        widths = [d.itemsize if d.kind == 'S' else NUMBER_WIDTH for d in (current, dtype)]
+        return np.dtype(f"S{max(widths)}")
+    return np.dtype(np.float64)
+
+
+def open_cursor(conn):
+    """
+    A server-side cursor for MySQL, so rows are streamed instead of the
+    whole result being buffered by the client. Other DB-API connections
+    (e.g. an sqlite3 stand-in) use their default cursor.
+    """
+    if isinstance(conn, pymysql.connections.Connection):
+        return conn.cursor(pymysql.cursors.SSCursor)
+    return conn.cursor()
+
+
+def write_column(path, chunk_paths, dtype, size):
+    """
+    Copies the spilled chunks of a column into one .npy file through a
+    memory map, one chunk at a time.
+    """
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(size,))
+    offset = 0
+    for chunk_path in chunk_paths:
+        chunk = np.load(chunk_path, mmap_mode='r')
+        out[offset:offset + len(chunk)] = chunk.astype(dtype)
+        offset += len(chunk)
+    out.flush()
+    del out
+
+
+def export_chromosome(pool, select, chrom, chrom_dir, columns):
+    """
+    Streams the rows of one chromosome into chrom_dir. Every FETCH_ROWS
+    rows are converted and spilled to disk as they arrive; once the size
+    and dtype of each column are known, the chunks are copied into the
+    final arrays. Memory use is bounded by FETCH_ROWS, not by the size of
+    the chromosome. Returns the number of rows.
+    """
+    spill_dir = os.path.join(chrom_dir, SPILL_DIR)
+    os.makedirs(spill_dir)
+    names = [POSITIONS[:-len('.npy')]] + columns
+    chunks = {name: [] for name in names}
+    masks = {name: [] for name in names}
+    dtypes = {name: None for name in names}
+    nullable = set()
+    rows = 0
+
+    with pool.connection() as conn:
+        cursor = open_cursor(conn)
+        try:
+            cursor.execute(select, (chrom,))
+            n = 0
+            while True:
+                batch = cursor.fetchmany(FETCH_ROWS)
+                if not batch:
+                    break
+                for i, name in enumerate(names):
+                    if i == 0:
+                        array, nulls = np.array([row[0] for row in batch], dtype=np.int64), None
+                    else:
+                        array, nulls = column_array([row[i] for row in batch])
+                    chunks[name].append(os.path.join(spill_dir, f"{name}.{n}.npy"))
+                    np.save(chunks[name][-1], array)
+                    dtypes[name] = merge_dtype(dtypes[name], array.dtype)
+                    if nulls is not None:
+                        nullable.add(name)
+                    else:
+                        nulls = np.zeros(len(batch), dtype=bool)
+                    masks[name].append(os.path.join(spill_dir, f"{name}.{n}{NULLS}"))
+                    np.save(masks[name][-1], nulls)
+                rows += len(batch)
+                n += 1
+        finally:
+            cursor.close()
+
+    for name in names:
+        write_column(os.path.join(chrom_dir, f"{name}.npy"), chunks[name],
+            dtypes[name] or np.dtype(np.int64), rows)
+        # only columns with NULLs get a mask
+        if name in nullable:
+            write_column(os.path.join(chrom_dir, f"{name}{NULLS}"), masks[name],
+                np.dtype(bool), rows)
+    shutil.rmtree(spill_dir)
+    return rows
+
+
+def export_snapshot(snapshot_dir, table, columns, chrom_col='chrom', pos_col='pos',
+        pool=None, placeholder='%s'):
+    """
+    Writes a snapshot of table to snapshot_dir/table. The snapshot is built
+    in a temporary directory and swapped in at the end, so readers never
+    see a partial export. Returns the manifest.
+    """
+    table = check_identifier(table)
+    columns = [check_identifier(c) for c in columns]
+    chrom_col = check_identifier(chrom_col)
+    pos_col = check_identifier(pos_col)
+    pool = pool or db_pool.get_pool()
+
+    final_dir = os.path.join(snapshot_dir, table)
+    build_dir = f"{final_dir}.building"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+
+    manifest = {'table': table, 'columns': columns, 'exported': int(time.time()),
+        'chromosomes': {}}
+    chroms = [row[0] for row in pool.query(
+        f"SELECT DISTINCT {chrom_col} FROM {table}", cache=False)]
+    select = (f"SELECT {', '.join([pos_col] + columns)} FROM {table} "
+        f"WHERE {chrom_col} = {placeholder} ORDER BY {pos_col}")
+
+    for chrom in chroms:
+        chrom_dir = os.path.join(build_dir, str(chrom))
+        os.makedirs(chrom_dir)
+        rows = export_chromosome(pool, select, chrom, chrom_dir, columns)
+        manifest['chromosomes'][str(chrom)] = rows
+        print(f"{table} {chrom}: {rows} rows")
+
+    with open(os.path.join(build_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    old_dir = f"{final_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(final_dir):
+        os.rename(final_dir, old_dir)
+    os.rename(build_dir, final_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+
+def python_value(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    return value.item() if hasattr(value, 'item') else value
+
+
+class Snapshot:
+    """
+    Read-only view of an exported table. Chromosome arrays are memory-
+    mapped on first use, so opening a snapshot is immediate.
+    """
+    def __init__(self, snapshot_dir, table):
+        self.path = os.path.join(snapshot_dir, table)
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.columns = self.manifest['columns']
+        self.arrays = {}
+        self.lock = threading.Lock()
+
+    def chromosome(self, chrom):
+        chrom = str(chrom)
+        with self.lock:
+            if chrom not in self.arrays:
+                if chrom not in self.manifest['chromosomes']:
+                    self.arrays[chrom] = None
+                else:
+                    chrom_dir = os.path.join(self.path, chrom)
+                    load = lambda name: np.load(os.path.join(chrom_dir, name), mmap_mode='r')
+                    # columns without a mask have no NULLs on this chromosome
+                    mask = lambda column: load(f"{column}{NULLS}") \
+                        if os.path.exists(os.path.join(chrom_dir, f"{column}{NULLS}")) else None
+                    self.arrays[chrom] = (load(POSITIONS),
+                        [(load(f"{column}.npy"), mask(column)) for column in self.columns])
+            return self.arrays[chrom]
+
+    def column_indices(self, columns=None):
+        if not columns or list(columns) == ['*']:
+            return list(range(len(self.columns)))
+        missing = set(columns) - set(self.columns)
+        if missing:
+            raise KeyError(f"columns not in snapshot: {', '.join(sorted(missing))}")
+        return [self.columns.index(column) for column in columns]
+
+    def lookup(self, chrom, pos, columns=None):
+        """
+        Rows (tuples of the payload columns, or of the given columns) at
+        one position.
+        """
+        arrays = self.chromosome(chrom)
+        if arrays is None:
+            return []
+        positions, payload = arrays
+        selected = [payload[i] for i in self.column_indices(columns)]
+        lo = np.searchsorted(positions, pos, side='left')
+        hi = np.searchsorted(positions, pos, side='right')
+        return [tuple(None if nulls is not None and nulls[i] else python_value(column[i])
+            for column, nulls in selected) for i in range(lo, hi)]
+
+    def lookup_positions(self, variants, columns=None):
+        """
+        Same contract as ref_lookup.lookup_positions: variants is an
+        iterable of (record_id, chrom, pos); returns {record_id: [row, ...]}.
+        """
+        found = {}
+        for record_id, chrom, pos in variants:
+            found.setdefault(record_id, []).extend(self.lookup(chrom, pos, columns))
+        return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a reference table to a local snapshot')
+    parser.add_argument('snapshot_dir')
+    parser.add_argument('table')
+    parser.add_argument('columns', nargs='+')
+    parser.add_argument('--chrom-col', default='chrom')
+    parser.add_argument('--pos-col', default='pos')
+    args = parser.parse_args()
+    manifest = export_snapshot(args.snapshot_dir, args.table, args.columns,
+        args.chrom_col, args.pos_col)
+    print(f"exported {sum(manifest['chromosomes'].values())} rows of {args.table}")
+
+### EOF
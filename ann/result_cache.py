@@ -0,0 +1,214 @@
+# result_cache.py
+#
+# Content-addressed cache of annotation results
+#
+# Users often resubmit the same VCF. Results are cached in the results
+# bucket under a key derived from the SHA-256 of the input plus the
+# annotator and reference versions, so a resubmitted input is answered by
+# server-side copies of the cached .annot/.log files instead of a rerun.
+#
+# Layout: <prefix>/<cache key>/annot, .../log and, for BGZF output, .../tbi
+#
+# Hits and misses are published as CloudWatch metrics (Hits, Misses) so
+# the hit rate can be graphed with metric math. Entries are evicted by
+# age and total size with:
+#   python result_cache.py <bucket> <prefix> [--max-age-days N] [--max-gb N]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import Counter
+
+from botocore.exceptions import ClientError
+
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'common'))
+import aws_clients
+import transfer
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+ANNOT = 'annot'
+LOG = 'log'
+INDEX = 'tbi'
+
+counts = Counter()
+
+
+def file_digest(path):
+    """
+    SHA-256 of a file, read in 1 MB blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hashing(chunks, digest):
+    """
+    Passes a stream of byte chunks through, feeding each into digest, so
+    a streamed input is hashed on its way to the annotator.
+    """
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+class ResultCache:
+    """
+    Cache entries for one annotator configuration. versions identifies
+    everything besides the input that changes the results (annotator and
+    reference versions, output format); changing any of it starts a new
+    set of entries.
+    """
+    def __init__(self, s3, bucket, prefix, versions, metrics_namespace=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+        self.versions = versions
+        self.metrics_namespace = metrics_namespace
+
+    def key_for(self, input_digest):
+        material = dict(self.versions, input=input_digest)
+        return hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+    def object_key(self, cache_key, part):
+        return f"{self.prefix}/{cache_key}/{part}"
+
+    def copy(self, src_key, dst_key):
+        """
+        Server-side copy. Managed (multipart) copies do not carry the
+        source's Content-Encoding over, so it is passed explicitly.
+        """
+        head = self.s3.head_object(Bucket=self.bucket, Key=src_key)
+        extra_args = {}
+        if head.get('ContentEncoding'):
+            extra_args['ContentEncoding'] = head['ContentEncoding']
+        self.s3.copy({'Bucket': self.bucket, 'Key': src_key}, self.bucket, dst_key,
+            ExtraArgs=extra_args, Config=transfer.transfer_config())
+
+    def restore(self, input_digest, annot_key, log_key, index_key=None):
+        """
+        Copies cached results for the input to the job's result keys.
+        Returns True on a hit, False on a miss (including an incomplete
+        entry or a failed copy).
+        """
+        cache_key = self.key_for(input_digest)
+        parts = [(ANNOT, annot_key), (LOG, log_key)]
+        if index_key:
+            parts.append((INDEX, index_key))
+        try:
+            for part, dst_key in parts:
+                try:
+                    self.copy(self.object_key(cache_key, part), dst_key)
+                except ClientError as e:
+                    # an entry stored without an index is still a hit
+                    if part != INDEX or e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                        raise
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                print(f"result cache lookup failed: {e.response['Error']['Code']}")
+            self.record(hit=False)
+            return False
+        self.record(hit=True)
+        return True
+
+    def store(self, input_digest, annot_key, log_key, index_key=None):
+        """
+        Adds a job's uploaded results to the cache. The annot part is
+        copied last, since restore() reads it first and an entry must not
+        look complete before it is.
+        """
+        cache_key = self.key_for(input_digest)
+        parts = [(LOG, log_key), (ANNOT, annot_key)]
+        if index_key:
+            parts.insert(0, (INDEX, index_key))
+        try:
+            for part, src_key in parts:
+                self.copy(src_key, self.object_key(cache_key, part))
+            return True
+        except ClientError as e:
+            print(f"could not store results in cache: {e.response['Error']['Code']}")
+            return False
+
+    def record(self, hit):
+        metric = 'Hits' if hit else 'Misses'
+        counts[metric] += 1
+        lookups = counts['Hits'] + counts['Misses']
+        print(f"result cache {'hit' if hit else 'miss'}; hit rate {counts['Hits'] / lookups:.0%} "
+            f"over {lookups} lookup(s) in this process")
+        if not self.metrics_namespace:
+            return
+        try:
+            aws_clients.get_client('cloudwatch').put_metric_data(
+                Namespace=self.metrics_namespace,
+                MetricData=[{'MetricName': metric, 'Value': 1, 'Unit': 'Count'}])
+        except ClientError as e:
+            print(f"could not publish cache metric: {e.response['Error']['Code']}")
+
+
+def list_entries(s3, bucket, prefix):
+    """
+    Cache entries as {cache key: {'bytes': total size, 'modified': newest
+    LastModified as a timestamp}}.
+    """
+    entries = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix.rstrip('/') + '/'):
+        for obj in page.get('Contents', []):
+            cache_key = obj['Key'][len(prefix.rstrip('/')) + 1:].split('/', 1)[0]
+            entry = entries.setdefault(cache_key, {'bytes': 0, 'modified': 0, 'keys': []})
+            entry['bytes'] += obj['Size']
+            entry['modified'] = max(entry['modified'], obj['LastModified'].timestamp())
+            entry['keys'].append(obj['Key'])
+    return entries
+
+
+def evict(s3, bucket, prefix, max_age_days=None, max_bytes=None):
+    """
+    Deletes entries older than max_age_days, then the oldest remaining
+    entries until the cache holds at most max_bytes.
+    Returns (entries evicted, bytes freed).
+    """
+    entries = list_entries(s3, bucket, prefix)
+    by_age = sorted(entries.items(), key=lambda item: item[1]['modified'])
+    total = sum(entry['bytes'] for entry in entries.values())
+    cutoff = time.time() - max_age_days * 86400 if max_age_days else None
+
+    doomed = []
+    for cache_key, entry in by_age:
+        too_old = cutoff is not None and entry['modified'] < cutoff
+        too_big = max_bytes is not None and total > max_bytes
+        if not (too_old or too_big):
+            continue
+        doomed.append(entry)
+        total -= entry['bytes']
+
+    keys = [{'Key': key} for entry in doomed for key in entry['keys']]
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': keys[i:i + 1000]})
+    return len(doomed), sum(entry['bytes'] for entry in doomed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evict old annotation results from the cache')
+    parser.add_argument('bucket')
+    parser.add_argument('prefix')
+    parser.add_argument('--max-age-days', type=float)
+    parser.add_argument('--max-gb', type=float)
+    args = parser.parse_args()
+    s3 = aws_clients.get_client('s3', signature_version='s3v4')
+    max_bytes = int(args.max_gb * GB) if args.max_gb is not None else None
+    evicted, freed = evict(s3, args.bucket, args.prefix, args.max_age_days, max_bytes)
+    print(f"evicted {evicted} cache entr{'y' if evicted == 1 else 'ies'}, freed {freed / MB:.1f} MB")
+
+### EOF
@@ -0,0 +1,252 @@
+# transfer.py
+#
+# S3 transfers for annotation inputs and results
+#
+# Wraps boto3's managed transfers with tuned multipart settings, parallel
+# uploads of several files, optional gzip compression on the fly and
+# per-transfer throughput figures. Inputs can also be streamed with
+# ranged GETs instead of being downloaded before annotation starts.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+
+settings = {
+    'multipart_threshold_mb': 64,
+    'multipart_chunksize_mb': 64,
+    'max_concurrency': 10,
+    'gzip_level': 6,
+    'stream_range_mb': 8,
+}
+
+
+def configure(**kwargs):
+    """
+    Overrides transfer settings (multipart_threshold_mb,
+    multipart_chunksize_mb, max_concurrency, gzip_level, stream_range_mb).
+    """
+    unknown = set(kwargs) - set(settings)
+    if unknown:
+        raise ValueError(f"unknown transfer settings: {', '.join(sorted(unknown))}")
+    settings.update(kwargs)
+
+
+def transfer_config():
+    return TransferConfig(
+        multipart_threshold=settings['multipart_threshold_mb'] * MB,
+        multipart_chunksize=settings['multipart_chunksize_mb'] * MB,
+        max_concurrency=settings['max_concurrency'],
+        use_threads=True)
+
+
+class TransferProgress:
+    """
+    boto3 transfer callback that counts bytes moved and reports throughput.
+    Callbacks arrive from several transfer threads at once.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.start = time.time()
+        self.end = None
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self.lock:
+            self.bytes += bytes_amount
+
+    def finish(self):
+        self.end = time.time()
+        return self
+
+    @property
+    def secs(self):
+        return (self.end or time.time()) - self.start
+
+    @property
+    def mb_per_sec(self):
+        return (self.bytes / MB) / self.secs if self.secs > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.name}: {self.bytes / MB:.1f} MB in {self.secs:.2f} s ({self.mb_per_sec:.1f} MB/s)"
+
+
+class GzipReader:
+    """
+    Read-only file object that gzip-compresses another file as it is read,
+    so a file can be uploaded compressed without writing a .gz copy first.
+    """
+    def __init__(self, fileobj, level=6, chunk_size=MB):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        # wbits=31 writes a gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self.buffer = bytearray()
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size is None or size < 0 or len(self.buffer) < size):
+            chunk = self.fileobj.read(self.chunk_size)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readable(self):
+        return True
+
+
+def download_file(s3, bucket, key, path):
+    """
+    Downloads an object to path using ranged, parallel GETs for large
+    objects. ClientErrors are left to the caller. Returns the progress.
+    """
+    progress = TransferProgress(f"s3://{bucket}/{key}")
+    s3.download_file(bucket, key, path, Config=transfer_config(), Callback=progress)
+    return progress.finish()
+
+
+def upload_file(s3, path, bucket, key, compress=False):
+    """
+    Uploads path to S3 with multipart uploads for large files. With
+    compress, the file is gzipped on the fly and stored with
+    Content-Encoding: gzip under the same key, so presigned downloads
+    still arrive uncompressed in browsers. FileNotFoundError and
+    ClientError are left to the caller. Returns the progress.
+    """
+    progress = TransferProgress(path)
+    if compress:
+        with open(path, 'rb') as f:
+            s3.upload_fileobj(GzipReader(f, settings['gzip_level']), bucket, key,
+                ExtraArgs={'ContentEncoding': 'gzip'},
+                Config=transfer_config(), Callback=progress)
+    else:
+        s3.upload_file(path, bucket, key, Config=transfer_config(), Callback=progress)
+    return progress.finish()
+
+
+def run_parallel(*tasks):
+    """
+    Runs the given zero-argument callables concurrently and returns their
+    results in order. Exceptions are re-raised when collecting results.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(tasks))) as executor:
+        futures = [executor.submit(task) for task in tasks]
+    return [future.result() for future in futures]
+
+def parse_s3_uri(uri):
+    """
+    Splits s3://bucket/key into (bucket, key).
+    """
+    if not uri.startswith('s3://') or '/' not in uri[len('s3://'):]:
+        raise ValueError(f"not an S3 object URI: {uri}")
+    bucket, key = uri[len('s3://'):].split('/', 1)
+    return bucket, key
+
+
+def iter_object_ranges(s3, bucket, key, range_mb=None):
+    """
+    Yields an S3 object as consecutive byte ranges, one ranged GET each.
+    The next range is fetched while the caller consumes the current one,
+    so reading overlaps with the network transfer.
+    """
+    range_size = (range_mb or settings['stream_range_mb']) * MB
+    size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+    def fetch(start):
+        end = min(start + range_size, size) - 1
+        response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+        return response['Body'].read()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(fetch, 0) if size else None
+        for start in range(0, size, range_size):
+            chunk = pending.result()
+            next_start = start + range_size
+            pending = executor.submit(fetch, next_start) if next_start < size else None
+            yield chunk
+
+
+def iter_lines(chunks):
+    """
+    Re-splits a stream of byte chunks into lines (with their line endings).
+    """
+    remainder = b''
+    for chunk in chunks:
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if remainder:
+        yield remainder
+
+
+class FifoFeeder:
+    """
+    Feeds a stream of byte chunks into a named pipe created at path, so a
+    program that only accepts a file name (such as the AnnTools driver)
+    reads an S3 object while it is still being downloaded and nothing is
+    written to local disk. The reader must open the path exactly once;
+    use a regular download for tools that read their input twice.
+    """
+    def __init__(self, path, chunks):
+        self.path = path
+        self.chunks = chunks
+        self.bytes = 0
+        self.error = None
+        self.cancelled = False
+        # a retried job may find the pipe or a partial download left behind
+        if os.path.lexists(path):
+            os.remove(path)
+        os.mkfifo(path)
+        self.thread = threading.Thread(target=self.feed, daemon=True)
+        self.thread.start()
+
+    def feed(self):
+        try:
+            # blocks until the reader opens the pipe
+            with open(self.path, 'wb') as fifo:
+                for chunk in self.chunks:
+                    if self.cancelled:
+                        raise RuntimeError('input stream cancelled before the reader finished')
+                    fifo.write(chunk)
+                    self.bytes += len(chunk)
+        except Exception as e:
+            # BrokenPipeError if the reader stopped early, ClientError on S3
+            self.error = e
+
+    def close(self, timeout=30):
+        """
+        Waits for the feeder to finish and removes the pipe. A feeder still
+        waiting for a reader (e.g. the reader failed before opening the
+        input) is released by briefly opening the pipe ourselves.
+        """
+        if self.thread.is_alive():
+            self.thread.join(timeout=1)
+        if self.thread.is_alive():
+            self.cancelled = True
+            try:
+                os.close(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self.thread.join(timeout=timeout)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+### EOF
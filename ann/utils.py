@@ -11,42 +11,31 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 
-import os
-import json
-import pymysql
-import boto3
+from bisect import bisect_right
 from botocore.exceptions import ClientError
 
+import db_pool
+
+# NumPy is only needed for the vectorized (*Array) helpers
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 """Get connection to reference database
+The connection comes from db_pool's process-wide pool and close() checks
+it back in, so callers no longer open a new connection each time. The RDS
+secret is cached by db_pool and refreshed after a TTL. Callers that run
+many queries can use db_pool.get_pool().query(), which also caches lookups.
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
+        # Return a pooled connection to the database
+        return db_pool.get_pool().checkout()
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
-
 
 """Column indices for pileup and VCF
 """
@@ -98,17 +87,152 @@ def isBetween(testStart, refStart, refEnd):
         return False
 
 
-"""Helper method to deduplicate the list
+"""Vectorized versions of getOverlap, proportionOverlap and isBetween
+Take NumPy arrays (or anything np.asarray accepts) of starts and ends and
+compute every variant/region pair in one call. Arguments broadcast, so
+equal-length arrays give element-wise pairs, and testStarts[:, None]
+against refStarts[None, :] gives the full variant x region matrix.
+"""
+def _requireNumpy():
+    if np is None:
+        raise ImportError("NumPy is required for the vectorized overlap helpers")
+
+
+def getOverlapArray(testStarts, testEnds, refStarts, refEnds):
+    _requireNumpy()
+    overlap = np.minimum(testEnds, refEnds) - np.maximum(testStarts, refStarts) + 1
+    return np.maximum(overlap, 0)
+
+
+def proportionOverlapArray(testStarts, testEnds, refStarts, refEnds):
+    _requireNumpy()
+    cnvlength = np.subtract(testEnds, testStarts) + 1
+    overlaplength = getOverlapArray(testStarts, testEnds, refStarts, refEnds)
+    return np.round(overlaplength / cnvlength * 100, 2)
+
+
+def isBetweenArray(testStarts, refStarts, refEnds):
+    _requireNumpy()
+    testStarts = np.asarray(testStarts)
+    return (np.asarray(refStarts) <= testStarts) & (testStarts <= np.asarray(refEnds))
+
+
+"""Interval index over reference regions, such as segdup tables
+Built once per reference table. Regions are grouped by chromosome and
+sorted by start, with a running maximum of region ends, so a query
+binary-searches to the last region starting before the query ends and
+scans back only while earlier regions can still reach the query start.
+Regions are (chrom, start, end, payload) tuples with inclusive
+coordinates, matching isOverlap and getOverlap.
 """
-def dedup(mylist):
-    outlist = []
-    for element in mylist:
-        if element not in outlist:
-            outlist.append(element)
-    return outlist
+class IntervalIndex(object):
+    def __init__(self, regions=()):
+        grouped = {}
+        for chrom, refStart, refEnd, payload in regions:
+            grouped.setdefault(chrom, []).append((refStart, refEnd, payload))
+
+        self.starts = {}
+        self.ends = {}
+        self.maxEnds = {}
+        self.payloads = {}
+        for chrom, rows in grouped.items():
+            rows.sort(key=lambda row: (row[0], row[1]))
+            self.starts[chrom] = [row[0] for row in rows]
+            self.ends[chrom] = [row[1] for row in rows]
+            self.payloads[chrom] = [row[2] for row in rows]
+            maxEnds = []
+            maxEnd = None
+            for refEnd in self.ends[chrom]:
+                maxEnd = refEnd if maxEnd is None else max(maxEnd, refEnd)
+                maxEnds.append(maxEnd)
+            self.maxEnds[chrom] = maxEnds
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+    def chromosomes(self):
+        return list(self.starts)
+
+    """Indices of regions overlapping [testStart, testEnd], in start order
+    """
+    def _overlapping(self, chrom, testStart, testEnd):
+        starts = self.starts.get(chrom)
+        if not starts:
+            return []
+        ends = self.ends[chrom]
+        maxEnds = self.maxEnds[chrom]
+        hits = []
+        i = bisect_right(starts, testEnd) - 1
+        while i >= 0 and maxEnds[i] >= testStart:
+            if ends[i] >= testStart:
+                hits.append(i)
+            i -= 1
+        hits.reverse()
+        return hits
+
+    """All regions overlapping the test segment as (refStart, refEnd, payload)
+    """
+    def query(self, chrom, testStart, testEnd):
+        return [(self.starts[chrom][i], self.ends[chrom][i], self.payloads[chrom][i])
+            for i in self._overlapping(chrom, testStart, testEnd)]
+
+    """Regions containing a single position (the indexed form of isBetween)
+    """
+    def queryPosition(self, chrom, testStart):
+        return self.query(chrom, testStart, testStart)
+
+    """Bulk query: overlapping regions for each (testStart, testEnd) segment
+    """
+    def queryMany(self, chrom, segments):
+        return [self.query(chrom, testStart, testEnd) for testStart, testEnd in segments]
+
+    """Bulk query: regions containing each position
+    """
+    def queryPositions(self, chrom, positions):
+        return [self.query(chrom, testStart, testStart) for testStart in positions]
+
+    """Bulk query: overlapping regions and the percentage of each segment
+    they cover, as lists of (refStart, refEnd, payload, proportionOverlap)
+    """
+    def proportionsMany(self, chrom, segments):
+        results = []
+        for testStart, testEnd in segments:
+            results.append([(refStart, refEnd, payload,
+                proportionOverlap(testStart, testEnd, refStart, refEnd))
+                for refStart, refEnd, payload in self.query(chrom, testStart, testEnd)])
+        return results
+
+
+"""Helper method to deduplicate the list, keeping the first occurrence
+of each element in order. Runs in linear time using a set of seen keys;
+key (e.g. a field getter) picks what identifies an element, and elements
+whose key is unhashable, such as lists or dicts, fall back to a list scan.
+"""
+def dedup(mylist, key=None):
+    return list(iterDedup(mylist, key))
+
+
+"""Generator form of dedup, for deduplicating records as they are emitted
+"""
+def iterDedup(iterable, key=None):
+    seen = set()
+    seenUnhashable = []
+    for element in iterable:
+        k = element if key is None else key(element)
+        try:
+            if k in seen:
+                continue
+            seen.add(k)
+        except TypeError:
+            if k in seenUnhashable:
+                continue
+            seenUnhashable.append(k)
+        yield element
 
 
 """Helper method to parse fields
+Matches keys by substring (AF also matches AF_EAS) and re-splits text on
+every call; use InfoField to look up several keys of the same record.
 """
 def parse_field(text, key, sep1, sep2):
     fields = text.strip().split(sep1)
@@ -118,4 +242,72 @@ def parse_field(text, key, sep1, sep2):
             return str(pairs[1])
     return '.'
 
+
+"""Parsed INFO field of a VCF record
+The INFO string is split once, on first lookup, into a dict of exact keys,
+so each further lookup is a dict access and AF never matches AF_EAS.
+Flags (keys without a value) map to True. Missing keys give '.', as in
+parse_field; when a key repeats, the first value wins.
+"""
+class InfoField(object):
+    __slots__ = ('text', 'sep1', 'sep2', 'fields')
+
+    def __init__(self, text, sep1=';', sep2='='):
+        self.text = text
+        self.sep1 = sep1
+        self.sep2 = sep2
+        self.fields = None
+
+    def parsed(self):
+        if self.fields is None:
+            self.fields = parseInfo(self.text, self.sep1, self.sep2)
+        return self.fields
+
+    def get(self, key, default='.'):
+        return self.parsed().get(key, default)
+
+    def getMany(self, keys, default='.'):
+        fields = self.parsed()
+        return [fields.get(key, default) for key in keys]
+
+    def __getitem__(self, key):
+        return self.parsed()[key]
+
+    def __contains__(self, key):
+        return key in self.parsed()
+
+    def __iter__(self):
+        return iter(self.parsed())
+
+    def __len__(self):
+        return len(self.parsed())
+
+    def __repr__(self):
+        return f"InfoField({self.text!r})"
+
+
+"""Splits an INFO string into a dict of exact keys
+"""
+def parseInfo(text, sep1=';', sep2='='):
+    fields = {}
+    for f in text.strip().split(sep1):
+        if not f or f == '.':
+            continue
+        key, found, value = f.partition(sep2)
+        if key not in fields:
+            fields[key] = value if found else True
+    return fields
+
+
+"""Batch mode: extracts a fixed set of keys from many INFO strings
+Returns a dict of key -> list of values, one per record in input order.
+"""
+def extractInfoFields(texts, keys, sep1=';', sep2='=', default='.'):
+    columns = {key: [] for key in keys}
+    for text in texts:
+        fields = parseInfo(text, sep1, sep2)
+        for key, column in columns.items():
+            column.append(fields.get(key, default))
+    return columns
+
 ### EOF
\ No newline at end of file
@@ -0,0 +1,293 @@
+# vcf.py
+#
+# Streaming VCF reader and buffered writer
+#
+# Records are read one line at a time and kept as the raw line. Columns
+# are only split when a field is first accessed: the eight fixed columns
+# in one split, INFO into an InfoField on demand, and a single sample
+# only when its genotype is asked for. Memory stays flat however large
+# the input, and records that are only filtered or passed through are
+# never split at all.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from utils import InfoField, getFormatSpecificIndices
+
+CHR_IND, POS_IND, REF_IND, ALT_IND = getFormatSpecificIndices('vcf')
+ID_IND = 2
+QUAL_IND = 5
+FILTER_IND = 6
+INFO_IND = 7
+# FORMAT and the sample columns are left unsplit after the fixed columns
+REST_IND = 8
+
+WRITE_BUFFER = 1024 * 1024
+
+
+class VcfRecord:
+    """
+    One VCF data line. Only the line is stored until a field is accessed.
+    FORMAT and the sample columns are never split as a whole: they stay in
+    the line, and a single sample is located and decoded on request, so
+    cohort files with thousands of samples cost nothing per record unless
+    genotypes are used.
+    """
+    __slots__ = ('line', 'fields', 'parsed_info', 'rest_start', 'format_keys',
+        'sample_offsets')
+
+    def __init__(self, line):
+        self.line = line.rstrip('\r\n')
+        self.fields = None
+        self.parsed_info = None
+        self.rest_start = None
+        self.format_keys = None
+        self.sample_offsets = None
+
+    def columns(self):
+        """
+        The eight fixed columns. The rest of the line is not copied; its
+        offset is kept in rest_start.
+        """
+        if self.fields is None:
+            end = -1
+            for _ in range(REST_IND):
+                end = self.line.find('\t', end + 1)
+                if end < 0:
+                    break
+            if end < 0:
+                self.fields = self.line.split('\t')
+                self.rest_start = len(self.line)
+            else:
+                self.fields = self.line[:end].split('\t')
+                self.rest_start = end + 1
+        return self.fields
+
+    @property
+    def chrom(self):
+        return self.columns()[CHR_IND]
+
+    @property
+    def pos(self):
+        return int(self.columns()[POS_IND])
+
+    @property
+    def id(self):
+        return self.columns()[ID_IND]
+
+    @property
+    def ref(self):
+        return self.columns()[REF_IND]
+
+    @property
+    def alt(self):
+        return self.columns()[ALT_IND]
+
+    @property
+    def alts(self):
+        return self.alt.split(',')
+
+    @property
+    def qual(self):
+        return self.columns()[QUAL_IND]
+
+    @property
+    def filter(self):
+        return self.columns()[FILTER_IND]
+
+    @property
+    def info(self):
+        if self.parsed_info is None:
+            self.parsed_info = InfoField(self.columns()[INFO_IND])
+        return self.parsed_info
+
+    def rest(self):
+        """
+        FORMAT and the sample columns, unsplit.
+        """
+        self.columns()
+        return self.line[self.rest_start:]
+
+    def samples_start(self):
+        # offset of the first sample column, or len(line) if there are none
+        self.columns()
+        end = self.line.find('\t', self.rest_start)
+        return len(self.line) if end < 0 else end + 1
+
+    @property
+    def format(self):
+        if self.format_keys is None:
+            self.columns()
+            end = self.line.find('\t', self.rest_start)
+            text = self.line[self.rest_start:] if end < 0 else self.line[self.rest_start:end]
+            self.format_keys = text.split(':') if text else []
+        return self.format_keys
+
+    @property
+    def n_samples(self):
+        start = self.samples_start()
+        if start >= len(self.line):
+            return 0
+        return self.line.count('\t', start) + 1
+
+    def sample(self, i):
+        """
+        The raw column of the i-th sample, e.g. '0/1:10'. Sample starts are
+        found with str.find and remembered, up to the highest sample asked
+        for, so no other sample is copied or split.
+        """
+        if i < 0:
+            raise IndexError('sample index must not be negative')
+        if self.sample_offsets is None:
+            start = self.samples_start()
+            self.sample_offsets = [start] if start < len(self.line) else []
+        offsets = self.sample_offsets
+        while len(offsets) <= i:
+            if not offsets:
+                raise IndexError(f"sample {i} out of range")
+            tab = self.line.find('\t', offsets[-1])
+            if tab < 0:
+                raise IndexError(f"sample {i} out of range")
+            offsets.append(tab + 1)
+        end = self.line.find('\t', offsets[i])
+        return self.line[offsets[i]:] if end < 0 else self.line[offsets[i]:end]
+
+    def genotype(self, i):
+        """
+        The i-th sample decoded into a dict of FORMAT key -> value.
+        """
+        return dict(zip(self.format, self.sample(i).split(':')))
+
+    def gt(self, i):
+        """
+        Just the GT value of the i-th sample ('.' if there is no GT).
+        """
+        if not self.format or self.format[0] != 'GT':
+            return self.genotype(i).get('GT', '.')
+        return self.sample(i).split(':', 1)[0]
+
+    @property
+    def samples(self):
+        """
+        All sample columns. Splits the whole buffer; prefer sample(i).
+        """
+        start = self.samples_start()
+        return self.line[start:].split('\t') if start < len(self.line) else []
+
+    def with_info(self, extra):
+        """
+        A new record with extra (e.g. 'GENE=BRCA2;IMPACT=HIGH') appended to
+        INFO, for writing annotated output. The sample columns are copied
+        through unparsed.
+        """
+        columns = list(self.columns())
+        info = columns[INFO_IND]
+        columns[INFO_IND] = extra if info in ('', '.') else f"{info};{extra}"
+        line = '\t'.join(columns)
+        if self.rest_start < len(self.line):
+            line = f"{line}\t{self.line[self.rest_start:]}"
+        return VcfRecord(line)
+
+    def __str__(self):
+        return self.line
+
+    def __repr__(self):
+        return f"VcfRecord({self.line[:60]!r})"
+
+
+class VcfReader:
+    """
+    Iterates the records of a VCF file or open text stream. The header is
+    read on open: meta holds the '##' lines and sample_names the names from
+    the '#CHROM' line.
+    """
+    def __init__(self, source):
+        if hasattr(source, 'readline'):
+            self.file = source
+            self.owns_file = False
+        else:
+            self.file = open(source, 'r')
+            self.owns_file = True
+        self.meta = []
+        self.column_header = None
+        self.first_line = None
+        self.read_header()
+
+    def read_header(self):
+        for line in self.file:
+            if line.startswith('##'):
+                self.meta.append(line.rstrip('\r\n'))
+            elif line.startswith('#'):
+                self.column_header = line.rstrip('\r\n')
+            else:
+                self.first_line = line
+                break
+
+    @property
+    def header(self):
+        lines = list(self.meta)
+        if self.column_header is not None:
+            lines.append(self.column_header)
+        return lines
+
+    @property
+    def sample_names(self):
+        if self.column_header is None:
+            return []
+        return self.column_header.split('\t')[REST_IND + 1:]
+
+    def sample_index(self, name):
+        """
+        Column index of a sample, for VcfRecord.sample() and genotype().
+        """
+        return self.sample_names.index(name)
+
+    def __iter__(self):
+        if self.first_line is not None:
+            line, self.first_line = self.first_line, None
+            if line.strip():
+                yield VcfRecord(line)
+        for line in self.file:
+            if line.strip():
+                yield VcfRecord(line)
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class VcfWriter:
+    """
+    Buffered VCF writer for .annot output. Records (or plain lines) are
+    written through a large buffer so the disk sees few, large writes.
+    """
+    def __init__(self, path, header=(), buffer_size=WRITE_BUFFER):
+        self.file = open(path, 'w', buffering=buffer_size)
+        self.records = 0
+        for line in header:
+            self.file.write(f"{line}\n")
+
+    def write(self, record):
+        self.file.write(f"{record}\n")
+        self.records += 1
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+### EOF
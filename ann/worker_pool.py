@@ -0,0 +1,225 @@
+# worker_pool.py
+#
+# Bounded pool of annotation jobs for the annotator services
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import glob
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from subprocess import Popen
+
+SUBPROCESS = 'subprocess'
+INPROCESS = 'inprocess'
+
+
+def default_max_workers(job_memory_mb=0):
+    """
+    Sizes the pool to the instance: one job per core, further capped by
+    physical memory when a per-job memory estimate is given.
+    """
+    workers = os.cpu_count() or 1
+    if job_memory_mb > 0:
+        try:
+            total_mb = (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')) // (1024 * 1024)
+            workers = min(workers, max(1, total_mb // job_memory_mb))
+        except (ValueError, OSError, AttributeError):
+            # sysconf names are not available on every platform
+            pass
+    return workers
+
+
+def remove_job_dir(job_dir, keep_checkpoint=False):
+    """
+    Deletes the local directory of a job that will not run here again,
+    and the user's directory if no other job is left in it. With
+    keep_checkpoint, a directory holding checkpointed chunks (see
+    checkpoint.py) is kept so a retry on this instance can resume.
+    """
+    if keep_checkpoint and glob.glob(os.path.join(job_dir, '*.chunks', 'manifest.json')):
+        return False
+    shutil.rmtree(job_dir, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(job_dir))
+    except OSError:
+        # other jobs of the user are still there
+        pass
+    return True
+
+
+class DuplicateJobError(ValueError):
+    """
+    Raised by submit() for a job that is already running in the pool,
+    e.g. when SQS delivers the same request twice.
+    """
+
+
+class WorkerPool:
+    """
+    Runs at most max_workers annotation jobs at a time.
+    Callers reserve() slots before pulling messages off the queue, so
+    nothing is received that cannot be started straight away; several
+    threads can receive at once without overbooking the pool. Every
+    reserved slot is either used by submit(..., reserved=True) or handed
+    back with cancel().
+    Finished jobs are collected by reap(), which must be called
+    regularly so their slots (and child processes) are released.
+
+    In 'subprocess' mode every job is a fresh `python run.py` process.
+    In 'inprocess' mode jobs run in persistent worker processes forked
+    from a server that has already imported the engine, so boto3, the
+    configuration and the AnnTools driver are loaded once per worker
+    rather than once per job.
+    """
+    def __init__(self, max_workers=0, job_memory_mb=0, mode=SUBPROCESS, run_py='run.py'):
+        if max_workers <= 0:
+            max_workers = default_max_workers(job_memory_mb)
+        if mode not in (SUBPROCESS, INPROCESS):
+            raise ValueError(f"unknown worker mode {mode!r}")
+        self.max_workers = max_workers
+        self.mode = mode
+        self.run_py = run_py
+        self.jobs = {}
+        self.reserved = 0
+        self.completed = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        if mode == INPROCESS:
+            self.executor = self.start_executor()
+
+    def start_executor(self):
+        """
+        Starts the persistent workers. The forkserver imports the engine
+        once; each worker forked from it then builds its own AWS clients.
+        """
+        import engine
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['engine'])
+        return ProcessPoolExecutor(max_workers=self.max_workers,
+            mp_context=context, initializer=engine.warm_up)
+
+    @property
+    def in_flight(self):
+        return len(self.jobs)
+
+    def is_running(self, job_id):
+        with self.lock:
+            return job_id in self.jobs
+
+    def free_slots(self):
+        with self.lock:
+            return max(0, self.max_workers - len(self.jobs) - self.reserved)
+
+    def reserve(self, n):
+        """
+        Reserves up to n free slots and returns how many were reserved.
+        """
+        with self.lock:
+            granted = max(0, min(n, self.max_workers - len(self.jobs) - self.reserved))
+            self.reserved += granted
+            return granted
+
+    def cancel(self, n=1):
+        """
+        Hands back n reserved slots that will not be used.
+        """
+        with self.lock:
+            self.reserved -= min(n, self.reserved)
+
+    def submit(self, job_id, file_path, user_role, source=None, reserved=False):
+        """
+        Starts a job if a slot is free. source is an optional s3:// URI
+        to stream the input from (see engine.run_job). With reserved, the
+        job takes one of the caller's reserved slots, which is used up
+        whether or not the job starts.
+        Returns True if the job was started, False if the pool is full.
+        Raises DuplicateJobError if job_id is already running here.
+        Other exceptions from starting the job are left to the caller.
+        """
+        with self.lock:
+            if reserved and self.reserved:
+                self.reserved -= 1
+            elif len(self.jobs) + self.reserved >= self.max_workers:
+                return False
+            if job_id in self.jobs:
+                raise DuplicateJobError(f"job_id {job_id} is already running")
+            if self.mode == INPROCESS:
+                import engine
+                try:
+                    job = self.executor.submit(engine.run_job, file_path, user_role, source)
+                except BrokenProcessPool:
+                    # a worker died (e.g. OOM killed) and took the executor
+                    # with it; start a fresh set of workers and retry once
+                    self.executor.shutdown(wait=False)
+                    self.executor = self.start_executor()
+                    job = self.executor.submit(engine.run_job, file_path, user_role, source)
+                self.jobs[job_id] = job
+            else:
+                args = [sys.executable, self.run_py, file_path, str(user_role)]
+                if source:
+                    args.append(source)
+                self.jobs[job_id] = Popen(args)
+            return True
+
+    def reap(self):
+        """
+        Collects finished jobs and frees their slots.
+        Returns a list of (job_id, returncode) for jobs that exited since
+        the last call; returncode is 0 for a successful job.
+        """
+        finished = []
+        with self.lock:
+            for job_id, job in list(self.jobs.items()):
+                returncode = self.returncode(job)
+                if returncode is None:
+                    continue
+                del self.jobs[job_id]
+                if returncode == 0:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                finished.append((job_id, returncode))
+        return finished
+
+    def returncode(self, job):
+        """
+        Exit status of a job, or None while it is still running.
+        """
+        if self.mode == SUBPROCESS:
+            return job.poll()
+        if not job.done():
+            return None
+        try:
+            return 0 if job.result() else 1
+        except Exception as e:
+            print(f"annotation job failed: {e}")
+            return 1
+
+    def stats(self, queue=None):
+        """
+        Returns in-flight and lifetime counts for the pool, plus the
+        approximate number of waiting messages if an SQS queue is given.
+        """
+        with self.lock:
+            stats = {
+                'mode': self.mode,
+                'max_workers': self.max_workers,
+                'in_flight': len(self.jobs),
+                'reserved': self.reserved,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+        if queue is not None:
+            queue.load()
+            stats['queue_depth'] = int(queue.attributes.get('ApproximateNumberOfMessages', 0))
+            stats['queue_in_flight'] = int(queue.attributes.get('ApproximateNumberOfMessagesNotVisible', 0))
+        return stats
+
+### EOF
@@ -0,0 +1,146 @@
+# aws_clients.py
+#
+# Process-wide registry of pooled boto3 clients and resources
+#
+# Building a boto3 client resolves endpoints, walks the credential chain
+# and opens a new connection pool, so clients are built once per process
+# and shared. Low-level clients are thread-safe and shared by all threads;
+# resources are not, so each thread gets its own.
+#
+# This is the one copy of the registry; the ann, web and util servers put
+# this directory on sys.path and import it from here.
+#
+# Pool size, retries and keep-alive can be tuned with configure() or the
+# AWS_MAX_POOL_CONNECTIONS, AWS_MAX_ATTEMPTS, AWS_RETRY_MODE and
+# AWS_TCP_KEEPALIVE environment variables.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import threading
+from collections import Counter
+
+import boto3
+from botocore.config import Config
+
+settings = {
+    'region_name': os.environ.get('AWS_REGION_NAME', 'us-east-1'),
+    'max_pool_connections': int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50)),
+    'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', 5)),
+    'retry_mode': os.environ.get('AWS_RETRY_MODE', 'standard'),
+    'tcp_keepalive': os.environ.get('AWS_TCP_KEEPALIVE', 'true').lower() == 'true',
+}
+
+lock = threading.Lock()
+local = threading.local()
+clients = {}
+# per-thread resource caches by thread id, so stats() can count them
+resource_caches = {}
+created = Counter()
+state = {'pid': None, 'session': None}
+
+
+def configure(**kwargs):
+    """
+    Overrides registry settings (region_name, max_pool_connections,
+    max_attempts, retry_mode, tcp_keepalive). Clients that were already
+    built keep their settings, so call this at startup.
+    """
+    unknown = set(kwargs) - set(settings)
+    if unknown:
+        raise ValueError(f"unknown client settings: {', '.join(sorted(unknown))}")
+    with lock:
+        settings.update(kwargs)
+
+
+def client_config(**overrides):
+    """
+    botocore Config with the registry's pool, retry and keep-alive settings.
+    Extra Config options (e.g. signature_version) are merged on top.
+    """
+    config = Config(
+        max_pool_connections=settings['max_pool_connections'],
+        retries={'max_attempts': settings['max_attempts'], 'mode': settings['retry_mode']},
+        tcp_keepalive=settings['tcp_keepalive'])
+    if overrides:
+        config = config.merge(Config(**overrides))
+    return config
+
+
+def get_session():
+    """
+    The boto3 session for this process. Connections must not be shared
+    with a forked child, so a new pid starts from an empty registry.
+    Must be called with the lock held.
+    """
+    pid = os.getpid()
+    if state['pid'] != pid:
+        clients.clear()
+        resource_caches.clear()
+        created.clear()
+        state['pid'] = pid
+        state['session'] = boto3.session.Session()
+        local.__dict__.clear()
+    return state['session']
+
+
+def get_client(service, region_name=None, **config):
+    """
+    Shared low-level client for a service, e.g.
+    get_client('s3', signature_version='s3v4').
+    """
+    region_name = region_name or settings['region_name']
+    key = (service, region_name, tuple(sorted(config.items())))
+    with lock:
+        session = get_session()
+        client = clients.get(key)
+        if client is None:
+            client = session.client(service, region_name=region_name,
+                config=client_config(**config))
+            clients[key] = client
+            created[f"client:{service}"] += 1
+    return client
+
+
+def get_resource(service, region_name=None, **config):
+    """
+    boto3 resource for a service, cached per thread because resources
+    are not thread-safe.
+    """
+    region_name = region_name or settings['region_name']
+    key = (service, region_name, tuple(sorted(config.items())))
+    with lock:
+        session = get_session()
+        resources = local.__dict__.get('resources')
+        if resources is None:
+            resources = local.__dict__['resources'] = {}
+            resource_caches[threading.get_ident()] = resources
+        resource = resources.get(key)
+        if resource is None:
+            resource = session.resource(service, region_name=region_name,
+                config=client_config(**config))
+            resources[key] = resource
+            created[f"resource:{service}"] += 1
+    return resource
+
+
+def stats():
+    """
+    Number of shared clients and per-thread resources alive, and of
+    clients/resources built per service since the process started.
+    """
+    alive = {thread.ident for thread in threading.enumerate()}
+    with lock:
+        # forget the caches of threads that have exited
+        for ident in set(resource_caches) - alive:
+            del resource_caches[ident]
+        return {
+            'clients_alive': len(clients),
+            'resources_alive': sum(len(resources) for resources in resource_caches.values()),
+            'resource_threads': len(resource_caches),
+            'created': dict(created),
+            'max_pool_connections': settings['max_pool_connections'],
+        }
+
+### EOF
@@ -0,0 +1,100 @@
+# sqs_batch.py
+#
+# Batched receive and delete helpers for SQS consumers
+#
+# Shared by the ann and util servers; see aws_clients.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from botocore.exceptions import ClientError
+
+# SQS returns and accepts at most 10 messages per request
+SQS_BATCH_SIZE = 10
+
+
+def receive_messages(queue, wait_time=20, max_messages=SQS_BATCH_SIZE, attribute_names=()):
+    """
+    Long-polls the queue for up to max_messages messages (capped at 10).
+    attribute_names are message system attributes to return with them,
+    e.g. ApproximateReceiveCount. ClientErrors are left to the caller.
+    """
+    max_messages = max(1, min(max_messages, SQS_BATCH_SIZE))
+    if attribute_names:
+        return queue.receive_messages(WaitTimeSeconds=wait_time, MaxNumberOfMessages=max_messages,
+            AttributeNames=list(attribute_names))
+    return queue.receive_messages(WaitTimeSeconds=wait_time, MaxNumberOfMessages=max_messages)
+
+
+def delete_messages(queue, messages):
+    """
+    Deletes messages with DeleteMessageBatch, 10 at a time.
+    Entries that fail for a reason other than a bad request (e.g. SQS
+    throttling) are retried once. Returns the messages that could not be
+    deleted; they will reappear in the queue once their visibility expires.
+    """
+    failed = []
+    for i in range(0, len(messages), SQS_BATCH_SIZE):
+        batch = messages[i:i + SQS_BATCH_SIZE]
+        retry, rejected = delete_batch(queue, batch)
+        if retry:
+            retry_again, retry_rejected = delete_batch(queue, retry)
+            rejected += retry_again + retry_rejected
+        failed.extend(rejected)
+    if failed:
+        print(f"could not delete {len(failed)} message(s) from queue")
+    return failed
+
+
+def release_messages(queue, messages):
+    """
+    Makes received messages that will not be handled visible again at
+    once (VisibilityTimeout=0), 10 at a time, instead of leaving them in
+    flight until their visibility timeout expires. Returns the messages
+    that could not be released.
+    """
+    failed = []
+    for i in range(0, len(messages), SQS_BATCH_SIZE):
+        batch = messages[i:i + SQS_BATCH_SIZE]
+        entries = [{'Id': str(n), 'ReceiptHandle': message.receipt_handle, 'VisibilityTimeout': 0}
+            for n, message in enumerate(batch)]
+        try:
+            response = queue.change_message_visibility_batch(Entries=entries)
+        except ClientError as e:
+            print(e.response['Error']['Code'])
+            failed.extend(batch)
+            continue
+        for failure in response.get('Failed', []):
+            print(f"could not release message: {failure.get('Code')} {failure.get('Message', '')}")
+            failed.append(batch[int(failure['Id'])])
+    if failed:
+        print(f"could not release {len(failed)} message(s); they reappear once their visibility expires")
+    return failed
+
+
+def delete_batch(queue, batch):
+    """
+    Sends one DeleteMessageBatch request for at most 10 messages.
+    Returns (retryable, rejected): messages that failed transiently and
+    messages that SQS refused (e.g. an expired receipt handle).
+    """
+    entries = [{'Id': str(n), 'ReceiptHandle': message.receipt_handle}
+        for n, message in enumerate(batch)]
+    try:
+        response = queue.delete_messages(Entries=entries)
+    except ClientError as e:
+        print(e.response['Error']['Code'])
+        return list(batch), []
+
+    retryable = []
+    rejected = []
+    for failure in response.get('Failed', []):
+        print(f"could not delete message: {failure.get('Code')} {failure.get('Message', '')}")
+        message = batch[int(failure['Id'])]
+        if failure.get('SenderFault', False):
+            rejected.append(message)
+        else:
+            retryable.append(message)
+    return retryable, rejected
+
+### EOF
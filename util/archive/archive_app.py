@@ -9,7 +9,6 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import json
 import os
-import boto3
 from botocore.exceptions import ClientError
 import sys
 import psycopg2
@@ -22,6 +21,10 @@ app.config.from_object(environment)
 
 sys.path.append(app.config['HELPERS_PATH'])
 import helpers as h
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, os.path.pardir, 'common'))
+from sqs_batch import receive_messages, delete_messages, release_messages
+import aws_clients
 
 
 REGION = app.config['AWS_REGION_NAME']
@@ -37,13 +40,22 @@ AWS_SQS_MAX_MESSAGES = app.config['AWS_SQS_MAX_MESSAGES']
 KEY_SEP = app.config['KEY_SEP']
 FILE_SEP = app.config['FILE_SEP']
 VCF = app.config['VCF']
+# inputs may be uploaded gzipped; results may be BGZF with a tabix index
+GZ = '.gz'
+TBI = '.tbi'
+# job item attributes holding the Glacier archive ids
+RESULTS_ARCHIVE_ID = 'results_file_archive_id'
+INDEX_ARCHIVE_ID = 'results_index_archive_id'
 
 SNS = app.config['AWS_ARCHIVE_SNS_ARN']
 
+# boto3 clients are shared process-wide; see aws_clients.py
+aws_clients.configure(region_name=REGION)
+
 #### CONNECT TO AWS RESOURCES ####
 # Connect to SQS and get the message queue
 try:
-    sqs = boto3.resource('sqs', region_name=REGION)
+    sqs = aws_clients.get_resource('sqs')
 except ClientError as e:
     app.logger.error(e)
 
@@ -53,7 +65,7 @@ try:
 except ClientError as e:
     if e.response['Error']['Code'] == 'AWS.SimpleQueueService.NonExistentQueue':
         queue = sqs.create_queue(QueueName=ARCHIVE_QUEUE)
-        sns = boto3.resource('sns', region_name=REGION)
+        sns = aws_clients.get_resource('sns')
         topic = sns.Topic(SNS)
         try:
             subscription = topic.subscribe(
@@ -69,27 +81,27 @@ except ClientError as e:
 # connect to s3
 try:
     # https://stackoverflow.com/questions/58131961/how-to-make-connection-s3-bucket-using-boto3-and-access-csv-file
-    s3 = boto3.resource('s3', region_name=REGION)
+    s3 = aws_clients.get_resource('s3')
     bucket = s3.Bucket(S3_RESULTS_BUCKET)
 except ClientError as e:
     app.logger.error(e)
 
 # connect to glacier
 try:
-    glacier = boto3.client('glacier', region_name=REGION)
+    glacier = aws_clients.get_client('glacier')
 except ClientError as e:
     app.logger.error(e)
 
 # connect to dynamodb
 try:
-    dynamodb = boto3.resource('dynamodb', region_name=REGION)
+    dynamodb = aws_clients.get_resource('dynamodb')
     ann_table = dynamodb.Table(DYNAMO)
 except ClientError as e:
     app.logger.error(e)
 
 # connect to glacier
 try: 
-    glacier = boto3.client('glacier', region_name=REGION)
+    glacier = aws_clients.get_client('glacier')
 except ClientError as e:
     app.logger.error(e)
 
@@ -107,7 +119,7 @@ def archive_free_user_data():
         try:
             # connect to sns
             # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/reference/services/sns.html
-            sns = boto3.client('sns', region_name=REGION)
+            sns = aws_clients.get_client('sns')
             response = sns.confirm_subscription(
                 TopicArn=request_data['TopicArn'],
                 Token=request_data['Token']
@@ -123,9 +135,12 @@ def archive_free_user_data():
     # get job info
     else:
         try:
-            messages = queue.receive_messages(WaitTimeSeconds=AWS_SQS_WAIT_TIME, MaxNumberOfMessages=AWS_SQS_MAX_MESSAGES)
+            messages = receive_messages(queue, AWS_SQS_WAIT_TIME, AWS_SQS_MAX_MESSAGES)
         except ClientError as e:
             return jsonify({"code": 500, "message": "Could not receive messages from queue."})
+
+        # handled messages are acknowledged together once the batch is done
+        processed = []
         for message in messages:
             message_info = json.loads(json.loads(message.body)['Message'])
 
@@ -133,7 +148,8 @@ def archive_free_user_data():
             job_id = message_info.get('job_id', None)
             input_file = message_info['input_file']
             file_id = f"{job_id}{FILE_SEP}{input_file}"
-            result_file = f"{job_id}{FILE_SEP}{input_file.replace(VCF, '')}{ANNOT}"
+            input_vcf = input_file[:-len(GZ)] if input_file.endswith(GZ) else input_file
+            result_file = f"{job_id}{FILE_SEP}{input_vcf.replace(VCF, '')}{ANNOT}"
             key = f"{CNET}{KEY_SEP}{user}{KEY_SEP}{file_id}{KEY_SEP}{result_file}"
 
             ## CHECK USER ROLE ##
@@ -155,40 +171,63 @@ def archive_free_user_data():
 
                 # archiving an S3 object to Glacier
                 # # https://stackoverflow.com/questions/41833565/s3-buckets-to-glacier-on-demand-is-it-possible-from-boto3-api
-                obj = None
+                # the results and their tabix index, if any, are archived
+                # separately; restore.py puts each back under its own key
+                archived = True
                 for obj in bucket.objects.filter(Prefix=key):
+                    index = obj.key.endswith(TBI)
                     try:
-                        vault_response = glacier.upload_archive(vaultName=GLACIER_VAULT,body=obj.get()['Body'].read())
+                        # results uploaded gzipped keep their Content-Encoding on
+                        # the job item, so restore.py can put it back
+                        s3_object = obj.get()
+                        vault_response = glacier.upload_archive(vaultName=GLACIER_VAULT,body=s3_object['Body'].read())
                         archive_id = vault_response.get('archiveId', None)
                         print('Uploaded to vault, archive id:', archive_id)
                         if archive_id:
-                            update_table(job_id, archive_id)
-                            delete_from_bucket(key)
-                            delete_message(message)
+                            update_table(job_id, archive_id, s3_object.get('ContentEncoding'),
+                                INDEX_ARCHIVE_ID if index else RESULTS_ARCHIVE_ID)
+                            delete_from_bucket(obj.key)
+                        else:
+                            archived = False
                     except ClientError as e:
                         print("Could not archive file. Please try again")
+                        archived = False
+
+                # a retry only finds the objects that are still in S3
+                if archived:
+                    processed.append(message)
 
             else:
                 # ignore if premium user
-                message.delete()
+                processed.append(message)
                 if not user:
                     app.logger.info("Could not retrieve user information. Data left unarchived.")
                 else:
                     app.logger.info("Premium user, abandon archival.")
 
+        delete_processed(processed)
+        # jobs that could not be archived are retried with the next request
+        # instead of waiting out the visibility timeout
+        skipped = [message for message in messages if message not in processed]
+        if skipped:
+            release_messages(queue, skipped)
+
     return jsonify({"code": 200})
 
 
-def update_table(job_id, archive_id):
+def update_table(job_id, archive_id, content_encoding=None, field=RESULTS_ARCHIVE_ID):
+    update_expression = f"set {field} = :a"
+    values = {':a': archive_id}
+    if content_encoding:
+        update_expression += ", results_content_encoding = :e"
+        values[':e'] = content_encoding
     try:
         table_response = ann_table.update_item(
             Key={
                 'job_id': job_id,
                 },
-            UpdateExpression="set results_file_archive_id = :a",
-            ExpressionAttributeValues={
-                ':a': archive_id,
-                },
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=values,
             )
         app.logger.info('Updated table with archive_id')
     except ClientError as e:
@@ -196,26 +235,30 @@ def update_table(job_id, archive_id):
         app.logger.error(e)
 
 
-def delete_from_bucket(key):
+def delete_from_bucket(*keys):
     """
-    Helper function that deletes object from S3 results bucket.
+    Helper function that deletes objects from S3 results bucket.
+    Keys that do not exist are ignored.
     """
     try:
         response = bucket.delete_objects(
-            Delete={'Objects':[{'Key': key}]}
+            Delete={'Objects':[{'Key': key} for key in keys]}
             )
         app.logger.info('File deleted from gas-results')
     except ClientError as e:
         app.logger.error(e)
 
 
-def delete_message(message):
-    try:
-        message.delete()
-        app.logger.info('Message deleted')
-    except ClientError as e:
-        app.logger.error(e)
-        app.logger.error('Message could not be deleted')
+def delete_processed(messages):
+    """
+    Helper function that deletes handled messages in batches.
+    """
+    if not messages:
+        return
+    failed = delete_messages(queue, messages)
+    app.logger.info(f"{len(messages) - len(failed)} message(s) deleted")
+    if failed:
+        app.logger.error(f"{len(failed)} message(s) could not be deleted")
 
 
 # Run using dev server (remove if running via uWSGI)
@@ -7,7 +7,6 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-import boto3
 import time
 import os
 import sys
@@ -18,6 +17,10 @@ from botocore.exceptions import ClientError
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, os.path.pardir, 'common'))
+from sqs_batch import receive_messages, delete_messages
+import aws_clients
 
 # Get configuration
 from configparser import ConfigParser
@@ -32,6 +35,9 @@ AWS_SQS_MAX_MESSAGES = int(config.get('sqs', 'AWS_SQS_MAX_MESSAGES'))
 EMAIL_SUBJECT = config.get('email', 'EMAIL_SUBJECT')
 EMAIL_BODY = config.get('email', 'EMAIL_BODY')
 
+# boto3 clients are shared process-wide; see aws_clients.py
+aws_clients.configure(region_name=REGION)
+
 '''
 Reads result messages from SQS and sends notification emails.
 '''
@@ -39,11 +45,14 @@ def handle_results_queue(sqs=None):
     # Read a message from the queue
 
     try:
-        messages = sqs.receive_messages(WaitTimeSeconds=AWS_SQS_WAIT_TIME, MaxNumberOfMessages=AWS_SQS_MAX_MESSAGES)
+        messages = receive_messages(sqs, AWS_SQS_WAIT_TIME, AWS_SQS_MAX_MESSAGES)
     except ClientError as e:
         print("Could not receive messages from results queue.")
         print(e)
+        return
 
+    # handled messages are acknowledged together once the batch is done
+    processed = []
     for message in messages:
         message_info = json.loads(json.loads(message.body)['Message'])
         # Process message
@@ -80,18 +89,18 @@ def handle_results_queue(sqs=None):
             print('Could not send email')
             print(e)
 
-        # Delete message
-        try:
-            message.delete()
-        except ClientError as e:
-            print('message could not be deleted')
+        processed.append(message)
+
+    # Delete messages
+    if processed:
+        delete_messages(sqs, processed)
 
 if __name__ == '__main__':
   
     # Get handles to resources; and create resources if they don't exist
     
     try:
-        sqs = boto3.resource('sqs', region_name=REGION)
+        sqs = aws_clients.get_resource('sqs')
         queue = sqs.get_queue_by_name(QueueName=QUEUE)
     except ClientError as e:
         print("Could not connect to message queue.")
@@ -12,6 +12,7 @@ import time
 import os
 import sys
 import json
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # Define constants here; no config file is used for Lambdas
@@ -27,28 +28,23 @@ DESC_SEP = ","
 DYNAMODB = ''
 KEY_SEP = '/'
 FILE_SEP = '~'
+# tabix index of BGZF results, archived separately (see archive_app.py)
+TBI = '.tbi'
+# results_restore_status values on the job item (thaw sets IN_PROGRESS)
+RESTORE_COMPLETED = 'COMPLETED'
+
+# Clients are built once per Lambda container and reused by every
+# invocation it serves, instead of being rebuilt on each event
+CLIENT_CONFIG = Config(retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+s3 = boto3.client('s3', region_name=REGION, config=CLIENT_CONFIG)
+glacier = boto3.client('glacier', region_name=REGION, config=CLIENT_CONFIG)
+sqs = boto3.resource('sqs', region_name=REGION, config=CLIENT_CONFIG)
+dynamo = boto3.resource('dynamodb', region_name=REGION, config=CLIENT_CONFIG)
 
 def lambda_handler(event, context):
     #print("Received event: " + json.dumps(event, indent=2))
     
-    # connect to s3
-    try:
-        s3 = boto3.client('s3',region_name=REGION)
-    except ClientError as e:
-        print(e)
-        
-    # connect to glacier
-    try:
-        glacier = boto3.client('glacier', region_name=REGION)
-    except ClientError as e:
-        print(e)
-    
     # connect to queue
-    try:
-        sqs = boto3.resource('sqs', region_name=REGION)
-    except ClientError as e:
-        print(e)
-    
     try:
         queue = sqs.get_queue_by_name(QueueName=QUEUE_NAME)
     except ClientError as e:
@@ -69,14 +65,15 @@ def lambda_handler(event, context):
 
     # connect to dynamodb
     try:
-        dynamo = boto3.resource('dynamodb', region_name=REGION)
         ann_table = dynamo.Table('DYNAMODB')
     except ClientError as e:
         print(e)
         print("Could not connect to dynamodb table")
 
-    messages = queue.receive_messages(WaitTimeSeconds=20)
-    
+    messages = queue.receive_messages(WaitTimeSeconds=20, MaxNumberOfMessages=10)
+
+    # restored messages are acknowledged together at the end of the batch
+    restored = []
     for message in messages:
         job_info = json.loads(json.loads(message.body)['Message'])
         job_id = job_info['JobId']
@@ -95,11 +92,13 @@ def lambda_handler(event, context):
             print(e)
 
 
-        # retrieve job details to use when uploading to s3
-        user_id, key = job_info['JobDescription'].split(DESC_SEP)
+        # retrieve job details to use when uploading to s3; results that
+        # were stored gzipped carry their Content-Encoding (see thaw_app.py)
+        user_id, key, *content_encoding = job_info['JobDescription'].split(DESC_SEP)
+        extra_args = {'ContentEncoding': content_encoding[0]} if content_encoding else None
 
         try:
-            s3.upload_fileobj(output['body'], RESULTS_BUCKET, key)
+            s3.upload_fileobj(output['body'], RESULTS_BUCKET, key, ExtraArgs=extra_args)
             print(f"{key} successfully restored to S3.")
             s3_upload = True
         except ClientError as e:
@@ -124,14 +123,33 @@ def lambda_handler(event, context):
             _, _, input_file, _ = key.split(KEY_SEP)
             table_job_id, _= input_file.split(FILE_SEP)
             try:
-                ann_table.update_item(
-                    TableName=DYNAMODB,
-                    Key={"job_id": table_job_id},
-                    UpdateExpression="REMOVE results_file_archive_id")
+                if key.endswith(TBI):
+                    # the tabix index is restored alongside the results
+                    ann_table.update_item(
+                        TableName=DYNAMODB,
+                        Key={"job_id": table_job_id},
+                        UpdateExpression="REMOVE results_index_archive_id")
+                else:
+                    ann_table.update_item(
+                        TableName=DYNAMODB,
+                        Key={"job_id": table_job_id},
+                        UpdateExpression="REMOVE results_file_archive_id, results_content_encoding "\
+                            "SET results_restore_status = :s",
+                        ExpressionAttributeValues={':s': RESTORE_COMPLETED})
             except ClientError as e:
                 print(e)
 
-            message.delete()
+            restored.append(message)
+
+    if restored:
+        try:
+            response = queue.delete_messages(Entries=[
+                {'Id': str(n), 'ReceiptHandle': message.receipt_handle}
+                for n, message in enumerate(restored)])
+            for failure in response.get('Failed', []):
+                print(f"Could not delete message: {failure.get('Code')}")
+        except ClientError as e:
+            print(e)
 
     return {
         'statusCode': 200,
@@ -9,14 +9,21 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import json
 import os
+import time
 import requests
-import boto3
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key
 import sys
 
 from flask import Flask, jsonify, request
 
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, os.path.pardir, 'common'))
+from sqs_batch import receive_messages, delete_messages, release_messages
+import aws_clients
+
 app = Flask(__name__)
 environment = 'thaw_app_config.Config'
 app.config.from_object(environment)
@@ -26,6 +33,7 @@ app.url_map.strict_slashes = False
 KEY_SEP = app.config['KEY_SEP']
 FILE_SEP = app.config['FILE_SEP']
 DESC_SEP = app.config['DESC_SEP']
+TBI = '.tbi'
 
 REGION = app.config['AWS_REGION_NAME']
 AWS_SQS_WAIT_TIME = app.config['AWS_SQS_WAIT_TIME']
@@ -35,11 +43,17 @@ THAW_SNS_ARN = app.config['AWS_THAW_SNS_ARN']
 
 GLACIER_VAULT_NAME = app.config['AWS_GLACIER_VAULT']
 
+# results_restore_status values on the job item
+RESTORE_IN_PROGRESS = 'IN_PROGRESS'
+
+# boto3 clients are shared process-wide; see aws_clients.py
+aws_clients.configure(region_name=REGION)
+
 
 ### CONNECT TO THAW QUEUE #### 
 THAW_QUEUE = app.config['AWS_THAW_QUEUE']
 try:
-    sqs = boto3.resource('sqs', region_name=REGION)
+    sqs = aws_clients.get_resource('sqs')
 except ClientError as e:
     print(e, file=sys.stderr)
 
@@ -49,7 +63,7 @@ try:
 except ClientError as e:
     if e.response['Error']['Code'] == 'AWS.SimpleQueueService.NonExistentQueue':
         queue = sqs.create_queue(QueueName=THAW_QUEUE)
-        sns = boto3.resource('sns', region_name=REGION)
+        sns = aws_clients.get_resource('sns')
         topic = sns.Topic(THAW_SNS_ARN)
         try:
             subscription = topic.subscribe(
@@ -66,7 +80,7 @@ except ClientError as e:
 
 #### CONNECT TO DYNAMODB TABLE ####
 try:
-    DYNAMODB = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    DYNAMODB = aws_clients.get_resource('dynamodb')
     ANN_TABLE = DYNAMODB.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
 except ClientError as e:
     app.logger.error(e)
@@ -77,7 +91,7 @@ except ClientError as e:
 
 #### CONNECT TO GLACIER ####
 try:    # connect to glacier
-    GLACIER = boto3.client('glacier', region_name=app.config['AWS_REGION_NAME'])
+    GLACIER = aws_clients.get_client('glacier')
 except ClientError as e:
     app.logger.error(e)
     print("Could not connect to vault.")
@@ -106,7 +120,7 @@ def thaw_premium_user_data():
         try:
             # connect to sns
             # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/reference/services/sns.html
-            sns = boto3.client('sns', region_name=REGION)
+            sns = aws_clients.get_client('sns')
             response = sns.confirm_subscription(
                 TopicArn=request_data['TopicArn'],
                 Token=request_data['Token']
@@ -128,7 +142,7 @@ def thaw_premium_user_data():
             print('Job request received.')
             # retrieve messages from queue
             try:
-                messages = queue.receive_messages(WaitTimeSeconds=AWS_SQS_WAIT_TIME, MaxNumberOfMessages=AWS_SQS_MAX_MESSAGES)
+                messages = receive_messages(queue, AWS_SQS_WAIT_TIME, AWS_SQS_MAX_MESSAGES)
             except ClientError as e:
                 return jsonify({"code": 500, "message": "Could not retrieve messages."})
 
@@ -136,62 +150,118 @@ def thaw_premium_user_data():
             print(len(messages))
             if not messages:
                 return jsonify({"code": 200}), 200
-            for message in messages:
-                # parse variables
-                job_info = json.loads(json.loads(message.body)['Message'])
-                app.logger.info('this is job info', job_info)
-                user_id = job_info.get('user_id', None)
-                user_role = job_info.get('user_role', None)
-              
-                print(f"Initiating archival for user {user_id}")
-                # first, retrieve archive ids that are associated with the user
-                try:
-                    table_response = ANN_TABLE.query(
-                        IndexName='user_id_index',
-                        KeyConditionExpression=Key('user_id').eq(user_id)
-                        )
-                    table_response = table_response['Items']
-                except ClientError as e:
-                    app.logger.error(e)
-                    return jsonify({"code": 500, "message": "Could not retrieve jobs for users"}), 500
-                if not table_response:
-                    app.logger.error("Query did not return items.")
-                    return jsonify({"code": 200, "message": "User has no stored jobs."}), 200
-
-
-                # initiating glacier jobs
-                # https://github.com/boto/boto3/issues/2608
-                for item in table_response:
-                    if item.get('results_file_archive_id', None):
-                        prefix = item['s3_key_input_file']
-                        results = item['s3_key_result_file']
-                        _, _, results = results.split(KEY_SEP)
-                        prefix = f"{prefix}{KEY_SEP}{results}"
-                        print('this is prefix', prefix)
-
-                        # attempt expedited thaw
-                        vault_response, exp_thaw = attempt_thaw(item['results_file_archive_id'], user_id, prefix, app.config['EXPEDITED'])
-                        if not exp_thaw:
-                            print("Attempting standard thaw")
-                            vault_response, std_thaw = attempt_thaw(item['results_file_archive_id'], user_id, prefix, app.config['STANDARD'])
-
-                        if not vault_response:
-                            return jsonify({"code": 500, "message": "Could not fulfill archive retrival request."}), 500
-                try:
-                    message.delete()
-                    print("Message deleted")
-                except ClientError as e:
-                    print("Could not delete message")
+
+            # handled messages are acknowledged together, including when
+            # a later message in the batch ends the request early; the
+            # requests of other users left in the batch are released at
+            # once so their thaw is not delayed by the visibility timeout
+            processed = []
+            try:
+                return thaw_messages(messages, processed)
+            finally:
+                if processed:
+                    failed = delete_messages(queue, processed)
+                    print(f"{len(processed) - len(failed)} message(s) deleted")
+                skipped = [message for message in messages if message not in processed]
+                if skipped:
+                    release_messages(queue, skipped)
+    return jsonify({"code": 200}), 200
+
+
+def thaw_messages(messages, processed):
+    """
+    Starts Glacier retrievals for the archived jobs of each user in messages.
+    Messages that were handled are appended to processed.
+    """
+    for message in messages:
+        # parse variables
+        job_info = json.loads(json.loads(message.body)['Message'])
+        app.logger.info('this is job info', job_info)
+        user_id = job_info.get('user_id', None)
+        user_role = job_info.get('user_role', None)
+
+        print(f"Initiating archival for user {user_id}")
+        # first, retrieve archive ids that are associated with the user
+        try:
+            table_response = ANN_TABLE.query(
+                IndexName='user_id_index',
+                KeyConditionExpression=Key('user_id').eq(user_id)
+                )
+            table_response = table_response['Items']
+        except ClientError as e:
+            app.logger.error(e)
+            return jsonify({"code": 500, "message": "Could not retrieve jobs for users"}), 500
+        if not table_response:
+            app.logger.error("Query did not return items.")
+            # nothing to thaw; do not hand the request back to the queue
+            processed.append(message)
+            return jsonify({"code": 200, "message": "User has no stored jobs."}), 200
+
+
+        # initiating glacier jobs
+        # https://github.com/boto/boto3/issues/2608
+        for item in table_response:
+            if item.get('results_file_archive_id', None):
+                prefix = item['s3_key_input_file']
+                results = item['s3_key_result_file']
+                _, _, results = results.split(KEY_SEP)
+                prefix = f"{prefix}{KEY_SEP}{results}"
+                print('this is prefix', prefix)
+
+                # restore.py reads the key, and the Content-Encoding the
+                # results were stored with, back from the job description
+                description = f"{user_id}{DESC_SEP}{prefix}"
+                if item.get('results_content_encoding'):
+                    description += f"{DESC_SEP}{item['results_content_encoding']}"
+
+                # attempt expedited thaw
+                vault_response, exp_thaw = attempt_thaw(item['results_file_archive_id'], description, app.config['EXPEDITED'])
+                if not exp_thaw:
+                    print("Attempting standard thaw")
+                    vault_response, std_thaw = attempt_thaw(item['results_file_archive_id'], description, app.config['STANDARD'])
+
+                if not vault_response:
+                    return jsonify({"code": 500, "message": "Could not fulfill archive retrival request."}), 500
+
+                # the tabix index of BGZF results was archived on its own
+                if item.get('results_index_archive_id'):
+                    index_description = f"{user_id}{DESC_SEP}{prefix}{TBI}"
+                    index_response, _ = attempt_thaw(item['results_index_archive_id'], index_description, app.config['EXPEDITED'])
+                    if not index_response:
+                        index_response, _ = attempt_thaw(item['results_index_archive_id'], index_description, app.config['STANDARD'])
+                    if not index_response:
+                        app.logger.error(f"Could not thaw tabix index for job_id {item['job_id']}")
+                mark_restore_in_progress(item['job_id'])
+        processed.append(message)
     return jsonify({"code": 200}), 200
 
 
-def attempt_thaw(archive_id, user_id, prefix, tier):
+def mark_restore_in_progress(job_id):
+    """
+    Records on the job item that its results are being restored, so the
+    web app can show the restore without probing S3. restore.py sets the
+    status to COMPLETED once the results are back.
+    """
+    try:
+        ANN_TABLE.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression="SET results_restore_status = :s, results_restore_time = :t",
+            ExpressionAttributeValues={
+                ':s': RESTORE_IN_PROGRESS,
+                ':t': int(time.time()),
+            })
+    except ClientError as e:
+        # the web app falls back to checking S3
+        app.logger.error(e)
+
+
+def attempt_thaw(archive_id, description, tier):
     try:
         vault_response = GLACIER.initiate_job(
             vaultName=GLACIER_VAULT_NAME,
             jobParameters={
                 'Type': app.config['ARCHIVE_JOB_TYPE'],
-                'Description': f"{user_id}{DESC_SEP}{prefix}",
+                'Description': description,
                 'ArchiveId': archive_id,
                 'SNSTopic': app.config['AWS_RESTORE_SNS'],
                 'Tier': tier
@@ -0,0 +1,84 @@
+# cache.py
+#
+# Small in-process TTL cache for DynamoDB reads in the web app
+#
+# Entries expire after their own TTL and can be grouped (e.g. all cached
+# pages of one user's job list) so a write can invalidate the whole group.
+# The cache is per process; with several uWSGI workers each one keeps its
+# own copy, and the TTLs bound how stale another worker can be.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread-safe cache of at most max_entries values, each with its own
+    time to live. The least recently used entry is dropped when full.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.groups = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        The cached value, or None if it is missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    self.discard(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl, group=None):
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (value, time.time() + ttl, group)
+            if group is not None:
+                self.groups.setdefault(group, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.discard(next(iter(self.entries)))
+
+    def invalidate(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def invalidate_group(self, group):
+        with self.lock:
+            for key in list(self.groups.get(group, ())):
+                self.discard(key)
+
+    def discard(self, key):
+        # must be called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            keys = self.groups.get(entry[2])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.groups[entry[2]]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+### EOF
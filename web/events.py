@@ -0,0 +1,85 @@
+# events.py
+#
+# In-process fan-out of job events to waiting browsers
+#
+# A detail page for an unfinished job holds an open Server-Sent Events
+# stream (see annotation_events in views.py) that subscribes here. When
+# the job results webhook hears that the job completed, it publishes once
+# and every stream waiting on that job wakes up, instead of each browser
+# polling the page. Like cache.py this is per process; a stream only
+# hears about notifications delivered to the same process.
+#
+# Each open stream holds a server thread, so only max_streams may be open
+# at once; past that, annotation_events answers with the current status
+# and tells the browser to poll again later instead of holding a thread.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import queue
+import threading
+
+
+class JobEvents:
+    """
+    Per-job subscriber queues. Publishing never blocks: a subscriber that
+    already has an event waiting does not need another one.
+    """
+    def __init__(self, max_streams=None):
+        self.subscribers = {}
+        self.max_streams = max_streams
+        self.streams = 0
+        self.lock = threading.Lock()
+
+    def open_stream(self):
+        """
+        Claims one of the max_streams stream slots. Returns False if they
+        are all taken.
+        """
+        with self.lock:
+            if self.max_streams is not None and self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self.lock:
+            self.streams -= 1
+
+    def subscribe(self, job_id):
+        q = queue.Queue(maxsize=1)
+        with self.lock:
+            self.subscribers.setdefault(job_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, job_id, q):
+        with self.lock:
+            queues = self.subscribers.get(job_id)
+            if queues is not None:
+                queues.discard(q)
+                if not queues:
+                    del self.subscribers[job_id]
+
+    def publish(self, job_id, event):
+        """
+        Wakes every subscriber of the job. Returns how many there were.
+        """
+        with self.lock:
+            queues = list(self.subscribers.get(job_id, ()))
+        for q in queues:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass
+        return len(queues)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'streams': self.streams,
+                'max_streams': self.max_streams,
+                'jobs': len(self.subscribers),
+                'subscribers': sum(len(queues) for queues in self.subscribers.values()),
+            }
+
+### EOF
@@ -0,0 +1,172 @@
+# logs.py
+#
+# Paged reads of annotation logs from S3
+#
+# The log view shows one page of a log at a time instead of the whole
+# object. A page is a byte range read with a ranged GET, so the web app
+# holds at most one page of any log in memory. Pages are trimmed to whole
+# lines; the tail of the log is shown unless an offset is asked for. A
+# line longer than a page is cut at the page end, and the next page
+# continues it exactly where it was cut.
+#
+# Logs uploaded gzipped (Content-Encoding: gzip) cannot be read by range,
+# so they are decompressed as a stream, keeping only the requested window.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import zlib
+
+from botocore.exceptions import ClientError
+
+PAGE_BYTES = 64 * 1024
+CHUNK_BYTES = 256 * 1024
+
+
+class LogPage:
+    """
+    Bytes start..end of a log of size bytes (None if the size is not
+    known because the rest of a gzipped log was not read).
+    """
+    def __init__(self, data, start, size, limit):
+        self.lines = data.decode('utf-8', errors='replace').splitlines()
+        self.start = start
+        self.end = start + len(data)
+        self.size = size
+        self.limit = limit
+        # the page ends inside a line too long for one page
+        self.continues = bool(data) and not data.endswith(b'\n') and self.next_offset is not None
+
+    @property
+    def prev_offset(self):
+        return max(0, self.start - self.limit) if self.start > 0 else None
+
+    @property
+    def next_offset(self):
+        if self.size is None or self.end < self.size:
+            return self.end
+        return None
+
+
+def trim(data, first, size, align=True):
+    """
+    Cuts a window read from byte first down to whole lines. A window that
+    does not start the log begins with the byte before the page, so a page
+    starting exactly on a line keeps that line. Without align the window
+    continues a cut line and is kept from its first byte. The end is only
+    cut mid-line if the window holds no newline at all.
+    """
+    start = first
+    if first > 0 and align:
+        newline = data.find(b'\n')
+        if newline < 0:
+            data = data[1:]
+            start += 1
+        else:
+            data = data[newline + 1:]
+            start += newline + 1
+    if size is None or start + len(data) < size:
+        newline = data.rfind(b'\n')
+        if newline >= 0:
+            data = data[:newline + 1]
+    return data, start
+
+
+def read_page(s3, bucket, key, offset=None, limit=PAGE_BYTES, align=True):
+    """
+    The page of the log at key starting near offset, or its last page if
+    offset is None or past the end. Without align the page starts exactly
+    at offset, to continue a page that ended mid-line (LogPage.continues).
+    """
+    # one byte more than the page, to tell whether it starts on a line
+    if offset is None:
+        byte_range = f"bytes=-{limit + 1}"
+    elif not align:
+        byte_range = f"bytes={offset}-{offset + limit - 1}"
+    else:
+        byte_range = f"bytes={max(offset - 1, 0)}-{offset + limit - 1}"
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key, Range=byte_range)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidRange':
+            raise
+        # an empty log, or an offset past the end of the stored object,
+        # which for a gzipped log may still be inside the decompressed one
+        if offset is None:
+            return LogPage(b'', 0, 0, limit)
+        if s3.head_object(Bucket=bucket, Key=key).get('ContentEncoding') == 'gzip':
+            return read_gzip_page(s3, bucket, key, offset, limit, align)
+        return read_page(s3, bucket, key, None, limit)
+
+    if response.get('ContentEncoding') == 'gzip':
+        response['Body'].close()
+        return read_gzip_page(s3, bucket, key, offset, limit, align)
+
+    data = response['Body'].read()
+    # Content-Range: bytes <first>-<last>/<size>
+    content_range = response.get('ContentRange')
+    if content_range:
+        span, size = content_range.split(' ', 1)[1].split('/')
+        first, size = int(span.split('-')[0]), int(size)
+    else:
+        first, size = 0, len(data)
+    data, start = trim(data, first, size, align or offset is None)
+    return LogPage(data, start, size, limit)
+
+
+def gunzip_chunks(chunks):
+    # multi-member aware, like bgzf.iter_gunzip in the annotator
+    d = zlib.decompressobj(31)
+    for chunk in chunks:
+        while chunk:
+            data = d.decompress(chunk)
+            if data:
+                yield data
+            if d.eof:
+                chunk = d.unused_data
+                d = zlib.decompressobj(31)
+            else:
+                chunk = b''
+
+
+def read_gzip_page(s3, bucket, key, offset, limit, align=True):
+    """
+    read_page() for a gzipped log. The log is decompressed from the start,
+    keeping only the window for the page; reading stops once the page is
+    complete.
+    """
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    window = bytearray()
+    position = 0
+    size = None
+    if offset is None:
+        first = 0
+    else:
+        first = max(offset - 1, 0) if align else offset
+    stop = offset + limit if offset is not None else None
+    try:
+        for data in gunzip_chunks(body.iter_chunks(CHUNK_BYTES)):
+            if stop is None:
+                window += data
+                # keep the last page, plus the byte before it
+                if len(window) > limit + 1:
+                    del window[:len(window) - limit - 1]
+            else:
+                window += data[max(first - position, 0):max(stop - position, 0)]
+            position += len(data)
+            if stop is not None and position > stop:
+                break
+        else:
+            size = position
+    finally:
+        body.close()
+
+    if stop is None:
+        first = size - len(window)
+    elif first >= position:
+        # the offset is past the end of the log
+        return read_gzip_page(s3, bucket, key, None, limit)
+    data, start = trim(bytes(window), first, size, align or offset is None)
+    return LogPage(data, start, size, limit)
+
+### EOF
@@ -36,6 +36,7 @@ if [ "$1" = "console" ]; then
   /home/ubuntu/.virtualenvs/mpcs/bin/uwsgi \
     --manage-script-name \
     --enable-threads \
+    --threads 32 \
     --vacuum \
     --log-master \
     --chdir $GAS_WEB_APP_HOME \
@@ -47,6 +48,7 @@ else
     --master \
     --manage-script-name \
     --enable-threads \
+    --threads 32 \
     --vacuum \
     --log-master \
     --chdir $GAS_WEB_APP_HOME \
@@ -0,0 +1,110 @@
+# sns_auth.py
+#
+# Signature checks for messages SNS POSTs to the web app
+#
+# An HTTPS subscription endpoint is reachable by anyone, so a message is
+# only acted on if it carries a valid SNS signature. The signing
+# certificate must come from an SNS host over HTTPS; certificates are
+# cached per process, so a check costs one RSA verify after the first.
+#
+# https://docs.aws.amazon.com/sns/latest/dg/sns-verify-signature-of-message.html
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import re
+import base64
+import threading
+import urllib.request
+from urllib.parse import urlparse
+
+# cryptography is only needed on servers that receive SNS over HTTPS
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+    x509 = None
+
+# fields that are signed, in signing order, per message type
+SIGNED_FIELDS = {
+    'Notification': ('Message', 'MessageId', 'Subject', 'Timestamp', 'TopicArn', 'Type'),
+    'SubscriptionConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp',
+        'Token', 'TopicArn', 'Type'),
+    'UnsubscribeConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp',
+        'Token', 'TopicArn', 'Type'),
+}
+
+CERT_HOST = re.compile(r'^sns\.[a-z0-9-]+\.amazonaws\.com(\.cn)?$')
+CERT_TIMEOUT = 5
+
+lock = threading.Lock()
+certificates = {}
+
+
+class SignatureError(Exception):
+    pass
+
+
+def signing_string(message):
+    """
+    The string SNS signed: name and value of each signed field present in
+    the message, one per line.
+    """
+    fields = SIGNED_FIELDS.get(message.get('Type'))
+    if fields is None:
+        raise SignatureError(f"unknown message type {message.get('Type')}")
+    lines = []
+    for field in fields:
+        if field in message:
+            lines += [field, message[field]]
+    return ''.join(f"{line}\n" for line in lines).encode()
+
+
+def get_certificate(url):
+    """
+    The signing certificate at url, fetched once per process. Only HTTPS
+    URLs on an SNS host are accepted, so a forged message cannot point at
+    a certificate of its own.
+    """
+    parsed = urlparse(url or '')
+    if parsed.scheme != 'https' or not CERT_HOST.match(parsed.hostname or '') \
+            or not parsed.path.endswith('.pem'):
+        raise SignatureError(f"untrusted signing certificate URL {url}")
+    with lock:
+        certificate = certificates.get(url)
+    if certificate is None:
+        with urllib.request.urlopen(url, timeout=CERT_TIMEOUT) as response:
+            certificate = x509.load_pem_x509_certificate(response.read())
+        with lock:
+            certificates[url] = certificate
+    return certificate
+
+
+def verify(message):
+    """
+    Raises SignatureError unless message is signed by SNS. Signature
+    version 1 is SHA1 with RSA, version 2 SHA256 with RSA.
+    """
+    if x509 is None:
+        raise SignatureError("cryptography is not installed; cannot verify SNS messages")
+    version = message.get('SignatureVersion')
+    if version not in ('1', '2'):
+        raise SignatureError(f"unsupported signature version {version}")
+    try:
+        signature = base64.b64decode(message['Signature'])
+    except (KeyError, TypeError, ValueError):
+        raise SignatureError("missing or malformed signature")
+    try:
+        certificate = get_certificate(message.get('SigningCertURL'))
+    except (OSError, ValueError) as e:
+        raise SignatureError(f"could not load signing certificate: {e}")
+    algorithm = hashes.SHA1() if version == '1' else hashes.SHA256()
+    try:
+        certificate.public_key().verify(signature, signing_string(message),
+            padding.PKCS1v15(), algorithm)
+    except InvalidSignature:
+        raise SignatureError("signature does not match")
+
+### EOF
@@ -8,22 +8,47 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
 import uuid
 import time
 import json
+import base64
+import queue
+from decimal import Decimal
 from datetime import datetime
+from urllib.parse import quote
 import sys
 
-import boto3
-from botocore.client import Config
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
 from flask import (abort, flash, redirect, render_template, 
-  request, session, url_for, jsonify)
+  request, session, url_for, jsonify, Response)
 
 from app import app, db
 from decorators import authenticated, is_premium
+# shared helpers; see common/aws_clients.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'common'))
+import aws_clients
+from cache import TTLCache
+from events import JobEvents
+import logs
+import sns_auth
+
+# boto3 clients are shared across requests; see aws_clients.py
+aws_clients.configure(region_name=app.config['AWS_REGION_NAME'])
+
+# short-lived cache of DynamoDB reads; see cache.py
+dynamo_cache = TTLCache()
+
+# open job status streams waiting for completions; see events.py
+job_events = JobEvents(app.config.get('EVENTS_MAX_STREAMS', 8))
+
+# the job list only shows these attributes
+ANNOTATIONS_PROJECTION = 'job_id, submit_time, input_file_name, job_status'
+
+# a job in one of these states no longer changes status
+FINAL_STATUSES = ('COMPLETED', 'FAILED')
 
 """Start annotation request
 Creates the required AWS S3 policy document and renders a form for
@@ -33,9 +58,7 @@ uploading an annotation input file using the policy document
 @authenticated
 def annotate():
     # Open a connection to the S3 service
-    s3 = boto3.client('s3', 
-        region_name=app.config['AWS_REGION_NAME'], 
-        config=Config(signature_version='s3v4'))
+    s3 = aws_clients.get_client('s3', signature_version='s3v4')
 
     bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
     user_id = session['primary_identity']
@@ -91,7 +114,6 @@ def create_annotation_job_request():
     # logging vs. printing file=sys.stdout
     # https://stackoverflow.com/questions/44405708/flask-doesnt-print-to-console
     app.logger.info('creating the annotation request...')
-    region = app.config['AWS_REGION_NAME']
 
     # Parse redirect URL query parameters for S3 object info
     bucket_name = request.args.get('bucket')
@@ -115,7 +137,7 @@ def create_annotation_job_request():
 
     # Persist job to database
     try:
-        dynamodb = boto3.resource('dynamodb', region_name=region)
+        dynamodb = aws_clients.get_resource('dynamodb')
         ann_table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
     except ClientError as e:
         app.logger.error(e)
@@ -126,6 +148,9 @@ def create_annotation_job_request():
         app.logger.error('could not add job to dynamodb.')
         app.logger.error(e.response['Error']['Code'])
 
+    # the new job must show up in the user's job list right away
+    dynamo_cache.invalidate_group(('annotations', user_id))
+
     # Send message to request queue
 
     # Add user role to entry
@@ -133,7 +158,7 @@ def create_annotation_job_request():
     arn = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
 
     try:
-        sns = boto3.client('sns', region_name=region)
+        sns = aws_clients.get_client('sns')
         response = sns.publish(
             TopicArn=arn,
             Message=json.dumps(entry),
@@ -146,6 +171,10 @@ def create_annotation_job_request():
 
 
 """List all annotations for the user
+Pages through the user's jobs with an opaque cursor built from DynamoDB's
+LastEvaluatedKey. AWS_DYNAMODB_ANNOTATIONS_USER_INDEX should name an index
+keyed on user_id with submit_time as its sort key (projecting the listed
+attributes), so pages come back newest first.
 """
 @app.route('/annotations', methods=['GET'])
 @authenticated
@@ -155,31 +184,102 @@ def annotations_list():
     # how to query on secondary index
     # https://stackoverflow.com/questions/35758924/how-do-we-query-on-a-secondary-index-of-dynamodb-using-boto3
 
-    region = app.config['AWS_REGION_NAME']
     user_id = session['primary_identity']
-    print(session['role'])
-    try:
-        dynamodb = boto3.resource('dynamodb', region_name=region)
-        ann_table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-    except ClientError as e:
-        app.logger.error(e)
-        return jsonify({"code": 500, "message": "Could not connect to dynamodb"}), 500
-
-    try: # query table
-        response = ann_table.query(
-            IndexName='user_id_index',
-            KeyConditionExpression=Key('user_id').eq(user_id)
-            )
-    except ClientError as e:
-        app.logger.error(e)
-        return jsonify({"code": 500, "message": "Could not connect to dynamodb"}), 500
+    cursor = request.args.get('cursor')
+    start_key = None
+    if cursor:
+        start_key = decode_cursor(cursor)
+        # a cursor is only valid for the user it was issued to
+        if not isinstance(start_key, dict) or start_key.get('user_id') != user_id:
+            return abort(400)
+
+    cache_key = ('annotations', user_id, cursor)
+    page = dynamo_cache.get(cache_key)
+    if page is None:
+        try:
+            dynamodb = aws_clients.get_resource('dynamodb')
+            ann_table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+        except ClientError as e:
+            app.logger.error(e)
+            return jsonify({"code": 500, "message": "Could not connect to dynamodb"}), 500
+
+        query = {
+            'IndexName': app.config.get('AWS_DYNAMODB_ANNOTATIONS_USER_INDEX', 'user_id_index'),
+            'KeyConditionExpression': Key('user_id').eq(user_id),
+            'ProjectionExpression': ANNOTATIONS_PROJECTION,
+            'ScanIndexForward': False,
+            'Limit': app.config.get('ANNOTATIONS_PAGE_SIZE', 25),
+            }
+        if start_key:
+            query['ExclusiveStartKey'] = start_key
+
+        try: # query table
+            response = ann_table.query(**query)
+        except ClientError as e:
+            app.logger.error(e)
+            return jsonify({"code": 500, "message": "Could not connect to dynamodb"}), 500
+
+        last_key = response.get('LastEvaluatedKey')
+        page = {
+            'items': response['Items'],
+            'next_cursor': encode_cursor(last_key) if last_key else None,
+            }
+        dynamo_cache.set(cache_key, page, app.config.get('ANNOTATIONS_CACHE_TTL', 30),
+            group=('annotations', user_id))
 
     # converting date
     # https://stackoverflow.com/questions/12400256/converting-epoch-time-into-the-datetime
-    response = response['Items']
-    for r in response:
-        r['submit_time'] = time.strftime('%Y-%m-%d %H:%M', time.localtime(r['submit_time']))
-    return render_template('annotations.html', annotations=response)
+    # (on copies, so the cached page keeps the raw timestamps)
+    annotations = [dict(item, submit_time=time.strftime('%Y-%m-%d %H:%M',
+        time.localtime(item['submit_time']))) for item in page['items']]
+    return render_template('annotations.html', annotations=annotations,
+        next_cursor=page['next_cursor'], paged=cursor is not None)
+
+
+def encode_cursor(last_key):
+    """
+    URL-safe cursor for a LastEvaluatedKey. DynamoDB numbers come back as
+    Decimal, which json cannot encode.
+    """
+    plain = {k: int(v) if isinstance(v, Decimal) else v for k, v in last_key.items()}
+    return base64.urlsafe_b64encode(json.dumps(plain).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
+
+
+def get_job_item(job_id):
+    """
+    The job's DynamoDB item, or None if there is no such job. Items are
+    cached so the detail page, its log view and users polling a running
+    job do not each cost a read: briefly while the job can still change
+    state, longer once it is final (see FINAL_STATUSES). The job results
+    webhook below drops the entry as soon as a job completes.
+    """
+    cache_key = ('job', job_id)
+    item = dynamo_cache.get(cache_key)
+    if item is not None:
+        return item
+
+    # https://www.fernandomc.com/posts/ten-examples-of-getting-data-from-dynamodb-with-python-and-boto3/
+    dynamodb = aws_clients.get_resource('dynamodb')
+    ann_table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    item = ann_table.get_item(Key={'job_id': job_id}).get('Item')
+    if item is None:
+        return None
+
+    # a completed job can still be archived or restored; while a restore
+    # runs the item is treated as active
+    if item.get('job_status') in FINAL_STATUSES and item.get('results_restore_status') != 'IN_PROGRESS':
+        ttl = app.config.get('JOB_CACHE_TTL_COMPLETED', 300)
+    else:
+        ttl = app.config.get('JOB_CACHE_TTL_ACTIVE', 5)
+    dynamo_cache.set(cache_key, item, ttl)
+    return item
 
 
 """Display details of a specific annotation job
@@ -190,30 +290,14 @@ def annotation_details(id):
     job_id = id
     current_user = session['primary_identity']
 
-    # connect to table and query
-
-    region = app.config['AWS_REGION_NAME']
-    try:
-        dynamodb = boto3.resource('dynamodb', region_name=region)
-        db_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
-        ann_table = dynamodb.Table(db_name)
-    except ClientError as e:
-        app.logger.error("Could not connect to dynamodb")
-        return abort(500)
-
-    # make query
-    # https://www.fernandomc.com/posts/ten-examples-of-getting-data-from-dynamodb-with-python-and-boto3/
-    
+    # read the job item (cached; see get_job_item)
     try:
-        response = ann_table.get_item(
-            Key={
-                'job_id': job_id,
-                }
-            )
-        response = response['Item']
+        response = get_job_item(job_id)
     except ClientError as e:
         app.logger.error(e)
         return abort(500)
+    if response is None:
+        return abort(404)
 
     # check if current user == user who requested job
     if response['user_id'] != current_user:
@@ -235,9 +319,7 @@ def annotation_details(id):
 
 
     try:
-        s3 = boto3.client('s3', 
-            region_name=region, 
-            config=Config(signature_version='s3v4'))
+        s3 = aws_clients.get_client('s3', signature_version='s3v4')
     except ClientError as e:
         app.logger.error("Could not connect to S3.")
 
@@ -256,6 +338,7 @@ def annotation_details(id):
     role = session['role']
     show_upgrade = None
     results_url = None
+    restore_time = None
     print(role, file=sys.stderr)
 
     if complete_time:
@@ -272,26 +355,15 @@ def annotation_details(id):
             results_url = generate_results_url(s3, results_file)
         
         elif archived and role == 'premium_user':
-            # check if object was previously restored to S3
-            # connect to s3 resource and then to object resource
-            try:
-                s3_resource = boto3.resource('s3', region_name=region)
-            except ClientError as c:
-                print(e)
-                app.logger.error("Could not connect to s3 resource.")
-
-            # checking if S3 object exists
-            # https://stackoverflow.com/questions/33842944/check-if-a-key-exists-in-a-bucket-in-s3-using-boto3
-            obj = None
-            try:
-                print('this is results file', results_file)
-                obj =  s3_resource.Object(app.config['AWS_S3_RESULTS_BUCKET'], results_file).get()
-            except ClientError as e:
-                if e.response['Error']['Code'] == 'AccessDenied':
-                    app.logger.error("Access Denied. Check bucket settings.")
-                elif e.response['Error']['Code'] == 'NoSuchKey':
-                    app.logger.error("Object not in S3. Restoration in process.")
-            if obj:
+            # thaw/restore record the restoration on the item, so a running
+            # restore is shown without asking S3
+            restore_status = response.get('results_restore_status')
+            if restore_status == 'IN_PROGRESS':
+                show_upgrade = 'in progress'
+                restore_time = response.get('results_restore_time')
+                if restore_time:
+                    restore_time = time.strftime('%Y-%m-%d %H:%M', time.localtime(int(restore_time)))
+            elif results_available(s3, job_id, results_file):
                 results_url = generate_results_url(s3, results_file)
             else: # object is not in S3 and is in the process of being retrieved.
                 show_upgrade = 'in progress'
@@ -319,7 +391,42 @@ def annotation_details(id):
             'input_url': input_url
             }
 
-    return render_template('annotation.html', annotation=job_data, show_upgrade=show_upgrade)
+    return render_template('annotation.html', annotation=job_data, show_upgrade=show_upgrade,
+        restore_time=restore_time, final_statuses=FINAL_STATUSES)
+
+def results_available(s3, job_id, results_file):
+    """
+    Whether the results file is in the results bucket, probed with HEAD so
+    no object body is opened. The answer is cached per job: for
+    RESULTS_PROBE_TTL seconds once the file is there, and for
+    RESULTS_PROBE_TTL_MISSING while it is not.
+    """
+    # https://stackoverflow.com/questions/33842944/check-if-a-key-exists-in-a-bucket-in-s3-using-boto3
+    cache_key = ('results', job_id)
+    available = dynamo_cache.get(cache_key)
+    if available is not None:
+        return available
+
+    try:
+        s3.head_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'], Key=results_file)
+        available = True
+    except ClientError as e:
+        # HEAD errors have no body, so a missing key is reported as 404
+        # (or 403 without s3:ListBucket)
+        code = e.response['Error']['Code']
+        if code in ('404', 'NoSuchKey'):
+            app.logger.info("Results not in S3. Restoration in process.")
+        else:
+            app.logger.error(f"Could not check for results in S3: {code}")
+        available = False
+
+    if available:
+        ttl = app.config.get('RESULTS_PROBE_TTL', 300)
+    else:
+        ttl = app.config.get('RESULTS_PROBE_TTL_MISSING', 30)
+    dynamo_cache.set(cache_key, available, ttl)
+    return available
+
 
 def generate_results_url(s3, results_file):
     try:
@@ -334,69 +441,234 @@ def generate_results_url(s3, results_file):
 
 
 """Display the log file contents for an annotation job
+Shows one page of the log (see logs.py): the tail by default, or the page
+at ?offset=<byte>. ?limit= sets the page size in bytes, up to
+LOG_PAGE_MAX_BYTES.
 """
 @app.route('/annotations/<id>/log', methods=['GET'])
 @authenticated
 def annotation_log(id):
 
     job_id = id
+    offset = request.args.get('offset', type=int)
+    # set by the "later" link of a page that ended inside a long line
+    continued = request.args.get('continued', 0, type=int)
+    limit = request.args.get('limit', app.config.get('LOG_PAGE_BYTES', logs.PAGE_BYTES), type=int)
+    if (offset is not None and offset < 0) or limit < 1:
+        return abort(400)
+    limit = min(limit, app.config.get('LOG_PAGE_MAX_BYTES', 1024 * 1024))
+
+    response = get_owned_job_item(job_id)
 
-    # connect to table and query
-    region = app.config['AWS_REGION_NAME']
+    # read one page of the log with a ranged GET
+    # https://docs.aws.amazon.com/AmazonS3/latest/userguide/range-get-olap.html
+    s3 = aws_clients.get_client('s3', signature_version='s3v4')
     try:
-        dynamodb = boto3.resource('dynamodb', region_name=region)
-        db_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
-        ann_table = dynamodb.Table(db_name)
+        page = logs.read_page(s3, app.config['AWS_S3_RESULTS_BUCKET'],
+            log_file_key(response), offset, limit, align=not continued)
     except ClientError as e:
-        app.logger.error("Could not connect to dynamodb")
+        app.logger.error(e)
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return abort(404)
         return abort(500)
-    
-    # make query
-    # https://www.fernandomc.com/posts/ten-examples-of-getting-data-from-dynamodb-with-python-and-boto3/
+
+    # format so jinja for loop outputs correctly
+    # https://stackoverflow.com/questions/33232830/newline-and-dash-not-working-correctly-in-jinja
+    return render_template('view_log.html', job_id=job_id, log_file=page.lines, page=page)
+
+
+"""Download the full log file for an annotation job
+The object is streamed to the browser in chunks, never read whole. A
+gzipped log is sent as stored, with its Content-Encoding.
+"""
+@app.route('/annotations/<id>/log/download', methods=['GET'])
+@authenticated
+def annotation_log_download(id):
+
+    response = get_owned_job_item(id)
+    log_file = log_file_key(response)
+
+    s3 = aws_clients.get_client('s3', signature_version='s3v4')
     try:
-        response = ann_table.get_item(
-            Key={
-                'job_id': job_id,
-                }
-            )
-        response = response['Item']
+        log_object = s3.get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'], Key=log_file)
     except ClientError as e:
         app.logger.error(e)
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return abort(404)
         return abort(500)
 
-    # check that user_id in job equals current user
-    current_user = session['primary_identity']
-    if current_user != response['user_id']:
-        app.logger.error("User does not have access to this job")
-        return abort(403)
+    body = log_object['Body']
+    def stream():
+        try:
+            for chunk in body.iter_chunks(logs.CHUNK_BYTES):
+                yield chunk
+        finally:
+            body.close()
+
+    headers = {
+        'Content-Disposition': attachment_disposition(log_file.rsplit('/', 1)[-1]),
+        'Content-Length': str(log_object['ContentLength']),
+        }
+    if log_object.get('ContentEncoding'):
+        headers['Content-Encoding'] = log_object['ContentEncoding']
+    return Response(stream(), mimetype='text/plain', headers=headers)
 
-    # log file
-    log_file = response['s3_key_log_file']
-    _, _, log_file = log_file.split('/')
-    log_file = response['s3_key_input_file'] + '/' + log_file
 
-    # get s3 object
-    # https://stackoverflow.com/questions/31976273/open-s3-object-as-a-string-with-boto3
-    s3 = boto3.client('s3', 
-        region_name=region, 
-        config=Config(signature_version='s3v4'))
+def attachment_disposition(filename):
+    """
+    Content-Disposition for a download: a quoted ASCII filename for old
+    browsers plus the exact UTF-8 name as filename* (RFC 6266, RFC 5987).
+    """
+    fallback = ''.join(c if ' ' <= c < '\x7f' and c not in '"\\' else '_' for c in filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
 
+
+def get_owned_job_item(job_id):
+    """
+    The job item for the log views; aborts unless the current user owns it.
+    """
     try:
-        log_object = s3.get_object(
-            Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
-            Key=log_file)
+        response = get_job_item(job_id)
     except ClientError as e:
         app.logger.error(e)
-        log_url = None
+        return abort(500)
+    if response is None:
+        return abort(404)
 
-    # read log object
-    # https://stackoverflow.com/questions/31976273/open-s3-object-as-a-string-with-boto3
-    log_url = log_object['Body'].read().decode('utf-8')
-    
-    # format so jinja for loop outputs correctly
-    # https://stackoverflow.com/questions/33232830/newline-and-dash-not-working-correctly-in-jinja
-    log_url = log_url.split('\n')
-    return render_template('view_log.html', job_id=job_id, log_file=log_url)
+    # check that user_id in job equals current user
+    if session['primary_identity'] != response['user_id']:
+        app.logger.error("User does not have access to this job")
+        return abort(403)
+    return response
+
+
+def log_file_key(response):
+    # the log sits next to the input: <input key>/<log file name>
+    _, _, log_file = response['s3_key_log_file'].split('/')
+    return response['s3_key_input_file'] + '/' + log_file
+
+
+"""Stream status updates for an annotation job
+Server-Sent Events stream for the detail page of an unfinished job. It
+sends the job's status, then waits for the job results webhook to report
+the completion and sends the status read back from DynamoDB. The stream
+ends once the job reaches a final status (COMPLETED or FAILED).
+While waiting it sends a keepalive comment every EVENTS_KEEPALIVE seconds
+and re-checks the (cached) item, in case the notification went to
+another process. Streams end after EVENTS_STREAM_TIMEOUT seconds; the
+browser reconnects on its own.
+Every open stream holds a uWSGI thread, so at most EVENTS_MAX_STREAMS are
+open per process. Past that the browser gets the current status and is
+told to reconnect after EVENTS_POLL_MS, i.e. it falls back to polling.
+"""
+@app.route('/annotations/<id>/events', methods=['GET'])
+@authenticated
+def annotation_events(id):
+    job_id = id
+    try:
+        item = get_job_item(job_id)
+    except ClientError as e:
+        app.logger.error(e)
+        return abort(500)
+    if item is None:
+        return abort(404)
+    if item['user_id'] != session['primary_identity']:
+        app.logger.error("User does not have access to this job")
+        return abort(403)
+
+    keepalive = app.config.get('EVENTS_KEEPALIVE', 30)
+    timeout = app.config.get('EVENTS_STREAM_TIMEOUT', 300)
+
+    def stream():
+        # the slot is claimed inside the generator, so it is only held
+        # (and always given back) once the stream actually runs
+        if not job_events.open_stream():
+            data = json.dumps({'job_id': job_id, 'status': item['job_status']})
+            yield f"retry: {app.config.get('EVENTS_POLL_MS', 30000)}\n\n"
+            yield f"event: status\ndata: {data}\n\n"
+            return
+        subscription = job_events.subscribe(job_id)
+        try:
+            # re-read after subscribing, so a completion in between is not missed
+            current = get_job_item(job_id) or item
+            deadline = time.time() + timeout
+            yield f"retry: {app.config.get('EVENTS_RETRY_MS', 5000)}\n\n"
+            last_status = None
+            while True:
+                status = current['job_status']
+                if status != last_status:
+                    data = json.dumps({'job_id': job_id, 'status': status})
+                    yield f"event: status\ndata: {data}\n\n"
+                    last_status = status
+                if status in FINAL_STATUSES:
+                    return
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    subscription.get(timeout=min(keepalive, remaining))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                try:
+                    current = get_job_item(job_id) or current
+                except ClientError as e:
+                    app.logger.error(e)
+        finally:
+            job_events.unsubscribe(job_id, subscription)
+            job_events.close_stream()
+
+    return Response(stream(), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+"""Job results webhook
+HTTPS subscription endpoint for the job results SNS topic the annotator
+publishes to when a job completes. Drops the job's cached item and the
+user's cached job list so the next page view shows the COMPLETED job.
+Status streams waiting on the job are woken up; they re-read the item
+rather than trusting the message. Messages for another topic, or without
+a valid SNS signature (see sns_auth.py), are rejected.
+"""
+@app.route('/annotations/job-results', methods=['POST'])
+def job_results_webhook():
+    try:
+        message = json.loads(request.get_data(as_text=True))
+    except ValueError:
+        return abort(400)
+    if not isinstance(message, dict):
+        return abort(400)
+
+    topic_arn = app.config.get('AWS_SNS_JOB_RESULTS_TOPIC')
+    if not topic_arn or message.get('TopicArn') != topic_arn:
+        return abort(403)
+    try:
+        sns_auth.verify(message)
+    except sns_auth.SignatureError as e:
+        app.logger.warning(f"Rejected job results message: {e}")
+        return abort(403)
+
+    # https://docs.aws.amazon.com/sns/latest/dg/sns-subscribe-https-s-endpoints-to-topic.html
+    message_type = request.headers.get('x-amz-sns-message-type', message.get('Type'))
+    if message_type == 'SubscriptionConfirmation':
+        try:
+            aws_clients.get_client('sns').confirm_subscription(
+                TopicArn=topic_arn, Token=message['Token'])
+        except (ClientError, KeyError) as e:
+            app.logger.error(f"Could not confirm job results subscription: {e}")
+            return abort(500)
+        return ('', 204)
+
+    if message_type == 'Notification':
+        try:
+            job = json.loads(message['Message'])
+            job_id, user_id = job['job_id'], job['user_id']
+        except (KeyError, TypeError, ValueError):
+            return abort(400)
+        dynamo_cache.invalidate(('job', job_id))
+        dynamo_cache.invalidate_group(('annotations', user_id))
+        job_events.publish(job_id, 'job-results')
+
+    return ('', 204)
 
 
 """Subscription management handler
@@ -467,19 +739,41 @@ def subscribe():
     # after the 5 minute grace period.    
     
     try:
-        sqs = boto3.resource('sqs', region_name=app.config['AWS_REGION_NAME'])
+        sqs = aws_clients.get_resource('sqs')
         queue = sqs.Queue(app.config['ARCHIVE_QUEUE_URL'])
     except ClientError as e:
         app.logger.error(e)
         # if we can't connect to queue, just return template for now
 
     try:
-        messages = queue.receive_messages(WaitTimeSeconds=app.config['AWS_SQS_WAIT_TIME'])
+        messages = queue.receive_messages(WaitTimeSeconds=app.config['AWS_SQS_WAIT_TIME'],
+            MaxNumberOfMessages=10)
+        user_messages = []
+        other_messages = []
         for message in messages:
             message_info = json.loads(json.loads(message.body)['Message'])
             message_user_id = message_info.get('user_id', None)
             if message_user_id == user_id:
-                message.delete()
+                user_messages.append(message)
+            else:
+                other_messages.append(message)
+
+        # delete the user's pending archivals in a single batch request
+        if user_messages:
+            response = queue.delete_messages(Entries=[
+                {'Id': str(n), 'ReceiptHandle': message.receipt_handle}
+                for n, message in enumerate(user_messages)])
+            for failure in response.get('Failed', []):
+                app.logger.error(f"Could not cancel archival: {failure.get('Code')}")
+
+        # other users' pending archivals go straight back to the queue
+        # rather than staying in flight until their visibility expires
+        if other_messages:
+            response = queue.change_message_visibility_batch(Entries=[
+                {'Id': str(n), 'ReceiptHandle': message.receipt_handle, 'VisibilityTimeout': 0}
+                for n, message in enumerate(other_messages)])
+            for failure in response.get('Failed', []):
+                app.logger.error(f"Could not release archival: {failure.get('Code')}")
 
     except ClientError as e:
         print("Could not purge archive queue")
@@ -495,7 +789,7 @@ def subscribe():
             "user_role": session['role']
             }
     try:
-        sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+        sns = aws_clients.get_client('sns')
         response = sns.publish(
             TopicArn=thaw_arn,
             Message=json.dumps(thaw_entry),